@@ -0,0 +1,266 @@
+import sys
+import json
+import argparse
+from backends import BACKEND_NAMES
+
+__author__ = 'Steve Kochaver'
+
+# Command line entry point for the analyses so nobody has to edit paths into top_runner to start a run. Options come
+# from the command line, a JSON config, or both (the command line wins). A config can hold one run or a list of them:
+#
+#   python analysis_cli.py pairs --images C:\N --template C:\empty_raster.tif --int-count C:\path_counts.tif --type n
+#   python analysis_cli.py --config runs.json --backend gdal
+#
+#   runs.json: {"runs": [{"command": "pairs", "images": "...", "template": "...", "int_count": "...", "type": "lma"},
+#                        {"command": "direct", "images": "...", "template": "...", "type": "lig"}]}
+#
+# New lines can be ingested once up front (valid-data mask, data window and overviews next to each .bsq), after which
+# the GDAL stages read the mask instead of working it out from the bands, and quicklook makes rough percents from the
+# overviews:
+#
+#   python analysis_cli.py ingest --images C:\N --template C:\empty_raster.tif --nodata zero custom --tolerance 1e-6
+#   python analysis_cli.py quicklook --images C:\N --template C:\empty_raster.tif --type n --overview 16
+#
+# A template doesn't have to be a zero filled raster. template writes one covering every line that holds no pixels at
+# all, as a VRT (only defines the grid) or a sparse GeoTIFF (can be burned into):
+#
+#   python analysis_cli.py template --images C:\N --template C:\empty_raster.vrt
+#
+# Lines not already on the template grid can be warped onto it once with align. Every analysis after that uses the
+# aligned copies:
+#
+#   python analysis_cli.py align --images C:\N --template C:\empty_raster.tif
+#
+# N, LMA and LIG can be done in one run that works out each pair's overlap and intersection once for all three:
+#
+#   python analysis_cli.py shared --variable n C:\N --variable lma C:\LMA --variable lig C:\LIG
+#                                 --template C:\empty_raster.tif --int-count C:\path_counts.tif
+#
+# Sharded runs across several machines go plan, run (on every node, as many times as wanted) and merge:
+#
+#   python analysis_cli.py shard-plan --images C:\N --template C:\empty_raster.tif --type n --work-dir S:\n_work --shards 64
+#   python analysis_cli.py shard-run --work-dir S:\n_work
+#   python analysis_cli.py shard-merge --work-dir S:\n_work
+#
+# Nothing is imported for a backend until a run asks for it.
+
+COMMANDS = ('pairs', 'incremental', 'direct', 'footprints', 'intersection', 'shard-plan', 'shard-run', 'shard-merge',
+            'ingest', 'quicklook', 'align', 'template', 'shared')
+
+DEFAULTS = {'command': None,
+            'images': None,
+            'template': None,
+            'int_count': None,
+            'type': None,
+            'variables': None,
+            'burn': None,
+            'sigmas': [1, 1.96],
+            'backend': 'arcpy',
+            'processes': None,
+            'memory_budget': None,
+            'cache_mb': None,
+            'store': None,
+            'work_dir': None,
+            'shards': None,
+            'shard': None,
+            'nodata': ['zero'],
+            'tolerance': 0.0,
+            'overviews': [4, 16],
+            'overview': 16,
+            'force': False,
+            'resample': 'near',
+            'pipeline': False,
+            'readers': 2,
+            'writers': 2,
+            'read_depth': 4,
+            'write_depth': 8,
+            'threads': 'ALL_CPUS',
+            'instrument_log': None,
+            'profile_pair': None}
+
+# What each command can't run without.
+REQUIRED = {'pairs': ['images', 'template', 'int_count', 'type'],
+            'incremental': ['images', 'template', 'int_count', 'type'],
+            'direct': ['images', 'template', 'type'],
+            'footprints': ['images', 'burn'],
+            'intersection': ['images', 'template', 'int_count'],
+            'shard-plan': ['images', 'template', 'type', 'work_dir', 'shards'],
+            'shard-run': ['work_dir'],
+            'shard-merge': ['work_dir'],
+            'ingest': ['images', 'template'],
+            'quicklook': ['images', 'template', 'type'],
+            'align': ['images', 'template'],
+            'template': ['images', 'template'],
+            'shared': ['variables', 'template', 'int_count']}
+
+
+def build_parser():
+    # Nothing gets a default here so the options actually given can be told apart from the ones left out.
+    parser = argparse.ArgumentParser(description='Run the flight line standard deviation analyses.',
+                                     argument_default=argparse.SUPPRESS)
+    parser.add_argument('command', nargs='?', choices=COMMANDS, default=None,
+                        help='pairs: compare every overlapping pair then count and percent. incremental: the same but '
+                             'only redo pairs whose lines changed. direct: count without pair outputs. footprints: burn '
+                             'pair output footprints into a raster. intersection: make the intersection count raster. '
+                             'shard-plan, shard-run, shard-merge: split the pairs into shards, run shards (on any '
+                             'number of nodes) and merge them into the final counts. Sharded runs always use GDAL. '
+                             'ingest: write valid-data masks and overviews next to the lines. quicklook: rough '
+                             'percents from the overviews. align: put the lines on the template grid once for every '
+                             'analysis after. template: make an empty template covering every line. shared: direct '
+                             'counts for several variables (N, LMA, LIG) from one pass over the pairs.')
+    parser.add_argument('--config', help='JSON file of options, or {"runs": [...]} for several runs')
+    parser.add_argument('--images', help='directory of .bsq flight lines (N, LIG or LMA)')
+    parser.add_argument('--template', help='the zero constant raster covering every line (.tif or .vrt)')
+    parser.add_argument('--int-count', dest='int_count', help='the intersection count (path_counts) raster')
+    parser.add_argument('--type', help="output name prefix, e.g. 'n', 'lig', 'lma'")
+    parser.add_argument('--variable', dest='variables', nargs=2, action='append', metavar=('TYPE', 'IMAGES'),
+                        help='a type and image directory for shared, once per variable. The first sets the geometry')
+    parser.add_argument('--burn', help='the 0 constant raster footprints are burned into')
+    parser.add_argument('--sigmas', type=float, nargs='+', help='standard deviation ranges to check (default 1 1.96)')
+    parser.add_argument('--backend', choices=BACKEND_NAMES, help='arcpy (default) or gdal')
+    parser.add_argument('--processes', type=int, help='worker processes, default every core')
+    parser.add_argument('--memory-budget', dest='memory_budget', type=int, help='MB of arrays to work within')
+    parser.add_argument('--cache-mb', dest='cache_mb', type=int,
+                        help='MB of decoded flight lines each worker keeps for pairs (GDAL comparisons only)')
+    parser.add_argument('--store', choices=['bits', 'uint8'], help='keep pair results in a pair_store')
+    parser.add_argument('--work-dir', dest='work_dir', help='work directory shared by every node of a sharded run')
+    parser.add_argument('--shards', type=int, help='how many shards shard-plan splits the pairs into')
+    parser.add_argument('--shard', type=int, nargs='+', help='shard-run only these shards, default any that are left')
+    parser.add_argument('--nodata', nargs='+', choices=['zero', 'custom'], help='NoData signatures for ingest (default zero)')
+    parser.add_argument('--tolerance', type=float, help='how close to a NoData signature counts as NoData (default 0)')
+    parser.add_argument('--overviews', type=int, nargs='+', help='overview block sizes ingest makes (default 4 16)')
+    parser.add_argument('--overview', type=int, help='which overview quicklook uses (default 16)')
+    parser.add_argument('--force', action='store_true', help='ingest or align lines again even if they are current')
+    parser.add_argument('--resample', help='gdal.Warp resampling for align (default near)')
+    parser.add_argument('--threads', help='threads for gdal.Warp (default ALL_CPUS)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='compare pairs with GDAL in one process, reading ahead and writing behind on threads')
+    parser.add_argument('--readers', type=int, help='pipeline reader threads (default 2)')
+    parser.add_argument('--writers', type=int, help='pipeline writer threads (default 2)')
+    parser.add_argument('--read-depth', dest='read_depth', type=int, help='pairs read ahead of the compare (default 4)')
+    parser.add_argument('--write-depth', dest='write_depth', type=int, help='pairs waiting to be written (default 8)')
+    parser.add_argument('--instrument-log', dest='instrument_log', help='JSON lines file for timings and pair outcomes')
+    parser.add_argument('--profile-pair', dest='profile_pair', help="pair name or pattern to run under cProfile, e.g. '140612_03_TO_*'")
+    return parser
+
+
+def load_runs(argv=None):
+    '''
+    Works out the runs asked for.
+    :param argv: Command line arguments, sys.argv[1:] if None.
+    :return: List of option dictionaries, each with every key in DEFAULTS.
+    '''
+    given = vars(build_parser().parse_args(argv))
+    if given['command'] is None:
+        del given['command']  # Can come from the config instead.
+
+    configured = [{}]
+    config_path = given.pop('config', None)
+    if config_path:
+        with open(config_path) as f:
+            config = json.load(f)
+        configured = config['runs'] if 'runs' in config else [config]
+
+    runs = []
+    for run_config in configured:
+        options = dict(DEFAULTS)
+        options.update(run_config)
+        options.update(given)
+
+        unknown = [key for key in options if key not in DEFAULTS]
+        if unknown:
+            raise ValueError('Unknown option(s) %s' % ', '.join(sorted(unknown)))
+        if options['command'] not in COMMANDS:
+            raise ValueError('No command given, expected one of %s' % ', '.join(COMMANDS))
+        missing = [key for key in REQUIRED[options['command']] if not options[key]]
+        if missing:
+            raise ValueError('%s needs %s' % (options['command'], ', '.join('--' + key.replace('_', '-') for key in missing)))
+        runs.append(options)
+
+    return runs
+
+
+def run(options):
+    '''
+    Does one run.
+    :param options: Option dictionary from load_runs.
+    :return:
+    '''
+    import top_runner
+
+    command = options['command']
+    sigmas = tuple(int(sigma) if sigma == int(sigma) else sigma for sigma in options['sigmas'])
+    memory_budget = options['memory_budget'] * 1024 * 1024 if options['memory_budget'] else None
+    cache_bytes = options['cache_mb'] * 1024 * 1024 if options['cache_mb'] else None
+    pipeline = None
+    if options['pipeline']:
+        from pair_pipeline import PipelineSettings
+        pipeline = PipelineSettings(options['readers'], options['writers'], options['read_depth'], options['write_depth'])
+
+    if command == 'pairs':
+        top_runner.multi_stdev_analysis(options['images'], options['template'], options['int_count'], options['type'],
+                                        sigmas, options['processes'], memory_budget, options['store'], options['backend'],
+                                        pipeline, cache_bytes)
+    elif command == 'incremental':
+        top_runner.incremental_stdev_analysis(options['images'], options['template'], options['int_count'],
+                                              options['type'], sigmas, options['processes'], options['backend'])
+    elif command == 'direct':
+        top_runner.direct_stdev_analysis(options['images'], options['template'], options['type'], sigmas, memory_budget)
+    elif command == 'footprints':
+        top_runner.create_path_footprints(options['images'], options['burn'], options['backend'] == 'gdal')
+    elif command == 'intersection' and options['backend'] == 'gdal':
+        top_runner.gdal_total_intersection(options['images'], options['template'], options['int_count'], pipeline)
+    elif command == 'intersection':
+        import raster_adder
+        raster_adder.total_intersection(options['images'], options['template'], options['int_count'])
+    elif command == 'shard-plan':
+        top_runner.plan_sharded_analysis(options['images'], options['template'], options['type'], options['work_dir'],
+                                         options['shards'], sigmas)
+    elif command == 'shard-run':
+        import shards
+        for shard, outcome in sorted(shards.run_shards(options['work_dir'], options['shard']).items()):
+            print('shard %d: %s' % (shard, outcome))
+    elif command == 'shard-merge':
+        import shards
+        shards.merge(options['work_dir'])
+    elif command == 'ingest':
+        import line_ingest
+        line_ingest.ingest_lines(top_runner.get_files_of_ext(options['images'], '.bsq'), options['nodata'],
+                                 options['tolerance'], options['overviews'], options['template'], options['force'])
+    elif command == 'quicklook':
+        top_runner.quicklook_stdev_analysis(options['images'], options['template'], options['type'], options['overview'],
+                                            sigmas)
+    elif command == 'align':
+        import line_align
+        line_align.align_lines(top_runner.get_files_of_ext(options['images'], '.bsq'), options['template'],
+                               options['resample'], options['threads'], options['force'])
+    elif command == 'shared':
+        top_runner.shared_stdev_analysis([tuple(variable) for variable in options['variables']], options['template'],
+                                         options['int_count'], sigmas, pipeline, memory_budget)
+    elif command == 'template':
+        top_runner.make_template(options['images'], options['template'])
+    return
+
+
+def main(argv=None):
+    try:
+        runs = load_runs(argv)
+    except ValueError as e:
+        sys.stderr.write('%s\n' % e)
+        return 2
+
+    import instrument
+    log_path = runs[0]['instrument_log']
+    if log_path or runs[0]['profile_pair']:
+        instrument.enable(log_path, runs[0]['profile_pair'])
+
+    for options in runs:
+        run(options)
+
+    if instrument.is_enabled():
+        instrument.write_summary()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
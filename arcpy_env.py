@@ -0,0 +1,24 @@
+__author__ = 'Steve Kochaver'
+
+# The arcpy modules used to check out Spatial Analyst and set the environment as soon as they were imported, which
+# every worker process paid for whether it used arcpy or not. Now the functions that need it call setup() instead,
+# so the license is only checked out by a process that actually does arcpy work, and only once.
+
+_ready = False
+
+
+def setup():
+    '''
+    Checks out the Spatial Analyst extension and sets the arcpy environment the arcpy modules expect. Only does
+    anything the first time it's called in a process.
+    :return:
+    '''
+    global _ready
+    if _ready:
+        return
+
+    import arcpy
+    arcpy.CheckOutExtension('Spatial')
+    arcpy.env.overwriteOutput = True
+    _ready = True
+    return
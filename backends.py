@@ -0,0 +1,34 @@
+from collections import namedtuple
+import arcpy_env
+
+__author__ = 'Steve Kochaver'
+
+# The two ways of doing the pair comparisons and sums. Nothing heavy is imported until a backend is asked for, so a
+# process that only uses GDAL never loads arcpy or checks out a license.
+
+Backend = namedtuple('Backend', ['name', 'check_stdev_range', 'check_196stdev_range', 'check_ranges', 'add_small_rasters'])
+
+BACKEND_NAMES = ('arcpy', 'gdal')
+
+
+def load_backend(name):
+    '''
+    Imports a backend's modules and gets it ready to use.
+    :param name: 'arcpy' for stdev_rangefinder and raster_adder, 'gdal' for gdal_rangefinder and gdal_adder.
+    :return: Backend namedtuple of the functions the analyses need. The check functions are module level so they can
+    be handed to pair_scheduler.
+    '''
+    if name == 'gdal':
+        import gdal_rangefinder
+        import gdal_adder
+        return Backend(name, gdal_rangefinder.check_stdev_range, gdal_rangefinder.check_196stdev_range,
+                       gdal_rangefinder.check_ranges, gdal_adder.add_small_rasters)
+
+    if name == 'arcpy':
+        import stdev_rangefinder
+        import raster_adder
+        arcpy_env.setup()
+        return Backend(name, stdev_rangefinder.check_stdev_range, stdev_rangefinder.check_196stdev_range,
+                       stdev_rangefinder.check_ranges, raster_adder.add_small_rasters)
+
+    raise ValueError('Unknown backend %s, expected one of %s' % (name, ', '.join(BACKEND_NAMES)))
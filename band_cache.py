@@ -0,0 +1,169 @@
+import os
+import glob
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+
+__author__ = 'Steve Kochaver'
+
+# Keeps decoded five band rasters and their valid-data masks around so each flight line is only read once per run
+# instead of once for every pair it's in. Entries are keyed by path, size and modification time so a file that changes
+# on disk is simply a cache miss. Nothing is cached until enable() is called. Entries are held as ordinary arrays, not
+# memory mapped views of the .bsq files, so the byte budget is what's really resident.
+
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+_enabled = False
+_max_bytes = DEFAULT_MAX_BYTES
+_spill_dir = None
+_entries = OrderedDict()
+_used_bytes = 0
+
+# pair_pipeline's reader threads share the cache. Loading happens outside the lock so they still read in parallel.
+_lock = threading.RLock()
+
+
+def enable(max_bytes=DEFAULT_MAX_BYTES, spill_dir=None):
+    '''
+    Turns the cache on for this process.
+    :param max_bytes: How much decoded data to hold in memory before the least recently used rasters are dropped.
+    :param spill_dir: Optional directory to keep decoded rasters in as .npy files. Other processes (and later runs)
+    pointed at the same directory will load them instead of decoding again.
+    :return:
+    '''
+    global _enabled, _max_bytes, _spill_dir
+    _enabled = True
+    _max_bytes = max_bytes
+    _spill_dir = spill_dir
+    if spill_dir and not os.path.exists(spill_dir):
+        os.makedirs(spill_dir)
+    return
+
+
+def disable():
+    '''
+    Turns the cache off and empties it. Spilled files are left alone.
+    :return:
+    '''
+    global _enabled
+    _enabled = False
+    clear()
+    return
+
+
+def is_enabled():
+    return _enabled
+
+
+def clear():
+    '''
+    Drops everything held in memory.
+    :return:
+    '''
+    global _used_bytes
+    with _lock:
+        _entries.clear()
+        _used_bytes = 0
+    return
+
+
+def cache_key(raster_path):
+    '''
+    The key a raster is cached under. Changes whenever the file is rewritten. ENVI .bsq files keep their metadata in a
+    .hdr next to them so that's checked too.
+    :param raster_path: The path to the raster.
+    :return: Tuple of (absolute path, size, mtime).
+    '''
+    raster_path = os.path.abspath(raster_path)
+    stat = os.stat(raster_path)
+    size, mtime = stat.st_size, stat.st_mtime
+
+    header_path = os.path.splitext(raster_path)[0] + '.hdr'
+    if os.path.exists(header_path):
+        mtime = max(mtime, os.stat(header_path).st_mtime)
+
+    return raster_path, size, mtime
+
+
+def _spill_prefix(raster_path):
+    return os.path.join(_spill_dir, hashlib.sha1(raster_path.encode('utf-8')).hexdigest())
+
+
+def _spill_paths(key):
+    stamp = '%d_%d' % (key[1], int(key[2] * 1000))
+    prefix = _spill_prefix(key[0]) + '_' + stamp
+    return prefix + '_bands.npy', prefix + '_mask.npy'
+
+
+def _read_spill(key):
+    bands_path, mask_path = _spill_paths(key)
+    if not (os.path.exists(bands_path) and os.path.exists(mask_path)):
+        return None
+    return np.load(bands_path), np.load(mask_path)
+
+
+def _write_spill(key, bands, mask):
+    # Anything spilled for an older version of the file is stale now. Spills for this version are left alone, another
+    # worker may have just written them and a third be about to load them.
+    spill_paths = _spill_paths(key)
+    for old_path in glob.glob(_spill_prefix(key[0]) + '_*.npy'):
+        if old_path in spill_paths:
+            continue
+        try:
+            os.remove(old_path)
+        except OSError:
+            pass  # Still open somewhere, it'll go next time.
+
+    # Write to temp names first so another process (or reader thread) never loads a half written file.
+    for path, array in zip(spill_paths, (bands, mask)):
+        temp_path = path + '.%d.%d.tmp' % (os.getpid(), threading.current_thread().ident)
+        with open(temp_path, 'wb') as f:
+            np.save(f, array)
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            os.remove(temp_path)  # Another process beat us to it.
+    return
+
+
+def _remember(key, bands, mask):
+    global _used_bytes
+    size = bands.nbytes + mask.nbytes
+    if size > _max_bytes:
+        return
+
+    # Same path but an older version of the file.
+    for old_key in [k for k in _entries if k[0] == key[0]]:
+        _used_bytes -= _entries.pop(old_key)[2]
+
+    _entries[key] = (bands, mask, size)
+    _used_bytes += size
+    while _used_bytes > _max_bytes:
+        _used_bytes -= _entries.popitem(last=False)[1][2]
+    return
+
+
+def get(raster_path, loader):
+    '''
+    The decoded bands and valid-data mask of a raster, from memory, from the spill directory or from the loader in that
+    order.
+    :param raster_path: The path to the raster.
+    :param loader: Function taking the path and returning (bands, mask), e.g. gdal_rangefinder.load_raster.
+    :return: Tuple of (bands, mask). Treat them as read only, they're shared with every other caller.
+    '''
+    key = cache_key(raster_path)
+    with _lock:
+        if key in _entries:
+            _entries[key] = _entries.pop(key)
+            return _entries[key][:2]
+
+    arrays = _read_spill(key) if _spill_dir else None
+    if arrays is None:
+        arrays = tuple(np.array(array) if isinstance(array, np.memmap) else array for array in loader(raster_path))
+        if _spill_dir:
+            _write_spill(key, *arrays)
+
+    with _lock:
+        _remember(key, *arrays)
+    return arrays
@@ -0,0 +1,388 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import gdal
+import raster_grid
+import bsq_reader
+import gdal_rangefinder
+import gdal_adder
+import pair_pipeline
+from footprint_index import overlapping_pairs
+from line_names import pair_name
+
+gdal.UseExceptions()
+__author__ = 'Steve Kochaver'
+
+# Times the stages of an analysis on synthetic flight lines so a change that slows things down shows up before it's
+# run on the real data. The lines are five band ENVI .bsq strips laid side by side with a set overlap, named like the
+# real ones so get_date works on them, with nodata margins in either of the signatures custom_nodata looks for.
+#
+#   python benchmark.py --lines 8 --cols 600 --rows 2000 --overlap 0.4 --nodata custom
+#   python benchmark.py --compare
+#
+# Every run is appended to a JSON lines file along with the commit it ran on, so runs can be compared across commits.
+
+RESULTS_NAME = 'benchmark_results.jsonl'
+BAND_NAMES = ['Plus1.96', 'PlusStDev', 'Mean', 'MinusStDev', 'Minus1.96']
+
+# Synthetic grid. UTM-ish coordinates and the 15 m cells the resampled lines use.
+ORIGIN = (500000.0, 4500000.0)
+CELL_SIZE = 15.0
+
+
+def line_name(index):
+    '''
+    A flight line file name in the same layout as the real ones, e.g. f140612t01p00r03.bsq.
+    :param index: The line number.
+    :return: The file name.
+    '''
+    month, day = 6 + index // 28, 1 + index % 28
+    return 'f14%02d%02dt01p00r%02d.bsq' % (month, day, index % 100)
+
+
+def synthetic_bands(cols, rows, nodata, margin, random_state):
+    '''
+    Five bands for one strip. The mean is a smooth field shared by every strip (so overlapping strips mostly agree,
+    like repeat flights over the same ground) plus a bit of per-strip noise, with the range bands around it.
+    :param cols: Strip width in pixels.
+    :param rows: Strip length in pixels.
+    :param nodata: 'zero' or 'custom', which no data signature the margins get.
+    :param margin: How many pixels down each side are no data.
+    :param random_state: numpy RandomState.
+    :return: Float32 array shaped (5, rows, cols).
+    '''
+    y, x = np.mgrid[0:rows, 0:cols].astype(np.float32)
+    mean = 1.0 + 0.2 * np.sin(y / 97.0) * np.cos(x / 61.0) + random_state.normal(0, 0.05, (rows, cols))
+    stdev = 0.05 + 0.05 * random_state.random_sample((rows, cols))
+
+    bands = np.array([mean + 1.96 * stdev, mean + stdev, mean, mean - stdev, mean - 1.96 * stdev], dtype=np.float32)
+
+    # Real lines are a bit skewed in their rectangles, so the margin wanders a few pixels down the strip.
+    edge = (margin + 3 * np.sin(np.arange(rows) / 150.0)).astype(int)
+    outside = (x < edge[:, np.newaxis]) | (x >= cols - edge[:, np.newaxis])
+
+    if nodata == 'custom':
+        fill = np.array(gdal_rangefinder.CUSTOM_NODATA, dtype=np.float32)
+    else:
+        fill = np.zeros(len(BAND_NAMES), dtype=np.float32)
+    bands[:, outside] = fill[:, np.newaxis]
+    return bands
+
+
+def make_lines(out_directory, line_count, cols, rows, overlap, nodata='zero', seed=0):
+    '''
+    Writes synthetic flight lines and a zero template raster covering all of them.
+    :param out_directory: Where the .bsq files and the template go.
+    :param line_count: How many strips.
+    :param cols: Strip width in pixels.
+    :param rows: Strip length in pixels.
+    :param overlap: Fraction of a strip's width its neighbour covers, 0 to 1.
+    :param nodata: 'zero', 'custom' or 'mixed' (alternating) no data signature.
+    :param seed: Random seed, so the same arguments always make the same data.
+    :return: List of the .bsq paths and the template path.
+    '''
+    random_state = np.random.RandomState(seed)
+    step = max(1, int(round(cols * (1 - overlap))))
+    margin = max(1, cols // 20)
+
+    line_paths = []
+    for i in range(line_count):
+        signature = nodata if nodata != 'mixed' else ['zero', 'custom'][i % 2]
+        # Every line is offset a little along track as well so they aren't perfectly stacked.
+        x_off, y_off = i * step, (i % 3) * 7
+        grid = raster_grid.Grid((ORIGIN[0] + x_off * CELL_SIZE, CELL_SIZE, 0.0, ORIGIN[1] - y_off * CELL_SIZE, 0.0, -CELL_SIZE),
+                                '', cols, rows)
+
+        path = os.path.join(out_directory, line_name(i))
+        bsq_reader.write_bands(path, synthetic_bands(cols, rows, signature, margin, random_state), grid, BAND_NAMES)
+        line_paths.append(path)
+
+    template_grid = raster_grid.Grid((ORIGIN[0], CELL_SIZE, 0.0, ORIGIN[1], 0.0, -CELL_SIZE), '',
+                                     (line_count - 1) * step + cols, rows + 14)
+    template_path = zero_raster(os.path.join(out_directory, 'empty_raster.tif'), template_grid)
+    return line_paths, template_path
+
+
+def zero_raster(out_path, grid):
+    '''
+    A zero constant Int32 raster, like the empty_raster.tif template and the burn raster footprints are counted into.
+    :param out_path: The path to the output .tif.
+    :param grid: Its Grid.
+    :return: out_path
+    '''
+    out_raster = raster_grid.create_raster(out_path, grid, (0, 0, grid.cols, grid.rows), gdal.GDT_Int32)
+    out_raster.GetRasterBand(1).Fill(0)
+    out_raster = None
+    return out_path
+
+
+def peak_rss():
+    '''
+    The most memory this process has held so far, in MB. None if there's no way to ask on this platform.
+    :return: Float or None.
+    '''
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / 1024.0 ** 2
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    if sys.platform == 'darwin':
+        return peak / 1024.0 ** 2
+    return peak / 1024.0
+
+
+def total_size(paths):
+    size = 0
+    for path in paths:
+        size += os.path.getsize(path)
+        header = bsq_reader.header_path(path)
+        if header:
+            size += os.path.getsize(header)
+    return size
+
+
+def time_stage(name, func, pairs=0, read_paths=()):
+    '''
+    Runs one stage and measures it.
+    :param name: The stage name for the report.
+    :param func: Function taking no arguments.
+    :param pairs: How many pairs the stage handles, for pairs/sec. 0 if it isn't a per pair stage.
+    :param read_paths: The files the stage reads, for MB/s. A path read twice should be in here twice. Can be a function
+    returning the list, for stages reading outputs that aren't there until an earlier stage has run.
+    :return: Dictionary of the stage's numbers.
+    '''
+    start = time.time()
+    func()
+    seconds = time.time() - start
+
+    if callable(read_paths):
+        read_paths = read_paths()
+    megabytes = total_size(read_paths) / 1024.0 ** 2
+    return {'stage': name,
+            'seconds': seconds,
+            'pairs': pairs,
+            'pairs_per_sec': pairs / seconds if pairs and seconds else None,
+            'mb_read': megabytes,
+            'mb_per_sec': megabytes / seconds if seconds else None,
+            'peak_rss_mb': peak_rss()}
+
+
+def gdal_stages(line_paths, template_path, work_directory):
+    '''
+    The stages of an analysis with the GDAL backend, in the order top_runner runs them.
+    :return: List of (name, function, pairs, read paths) for time_stage.
+    '''
+    pair_dir = os.path.join(work_directory, 'stdev_outs')
+    os.makedirs(pair_dir)
+    pairs = overlapping_pairs(line_paths)
+
+    def check_pairs():
+        for raster_file, compare_file in pairs:
+            output_path = os.path.join(pair_dir, pair_output_name(raster_file, compare_file))
+            try:
+                gdal_rangefinder.check_stdev_range(raster_file, compare_file, output_path, template_path)
+            except gdal_rangefinder.NoOverlap:
+                pass  # Strips whose data doesn't meet, skipped like the analyses skip them.
+
+    def pair_outputs():
+        return gdal_adder.get_files_of_ext(pair_dir, '.tif')
+
+    return [('check_stdev_range', check_pairs, len(pairs), [path for pair in pairs for path in pair]),
+            ('add_small_rasters', lambda: gdal_adder.add_small_rasters(pair_dir, template_path, os.path.join(work_directory, 'true_count.tif')),
+             len(pairs), pair_outputs),
+            ('total_intersection', lambda: list(pair_pipeline.total_intersection(pairs, template_path, os.path.join(work_directory, 'int_count.tif'))),
+             len(pairs), [path for pair in pairs for path in pair]),
+            ('create_path_footprints', lambda: gdal_adder.create_path_footprints(pair_dir, zero_raster(os.path.join(work_directory, 'path_counts.tif'), raster_grid.get_grid(template_path))),
+             len(pairs), pair_outputs)]
+
+
+def arcpy_stages(line_paths, template_path, work_directory):
+    '''
+    The same stages with the arcpy versions. Only imported when asked for so the GDAL run works without arcpy.
+    :return: List of (name, function, pairs, read paths) for time_stage.
+    '''
+    import stdev_rangefinder
+    import raster_adder
+    import top_runner
+
+    pair_dir = os.path.join(work_directory, 'stdev_outs')
+    os.makedirs(pair_dir)
+    pairs = overlapping_pairs(line_paths)
+
+    def check_pairs():
+        for raster_file, compare_file in pairs:
+            output_path = os.path.join(pair_dir, pair_output_name(raster_file, compare_file))
+            try:
+                stdev_rangefinder.check_stdev_range(raster_file, compare_file, output_path, template_path)
+            except RuntimeError:
+                pass  # arcpy's error for strips whose data doesn't meet.
+
+    def pair_outputs():
+        return gdal_adder.get_files_of_ext(pair_dir, '.tif')
+
+    return [('check_stdev_range', check_pairs, len(pairs), [path for pair in pairs for path in pair]),
+            ('add_small_rasters', lambda: raster_adder.add_small_rasters(pair_dir, template_path, os.path.join(work_directory, 'true_count.tif')),
+             len(pairs), pair_outputs),
+            ('total_intersection', lambda: raster_adder.total_intersection(os.path.dirname(line_paths[0]), template_path, os.path.join(work_directory, 'int_count.tif')),
+             len(pairs), lambda: [path for pair in pairs for path in pair]),
+            ('create_path_footprints', lambda: top_runner.create_path_footprints(pair_dir, zero_raster(os.path.join(work_directory, 'path_counts.tif'), raster_grid.get_grid(template_path)), fused=False),
+             len(pairs), pair_outputs)]
+
+
+BACKENDS = {'gdal': gdal_stages, 'arcpy': arcpy_stages}
+
+
+def pair_output_name(raster_file, compare_file):
+    return pair_name(raster_file, compare_file) + '.tif'
+
+
+def git_commit():
+    '''
+    The commit the code being timed is at, with a + on the end if the working tree has changes.
+    :return: String, or None outside of a git checkout.
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=here).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=here).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+' if dirty else '')
+
+
+def run_benchmark(line_count=6, cols=500, rows=1500, overlap=0.4, nodata='zero', backend='gdal', seed=0, keep_directory=None):
+    '''
+    Makes a synthetic data set, runs every stage on it and measures them.
+    :param line_count: How many strips.
+    :param cols: Strip width in pixels.
+    :param rows: Strip length in pixels.
+    :param overlap: Fraction of a strip's width its neighbour covers.
+    :param nodata: 'zero', 'custom' or 'mixed'.
+    :param backend: 'gdal' or 'arcpy'.
+    :param seed: Random seed for the synthetic data.
+    :param keep_directory: Work in this directory and leave everything there. A temp directory is used and removed
+    otherwise.
+    :return: Result dictionary, as saved by save_result.
+    '''
+    work_directory = keep_directory or tempfile.mkdtemp(prefix='stdev_benchmark_')
+    if not os.path.exists(work_directory):
+        os.makedirs(work_directory)
+
+    try:
+        line_dir = os.path.join(work_directory, 'lines')
+        os.makedirs(line_dir)
+
+        start = time.time()
+        line_paths, template_path = make_lines(line_dir, line_count, cols, rows, overlap, nodata, seed)
+        generate_seconds = time.time() - start
+
+        stages = []
+        for name, func, pairs, read_paths in BACKENDS[backend](line_paths, template_path, work_directory):
+            stages.append(time_stage(name, func, pairs, read_paths))
+    finally:
+        if keep_directory is None:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    return {'commit': git_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'gdal': gdal.VersionInfo('RELEASE_NAME'),
+            'backend': backend,
+            'params': {'lines': line_count, 'cols': cols, 'rows': rows, 'overlap': overlap, 'nodata': nodata, 'seed': seed},
+            'generate_seconds': generate_seconds,
+            'stages': stages}
+
+
+def save_result(result, results_path):
+    with open(results_path, 'a') as f:
+        f.write(json.dumps(result, sort_keys=True) + '\n')
+    return
+
+
+def load_results(results_path):
+    if not os.path.exists(results_path):
+        return []
+    with open(results_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def format_number(value, places=2):
+    return '-' if value is None else '%.*f' % (places, value)
+
+
+def print_result(result):
+    print('%s on %s, %s backend, %s' % (result['time'], result['commit'], result['backend'],
+                                        ', '.join('%s=%s' % item for item in sorted(result['params'].items()))))
+    print('%-24s %10s %8s %10s %10s %10s' % ('stage', 'seconds', 'pairs', 'pairs/sec', 'MB/s', 'peak MB'))
+    for stage in result['stages']:
+        print('%-24s %10s %8d %10s %10s %10s' % (stage['stage'], format_number(stage['seconds'], 3), stage['pairs'],
+                                                 format_number(stage['pairs_per_sec']), format_number(stage['mb_per_sec']),
+                                                 format_number(stage['peak_rss_mb'], 1)))
+    return
+
+
+def print_comparison(results):
+    '''
+    Seconds per stage for every saved run with the same parameters and backend as the latest one, oldest first, so a
+    regression shows up as a jump down a column.
+    :param results: List of result dictionaries from load_results.
+    :return:
+    '''
+    if not results:
+        print('No saved results.')
+        return
+
+    latest = results[-1]
+    matching = [result for result in results
+                if result['params'] == latest['params'] and result['backend'] == latest['backend']]
+    stage_names = [stage['stage'] for stage in latest['stages']]
+
+    print(', '.join('%s=%s' % item for item in sorted(latest['params'].items())) + ', %s backend' % latest['backend'])
+    print('%-20s %-12s' % ('time', 'commit') + ''.join(' %22s' % name for name in stage_names))
+    for result in matching:
+        seconds = dict((stage['stage'], stage['seconds']) for stage in result['stages'])
+        print('%-20s %-12s' % (result['time'], result['commit']) +
+              ''.join(' %22s' % format_number(seconds.get(name), 3) for name in stage_names))
+    return
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the analysis stages on synthetic flight lines.')
+    parser.add_argument('--lines', type=int, default=6, help='number of flight lines')
+    parser.add_argument('--cols', type=int, default=500, help='strip width in pixels')
+    parser.add_argument('--rows', type=int, default=1500, help='strip length in pixels')
+    parser.add_argument('--overlap', type=float, default=0.4, help='fraction of a strip its neighbour covers')
+    parser.add_argument('--nodata', choices=['zero', 'custom', 'mixed'], default='zero', help='no data signature')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='gdal')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', help='work in this directory and leave the data and outputs there')
+    parser.add_argument('--results', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), RESULTS_NAME),
+                        help='JSON lines file results are appended to')
+    parser.add_argument('--compare', action='store_true', help='print the saved results instead of running')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        print_comparison(load_results(args.results))
+        return
+
+    result = run_benchmark(args.lines, args.cols, args.rows, args.overlap, args.nodata, args.backend, args.seed, args.keep)
+    save_result(result, args.results)
+    print_result(result)
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+import os
+import re
+import numpy as np
+from raster_grid import Grid
+
+__author__ = 'Steve Kochaver'
+
+# Reads ENVI files (raw binary plus a .hdr) by memory mapping them. Bands come back as numpy views straight onto the
+# file so nothing is decoded or copied, and every process reading the same file shares the OS page cache.
+
+# ENVI data type codes to numpy types.
+ENVI_DTYPES = {1: np.uint8,
+               2: np.int16,
+               3: np.int32,
+               4: np.float32,
+               5: np.float64,
+               12: np.uint16,
+               13: np.uint32,
+               14: np.int64,
+               15: np.uint64}
+
+
+def header_path(raster_path):
+    '''
+    Where the ENVI header for a raster should be. ENVI writes it either next to the data with .hdr swapped in for the
+    extension or tacked on the end of the full name.
+    :param raster_path: The path to the raw data file.
+    :return: The path to the header or None if there isn't one.
+    '''
+    for path in [os.path.splitext(raster_path)[0] + '.hdr', raster_path + '.hdr']:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def parse_header(hdr_path):
+    '''
+    Reads an ENVI header into a dictionary. Keys are lower case, {} lists are split on commas.
+    :param hdr_path: The path to the .hdr file.
+    :return: Dictionary of header values as strings or lists of strings.
+    '''
+    with open(hdr_path) as f:
+        text = f.read()
+
+    if not text.startswith('ENVI'):
+        raise ValueError('%s is not an ENVI header' % hdr_path)
+
+    header = {}
+    # key = value, where value is either the rest of the line or everything inside {} (which can span lines).
+    for match in re.finditer(r'^\s*([^=\n]+?)\s*=\s*(\{[^}]*\}|[^\n]*)', text, re.MULTILINE):
+        key, value = match.group(1).strip().lower(), match.group(2).strip()
+        if value.startswith('{'):
+            inner = value[1:-1].strip()
+            if key in ('description', 'coordinate system string'):
+                value = inner
+            else:
+                value = [item.strip() for item in inner.split(',')]
+        header[key] = value
+
+    return header
+
+
+def header_geotransform(header):
+    '''
+    Turns ENVI map info into a GDAL style geotransform.
+    :param header: Dictionary from parse_header.
+    :return: Geotransform tuple, or the GDAL default (pixel coordinates) if there's no map info.
+    '''
+    map_info = header.get('map info')
+    if not map_info:
+        return 0.0, 1.0, 0.0, 0.0, 0.0, 1.0
+
+    # {projection, reference x pixel, reference y pixel, easting, northing, x size, y size, ...}. The reference pixel
+    # is 1 based and 1, 1 is the upper left corner of the upper left pixel.
+    ref_x, ref_y, easting, northing, x_size, y_size = [float(value) for value in map_info[1:7]]
+    return easting - (ref_x - 1) * x_size, x_size, 0.0, northing + (ref_y - 1) * y_size, 0.0, -y_size
+
+
+def header_grid(header):
+    '''
+    The Grid for an ENVI header.
+    :param header: Dictionary from parse_header.
+    :return: Grid namedtuple.
+    '''
+    return Grid(header_geotransform(header), header.get('coordinate system string', ''),
+                int(header['samples']), int(header['lines']))
+
+
+def get_grid(raster_path):
+    '''
+    The Grid of an ENVI raster from its header alone.
+    :param raster_path: The path to the raw data file.
+    :return: Grid namedtuple.
+    '''
+    return header_grid(parse_header(header_path(raster_path)))
+
+
+def open_bands(raster_path):
+    '''
+    Memory maps an ENVI raster. Band sequential files give each band as a contiguous view, band and pixel interleaved
+    files work too but their bands are strided views.
+    :param raster_path: The path to the raw data file.
+    :return: Read only numpy memmap view shaped (bands, lines, samples), the Grid and the list of band names.
+    '''
+    header = parse_header(header_path(raster_path))
+    samples, lines, band_count = int(header['samples']), int(header['lines']), int(header['bands'])
+
+    dtype = np.dtype(ENVI_DTYPES[int(header['data type'])])
+    if int(header.get('byte order', 0)) == 1:
+        dtype = dtype.newbyteorder('>')
+    else:
+        dtype = dtype.newbyteorder('<')
+
+    interleave = header.get('interleave', 'bsq').lower()
+    shapes = {'bsq': ((band_count, lines, samples), (0, 1, 2)),
+              'bil': ((lines, band_count, samples), (1, 0, 2)),
+              'bip': ((lines, samples, band_count), (2, 0, 1))}
+    if interleave not in shapes:
+        raise ValueError('Unknown ENVI interleave %s' % interleave)
+    shape, axes = shapes[interleave]
+
+    data = np.memmap(raster_path, dtype=dtype, mode='r', offset=int(header.get('header offset', 0)), shape=shape)
+    bands = data.transpose(axes)
+
+    band_names = header.get('band names') or ['Band %d' % (i + 1) for i in range(band_count)]
+    return bands, header_grid(header), band_names
+
+
+def read_bands(raster_path, window=None):
+    '''
+    The bands of an ENVI raster for a window, as a view on the memory mapped file. Only copies if the file isn't in
+    native byte order float32 already.
+    :param raster_path: The path to the raw data file.
+    :param window: Optional window tuple (xoff, yoff, cols, rows) in the raster's own pixels.
+    :return: Float32 array shaped (bands, rows, cols).
+    '''
+    bands = open_bands(raster_path)[0]
+    if window is not None:
+        bands = bands[:, window[1]:window[1] + window[3], window[0]:window[0] + window[2]]
+
+    if bands.dtype != np.float32 or not bands.dtype.isnative:
+        return bands.astype(np.float32)
+    return bands
+
+
+def write_bands(raster_path, bands, grid, band_names=None):
+    '''
+    Writes a band sequential ENVI file (raw data plus .hdr) that open_bands can map again.
+    :param raster_path: The path to the raw data file, e.g. something.bsq.
+    :param bands: Numpy array shaped (bands, lines, samples).
+    :param grid: The Grid to put in map info. Only north up grids, same as everything else here.
+    :param band_names: Optional list of band names.
+    :return:
+    '''
+    dtype_codes = dict((np.dtype(value), key) for key, value in ENVI_DTYPES.items())
+    bands = np.ascontiguousarray(bands, dtype=bands.dtype.newbyteorder('<'))
+    gt = grid.geotransform
+
+    lines = ['ENVI',
+             'samples = %d' % bands.shape[2],
+             'lines = %d' % bands.shape[1],
+             'bands = %d' % bands.shape[0],
+             'header offset = 0',
+             'file type = ENVI Standard',
+             'data type = %d' % dtype_codes[np.dtype(bands.dtype.name)],
+             'interleave = bsq',
+             'byte order = 0',
+             'map info = {Arbitrary, 1, 1, %r, %r, %r, %r}' % (gt[0], gt[3], gt[1], -gt[5])]
+    if grid.projection:
+        lines.append('coordinate system string = {%s}' % grid.projection)
+    if band_names:
+        lines.append('band names = {%s}' % ', '.join(band_names))
+
+    bands.tofile(raster_path)
+    with open(os.path.splitext(raster_path)[0] + '.hdr', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return
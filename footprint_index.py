@@ -0,0 +1,90 @@
+import raster_grid
+import line_ingest
+import instrument
+
+__author__ = 'Steve Kochaver'
+
+# Works out which flight lines can possibly overlap before any pixels are read. Most of our lines are parallel strips
+# so the bulk of the n(n-1)/2 pairs never touch and there's no reason to schedule them.
+
+
+def raster_extent(raster_path):
+    '''
+    The georeferenced extent of a raster, straight from its header.
+    :param raster_path: The path to the raster dataset.
+    :return: Tuple of (x_min, y_min, x_max, y_max).
+    '''
+    gt, projection, cols, rows = raster_grid.get_grid(raster_path)
+    x_1, x_2 = gt[0], gt[0] + cols * gt[1]
+    y_1, y_2 = gt[3], gt[3] + rows * gt[5]
+    return min(x_1, x_2), min(y_1, y_2), max(x_1, x_2), max(y_1, y_2)
+
+
+def valid_extent(raster_path):
+    '''
+    The georeferenced extent of where a raster has data. Flight lines that have been through line_ingest know this
+    exactly, anything else gets its header extent.
+    :param raster_path: The path to the raster dataset.
+    :return: Tuple of (x_min, y_min, x_max, y_max).
+    '''
+    ingested, bounds = line_ingest.valid_bounds(raster_path)
+    if not ingested or bounds is None:
+        return raster_extent(raster_path)
+
+    gt = raster_grid.get_grid(raster_path).geotransform
+    x_1, x_2 = gt[0] + bounds[0] * gt[1], gt[0] + (bounds[0] + bounds[2]) * gt[1]
+    y_1, y_2 = gt[3] + bounds[1] * gt[5], gt[3] + (bounds[1] + bounds[3]) * gt[5]
+    return min(x_1, x_2), min(y_1, y_2), max(x_1, x_2), max(y_1, y_2)
+
+
+def extents_overlap(extent_1, extent_2):
+    '''
+    True if two extents share some area. Extents that only touch along an edge don't count.
+    :param extent_1: Tuple of (x_min, y_min, x_max, y_max).
+    :param extent_2: Tuple of (x_min, y_min, x_max, y_max).
+    :return: Boolean.
+    '''
+    return (extent_1[0] < extent_2[2] and extent_2[0] < extent_1[2] and
+            extent_1[1] < extent_2[3] and extent_2[1] < extent_1[3])
+
+
+def overlapping_indices(extents):
+    '''
+    Sweeps a list of extents sorted by their left edge to find every pair that overlaps. Only extents whose x ranges
+    overlap ever get compared, so it's about n log n for strips rather than n squared.
+    :param extents: List of (x_min, y_min, x_max, y_max) tuples.
+    :return: Sorted list of (i, j) index pairs with i < j.
+    '''
+    order = sorted(range(len(extents)), key=lambda i: extents[i][0])
+    pairs = []
+
+    for position, i in enumerate(order):
+        for j in order[position + 1:]:
+            if extents[j][0] >= extents[i][2]:
+                break  # Everything after this starts further right still.
+            if extents_overlap(extents[i], extents[j]):
+                pairs.append((min(i, j), max(i, j)))
+
+    return sorted(pairs)
+
+
+def overlapping_pairs(files, extent_func=valid_extent):
+    '''
+    Drop-in replacement for pair_scheduler.list_pairs that leaves out pairs whose footprints can't intersect. Order and
+    direction of the pairs that are left is the same as list_pairs.
+    :param files: List of file paths.
+    :param extent_func: Function giving a file's (x_min, y_min, x_max, y_max). The valid-data extent by default, which
+    is the header extent for lines that haven't been ingested.
+    :return: List of (raster_file, compare_file) tuples.
+    '''
+    extents = [extent_func(path) for path in files]
+    indices = overlapping_indices(extents)
+
+    if instrument.is_enabled():
+        kept = set(indices)
+        for i in range(len(files)):
+            for j in range(i + 1, len(files)):
+                if (i, j) not in kept:
+                    instrument.skip_pair(files[i], files[j], 'footprints do not overlap')
+
+    return [(files[i], files[j]) for i, j in indices]
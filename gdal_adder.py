@@ -0,0 +1,388 @@
+import os
+import numpy as np
+import gdal
+from gdalconst import *
+import raster_grid
+import tiling
+import instrument
+import pair_store
+
+gdal.UseExceptions()
+__author__ = 'Steve Kochaver'
+
+# GDAL/NumPy version of raster_adder. Rather than blowing every small raster up to the template extent and chaining
+# Map Algebra additions, each one is added straight into a single count array at its own offset.
+
+# Count tile plus the read buffer for whichever raster is being added.
+ADD_BYTES_PER_PIXEL = 8
+
+# Two Int32 count tiles plus the Float32 output.
+PERCENT_BYTES_PER_PIXEL = 12
+PERCENT_NODATA = -1
+
+# Footprint tile, the image values read for it and the burn raster values it's added to.
+FOOTPRINT_BYTES_PER_PIXEL = 12
+
+
+def listdir_fullpath(directory):
+    return [os.path.join(directory, name) for name in os.listdir(directory)]
+
+
+def get_files_of_ext(directory, extension):
+    return [path for path in listdir_fullpath(directory) if os.path.splitext(path)[1].lower() == extension]
+
+
+def new_count_array(template_grid, memmap_path=None):
+    '''
+    Makes the zero filled array that counts get added into.
+    :param template_grid: The Grid of the template raster.
+    :param memmap_path: Optional path for a memory mapped file to hold the counts instead of RAM.
+    :return: Int32 numpy array (or memmap) shaped like the template.
+    '''
+    shape = (template_grid.rows, template_grid.cols)
+    if memmap_path:
+        return np.memmap(memmap_path, dtype=np.int32, mode='w+', shape=shape)
+    return np.zeros(shape, dtype=np.int32)
+
+
+def read_on_template(raster_path, template_grid, area_window=None):
+    '''
+    Reads the part of a single band raster that falls on the template (or on one window of it), untouched.
+    :param raster_path: The path to the raster.
+    :param template_grid: The Grid of the template raster.
+    :param area_window: Optional window on the template to limit the read to. Defaults to the whole template.
+    :return: The values, a boolean array of where they're NoData and the window on the template they belong in, or
+    (None, None, None) if the raster is outside the area.
+    '''
+    if area_window is None:
+        area_window = (0, 0, template_grid.cols, template_grid.rows)
+
+    window = raster_grid.window_in(raster_grid.get_grid(raster_path), template_grid)
+    on_template = raster_grid.intersect_windows(window, area_window)
+    if on_template is None:
+        return None, None, None
+
+    dataset = gdal.Open(raster_path)
+    band = dataset.GetRasterBand(1)
+    values = band.ReadAsArray(*raster_grid.relative_window(on_template, window))
+    no_data = band.GetNoDataValue()
+    instrument.add_bytes(read=values.nbytes)
+
+    invalid = np.isnan(values) if values.dtype.kind == 'f' else np.zeros(values.shape, dtype=bool)
+    if no_data is not None:
+        invalid |= values == no_data
+
+    band = None
+    dataset = None
+    return values, invalid, on_template
+
+
+def read_small_raster(raster_path, template_grid, area_window=None):
+    '''
+    Reads the part of a raster that falls on the template (or on one window of it). NoData becomes 0 so it doesn't
+    count for anything.
+    :param raster_path: The path to the raster.
+    :param template_grid: The Grid of the template raster.
+    :param area_window: Optional window on the template to limit the read to. Defaults to the whole template.
+    :return: Int32 array and the window on the template it belongs in, or (None, None) if it's outside the area.
+    '''
+    values, invalid, window = read_on_template(raster_path, template_grid, area_window)
+    if values is None:
+        return None, None
+
+    return np.where(invalid, 0, values).astype(np.int32), window
+
+
+def read_footprint(raster_path, template_grid, area_window=None):
+    '''
+    Array version of the footprint in top_runner.create_path_footprints. That polygonizes Con((raster == 0) |
+    (raster == 1), 1, 0), which gives polygons for the 0s as well as the 1s, so the footprint is every pixel that isn't
+    NoData.
+    :param raster_path: The path to a 0/1/NoData comparison raster.
+    :param template_grid: The Grid of the template raster.
+    :param area_window: Optional window on the template to limit the read to. Defaults to the whole template.
+    :return: Int32 array of 1s and 0s and the window on the template it belongs in, or (None, None).
+    '''
+    values, invalid, window = read_on_template(raster_path, template_grid, area_window)
+    if values is None:
+        return None, None
+
+    return (~invalid).astype(np.int32), window
+
+
+def add_raster(counts, template_grid, raster_path, sign=1):
+    '''
+    Adds a raster into the count array at its own offset. The rest of the array isn't touched.
+    :param counts: The count array from new_count_array.
+    :param template_grid: The Grid of the template raster.
+    :param raster_path: The path to the raster being added.
+    :param sign: 1 to add the raster, -1 to take it back out again.
+    :return:
+    '''
+    with instrument.stage('accumulate'):
+        values, window = read_small_raster(raster_path, template_grid)
+        if values is not None:
+            counts[raster_grid.window_slices(window)] += sign * values
+    return
+
+
+def load_counts(count_raster_path):
+    '''
+    Reads a count raster written by save_counts back into a count array so more can be added to it.
+    :param count_raster_path: The path to the count raster.
+    :return: Int32 numpy array.
+    '''
+    dataset = gdal.Open(count_raster_path)
+    counts = dataset.GetRasterBand(1).ReadAsArray().astype(np.int32)
+    dataset = None
+    return counts
+
+
+def write_count_tiles(out_band, counts, window):
+    '''
+    Writes the blocks of a count array that have a count in them. The rest are left out of the sparse GeoTIFF and read
+    back as 0.
+    :param out_band: The GDAL band to write to, covering the whole template.
+    :param counts: The count array for the window.
+    :param window: The window on the template the counts cover.
+    :return: How many bytes were written.
+    '''
+    written = 0
+    for tile in tiling.tile_windows(window, tiling.DEFAULT_BLOCK_SIZE):
+        values = counts[raster_grid.window_slices(raster_grid.relative_window(tile, window))]
+        if values.any():
+            out_band.WriteArray(values, tile[0], tile[1])
+            written += values.nbytes
+    return written
+
+
+def save_counts(counts, template_grid, final_raster_path):
+    '''
+    Writes the count array out at the full template extent. Only blocks with a count in them are written, see
+    write_count_tiles.
+    :param counts: The count array.
+    :param template_grid: The Grid of the template raster.
+    :param final_raster_path: Where the count raster goes.
+    :return:
+    '''
+    full_window = (0, 0, template_grid.cols, template_grid.rows)
+    with instrument.stage('accumulate'):
+        out_raster = raster_grid.create_raster(final_raster_path, template_grid, full_window, gdal.GDT_Int32)
+        written = write_count_tiles(out_raster.GetRasterBand(1), counts, full_window)
+        out_raster = None
+    instrument.add_bytes(written=written)
+    return
+
+
+def add_small_rasters_tiled(small_directory, template_raster_path, final_raster_path,
+                            memory_budget=tiling.DEFAULT_MEMORY_BUDGET):
+    '''
+    add_small_rasters for templates too big to hold in memory. The template is worked through one tile (a whole number
+    of its internal blocks) at a time and each tile only reads the pieces of the small rasters that fall in it. Tiles
+    that come out all 0 aren't written.
+    :param small_directory: The directory of rasters to sum.
+    :param template_raster_path: The template raster defining the output grid.
+    :param final_raster_path: Where the count raster goes.
+    :param memory_budget: Roughly how many bytes of arrays to hold at once.
+    :return:
+    '''
+    template_grid = raster_grid.get_grid(template_raster_path)
+    full_window = (0, 0, template_grid.cols, template_grid.rows)
+
+    # Only the grids are kept around, the pixels are read a tile at a time.
+    small_windows = [(image, raster_grid.window_in(raster_grid.get_grid(image), template_grid))
+                     for image in get_files_of_ext(small_directory, '.tif')]
+
+    out_raster = raster_grid.create_raster(final_raster_path, template_grid, full_window, gdal.GDT_Int32)
+    out_band = out_raster.GetRasterBand(1)
+
+    block_size = tiling.get_block_size(template_raster_path)
+    for tile in tiling.tile_windows(full_window, tiling.tile_shape(block_size, ADD_BYTES_PER_PIXEL, memory_budget, full_window[2])):
+        with instrument.stage('accumulate'):
+            counts = np.zeros((tile[3], tile[2]), dtype=np.int32)
+            for image, window in small_windows:
+                if raster_grid.intersect_windows(window, tile) is None:
+                    continue
+                values, values_window = read_small_raster(image, template_grid, tile)
+                counts[raster_grid.window_slices(raster_grid.relative_window(values_window, tile))] += values
+
+            if not counts.any():
+                continue  # Left out of the sparse GeoTIFF, reads back as 0.
+            out_band.WriteArray(counts, tile[0], tile[1])
+        instrument.add_bytes(written=counts.nbytes)
+
+    out_band = None
+    out_raster = None
+    return
+
+
+def percent_raster(true_count_path, int_count_path, per_raster_path, memory_budget=tiling.DEFAULT_MEMORY_BUDGET):
+    '''
+    The tile at a time version of Raster(true_count_path) * 1.0 / Raster(int_count_raster) * 1.0. Pixels with no
+    intersections come out as PERCENT_NODATA rather than a divide by zero, and tiles with none at all aren't written.
+    :param true_count_path: The true count raster from add_small_rasters.
+    :param int_count_path: The intersection count (path_counts) raster. Same grid as the true count.
+    :param per_raster_path: Where the Float32 percent raster goes.
+    :param memory_budget: Roughly how many bytes of arrays to hold at once.
+    :return:
+    '''
+    grid = raster_grid.get_grid(true_count_path)
+    full_window = (0, 0, grid.cols, grid.rows)
+
+    true_count = gdal.Open(true_count_path)
+    int_count = gdal.Open(int_count_path)
+    out_raster = raster_grid.create_raster(per_raster_path, grid, full_window, gdal.GDT_Float32, PERCENT_NODATA)
+    out_band = out_raster.GetRasterBand(1)
+
+    block_size = tiling.get_block_size(true_count_path)
+    for tile in tiling.tile_windows(full_window, tiling.tile_shape(block_size, PERCENT_BYTES_PER_PIXEL, memory_budget, grid.cols)):
+        with instrument.stage('percent'):
+            denominator = int_count.GetRasterBand(1).ReadAsArray(*tile).astype(np.float32)
+            if not denominator.any():
+                # No intersections at all, the block is left out and reads as PERCENT_NODATA.
+                instrument.add_bytes(read=denominator.nbytes)
+                continue
+            numerator = true_count.GetRasterBand(1).ReadAsArray(*tile).astype(np.float32)
+
+            percent = np.full(numerator.shape, PERCENT_NODATA, dtype=np.float32)
+            np.divide(numerator, denominator, out=percent, where=denominator > 0)
+            out_band.WriteArray(percent, tile[0], tile[1])
+        instrument.add_bytes(read=numerator.nbytes * 2, written=percent.nbytes)
+
+    out_band = None
+    out_raster = None
+    true_count = None
+    int_count = None
+    return
+
+
+def burn_footprints(image_paths, burn_raster_path, memory_budget=tiling.DEFAULT_MEMORY_BUDGET):
+    '''
+    Adds 1 to every pixel of the burn raster where an image has meaningful data, same as burning its polygon footprint
+    with ALL_TOUCHED and MERGE_ALG=ADD for images on the burn raster's grid. There's no polygon though, each image's
+    mask goes straight into the burn raster a tile at a time and only the tiles under the image are touched.
+    :param image_paths: List of 0/1/NoData comparison rasters.
+    :param burn_raster_path: The raster to add to. Usually the 0 constant template.
+    :param memory_budget: Roughly how many bytes of arrays to hold at once.
+    :return:
+    '''
+    template_grid = raster_grid.get_grid(burn_raster_path)
+    full_window = (0, 0, template_grid.cols, template_grid.rows)
+    block_size = tiling.get_block_size(burn_raster_path)
+
+    burn_raster = gdal.Open(burn_raster_path, GA_Update)
+    burn_band = burn_raster.GetRasterBand(1)
+
+    for image in image_paths:
+        image_window = raster_grid.intersect_windows(raster_grid.window_in(raster_grid.get_grid(image), template_grid), full_window)
+        if image_window is None:
+            continue
+
+        for tile in tiling.tile_windows(image_window, tiling.tile_shape(block_size, FOOTPRINT_BYTES_PER_PIXEL, memory_budget, image_window[2])):
+            with instrument.stage('accumulate'):
+                footprint, window = read_footprint(image, template_grid, tile)
+                current = burn_band.ReadAsArray(*window)
+                burn_band.WriteArray(current + footprint, window[0], window[1])
+            instrument.add_bytes(read=current.nbytes, written=current.nbytes)
+
+    burn_band = None
+    burn_raster = None
+    return
+
+
+def footprint_counts(image_paths, template_raster_path, partial_path=None):
+    '''
+    Counts image footprints into a fresh array rather than an existing raster. Meant for splitting the images between
+    workers, each one making a partial count that add_raster_list sums up afterwards.
+    :param image_paths: List of 0/1/NoData comparison rasters.
+    :param template_raster_path: The template raster defining the output grid.
+    :param partial_path: Optional path to save the partial count raster to.
+    :return: The Int32 count array.
+    '''
+    template_grid = raster_grid.get_grid(template_raster_path)
+    counts = new_count_array(template_grid)
+
+    for image in image_paths:
+        footprint, window = read_footprint(image, template_grid)
+        if footprint is not None:
+            counts[raster_grid.window_slices(window)] += footprint
+
+    if partial_path:
+        save_counts(counts, template_grid, partial_path)
+    return counts
+
+
+def create_path_footprints(image_directory, burn_raster_path, memory_budget=tiling.DEFAULT_MEMORY_BUDGET):
+    '''
+    Drop-in replacement for top_runner.create_path_footprints without the raster to polygon to raster round trip.
+    :param image_directory: The directory containing the raster images
+    :param burn_raster_path: The path to the 0 constant raster. Should be of an extent that contains all the paths.
+    :param memory_budget: Roughly how many bytes of arrays to hold at once.
+    :return:
+    '''
+    burn_footprints(get_files_of_ext(image_directory, '.tif'), burn_raster_path, memory_budget)
+    return
+
+
+def add_raster_list(image_paths, template_raster_path, final_raster_path, memmap_path=None):
+    '''
+    add_small_rasters for a list of rasters rather than a directory, e.g. the partial counts from footprint_counts.
+    :param image_paths: List of rasters to sum.
+    :param template_raster_path: The template raster defining the output grid.
+    :param final_raster_path: Where the count raster goes.
+    :param memmap_path: Optional path for a memory mapped count array. It's removed once the output is written.
+    :return:
+    '''
+    template_grid = raster_grid.get_grid(template_raster_path)
+    counts = new_count_array(template_grid, memmap_path)
+
+    for image in image_paths:
+        add_raster(counts, template_grid, image)
+
+    save_counts(counts, template_grid, final_raster_path)
+
+    counts = None
+    if memmap_path:
+        os.remove(memmap_path)
+    return
+
+
+def add_small_rasters(small_directory, template_raster_path, final_raster_path, memmap_path=None):
+    '''
+    Drop-in replacement for raster_adder.add_small_rasters. Sums every .tif in a directory onto the template grid with
+    NoData counting as 0. Memory use is one Int32 template sized array no matter how many rasters there are, and if
+    that's too much a memmap_path keeps it on disk instead.
+    :param small_directory: The directory of rasters to sum.
+    :param template_raster_path: The template raster defining the output grid.
+    :param final_raster_path: Where the count raster goes.
+    :param memmap_path: Optional path for a memory mapped count array. It's removed once the output is written.
+    :return:
+    '''
+    add_raster_list(get_files_of_ext(small_directory, '.tif'), template_raster_path, final_raster_path, memmap_path)
+    return
+
+
+def add_store_results(store_path, label, template_raster_path, final_raster_path, footprint=False, memmap_path=None):
+    '''
+    add_small_rasters for results kept in a pair_store rather than a directory of GeoTIFFs. The store is read front to
+    back once, nothing gets expanded to the template extent along the way.
+    :param store_path: The pair store directory.
+    :param label: Which results to sum, e.g. 'stdev'.
+    :param template_raster_path: The template raster the results were made on.
+    :param final_raster_path: Where the count raster goes.
+    :param footprint: Count where the results have data (the intersection count) instead of where they're 1.
+    :param memmap_path: Optional path for a memory mapped count array. It's removed once the output is written.
+    :return:
+    '''
+    template_grid = raster_grid.get_grid(template_raster_path)
+    counts = new_count_array(template_grid, memmap_path)
+
+    with instrument.stage('accumulate'):
+        pair_store.add_store(counts, store_path, label, footprint)
+
+    save_counts(counts, template_grid, final_raster_path)
+
+    counts = None
+    if memmap_path:
+        os.remove(memmap_path)
+    return
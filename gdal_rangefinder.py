@@ -0,0 +1,431 @@
+import numpy as np
+import gdal
+import raster_grid
+import tiling
+import band_cache
+import bsq_reader
+import instrument
+import pair_store
+import line_ingest
+
+gdal.UseExceptions()
+__author__ = 'Steve Kochaver'
+
+# GDAL/NumPy version of the comparisons in stdev_rangefinder. Same inputs, same 0/1/255 outputs, but everything
+# happens on arrays so there are no intermediate rasters, no polygons and no Spatial Analyst license.
+
+# Band positions in the five band .bsq files: Plus1.96, PlusStDev, Mean, MinusStDev, Minus1.96
+MEAN_BAND = 2
+
+# (lower, upper) band positions for each range we know how to check.
+RANGE_BANDS = {1: (3, 1),
+               1.96: (4, 0)}
+
+OUT_NODATA = 255
+
+# The fill values Ryan Sword's AVIRIS .bsq data uses outside the flight line, same as raster_clipper.custom_nodata.
+CUSTOM_NODATA = (2.1812543869018555,  # Plus 1.96
+                 1.8875709772109985,  # Plus StDev
+                 1.581650972366333,   # Mean
+                 1.2757309675216675,  # Minus StDev
+                 0.9820476770401001)  # Minus 1.96
+
+# Two five band float32 rasters plus the mask and an output tile, give or take.
+PAIR_BYTES_PER_PIXEL = 48
+
+
+class NoOverlap(RuntimeError):
+    # Two rasters with no data in common. Nothing went wrong, there's just nothing to compare. Still a RuntimeError so
+    # anything catching those keeps working, but it can be told apart from GDAL's own read and open failures.
+    pass
+
+
+def get_grid(raster_path):
+    '''
+    The Grid of a raster. ENVI files come straight from their .hdr, anything else goes through GDAL.
+    :param raster_path: The path to the raster.
+    :return: Grid namedtuple.
+    '''
+    if bsq_reader.header_path(raster_path):
+        return bsq_reader.get_grid(raster_path)
+    return raster_grid.get_grid(raster_path)
+
+
+def read_bands(raster_path, window=None):
+    '''
+    Reads all the bands of a five band raster into a single numpy array. ENVI files (our .bsq) are memory mapped by
+    bsq_reader instead, so the array is a view on the file rather than a copy.
+    :param raster_path: The path to the .bsq file.
+    :param window: Optional window tuple (xoff, yoff, cols, rows) in the raster's own pixels. Reads everything if None.
+    :return: Float32 numpy array shaped (bands, rows, cols).
+    '''
+    if bsq_reader.header_path(raster_path):
+        return bsq_reader.read_bands(raster_path, window)
+
+    dataset = gdal.Open(raster_path)
+    if window is None:
+        window = (0, 0, dataset.RasterXSize, dataset.RasterYSize)
+
+    bands = np.empty((dataset.RasterCount, window[3], window[2]), dtype=np.float32)
+    for i in range(dataset.RasterCount):
+        bands[i] = dataset.GetRasterBand(i + 1).ReadAsArray(*window)
+
+    dataset = None
+    return bands
+
+
+def remove_nodata(bands):
+    '''
+    Array version of stdev_rangefinder.remove_nodata. NoData pixels are the ones where every band is 0.
+    :param bands: Numpy array shaped (bands, rows, cols).
+    :return: Boolean array that is True where there is meaningful data.
+    '''
+    return (bands != 0).any(axis=0)
+
+
+def data_window(raster_path, raster_window):
+    '''
+    The part of a raster's window that its data is inside. Ingested lines know this from their sidecar, anything else
+    is taken to have data everywhere.
+    :param raster_path: The path to the raster.
+    :param raster_window: The raster's window on the reference grid.
+    :return: Window tuple on the reference grid, or None if the raster has no data at all.
+    '''
+    ingested, bounds = line_ingest.valid_bounds(raster_path)
+    if not ingested:
+        return raster_window
+    if bounds is None:
+        return None
+    return raster_window[0] + bounds[0], raster_window[1] + bounds[1], bounds[2], bounds[3]
+
+
+def pair_windows(raster_1_path, raster_2_path, template_raster_path=None):
+    '''
+    Works out where two rasters sit on the reference grid and where they overlap, without reading any pixels.
+    :param raster_1_path: The path to raster 1 (mean raster)
+    :param raster_2_path: The path to raster 2 (range raster)
+    :param template_raster_path: The grid to snap to. Raster 1's grid is used when not given.
+    :return: The reference Grid, raster 1's window, raster 2's window and their overlap window, all on that grid. The
+    overlap only covers where both have data when their data windows are known, see data_window.
+    '''
+    with instrument.stage('intersection'):
+        grid_1 = get_grid(raster_1_path)
+        grid_2 = get_grid(raster_2_path)
+        ref_grid = raster_grid.get_grid(template_raster_path) if template_raster_path else grid_1
+
+        window_1 = raster_grid.window_in(grid_1, ref_grid)
+        window_2 = raster_grid.window_in(grid_2, ref_grid)
+        data_1, data_2 = data_window(raster_1_path, window_1), data_window(raster_2_path, window_2)
+        overlap = raster_grid.intersect_windows(data_1, data_2) if data_1 and data_2 else None
+    if overlap is None:
+        raise NoOverlap('%s and %s do not overlap' % (raster_1_path, raster_2_path))
+
+    return ref_grid, window_1, window_2, overlap
+
+
+def valid_mask(raster_path, bands, window=None):
+    '''
+    Where a five band raster has meaningful data. Comes from the line's ingest sidecar when it has a current one,
+    otherwise it's remove_nodata on the bands.
+    :param raster_path: The path to the .bsq file.
+    :param bands: The bands read for the window.
+    :param window: The window the bands were read for, in the raster's own pixels. Everything if None.
+    :return: Boolean array.
+    '''
+    with instrument.stage('nodata_mask'):
+        mask = line_ingest.read_mask(raster_path, window)
+        if mask is None:
+            return remove_nodata(bands)
+    return mask
+
+
+def load_raster(raster_path):
+    '''
+    Reads a whole five band raster and works out where its meaningful data is. This is what band_cache holds on to.
+    :param raster_path: The path to the .bsq file.
+    :return: Tuple of (bands, valid mask).
+    '''
+    bands = read_bands(raster_path)
+    return bands, valid_mask(raster_path, bands)
+
+
+def read_window(raster_path, raster_window, window):
+    '''
+    The bands and valid-data mask for a window of the reference grid. Comes out of band_cache when it's enabled so a
+    flight line is only decoded once no matter how many pairs it's in.
+    :param raster_path: The path to the .bsq file.
+    :param raster_window: The raster's own window on the reference grid.
+    :param window: The window to read. Has to be inside the raster.
+    :return: Tuple of (bands, valid mask) for the window.
+    '''
+    local_window = raster_grid.relative_window(window, raster_window)
+
+    if band_cache.is_enabled():
+        with instrument.stage('load'):
+            bands, mask = band_cache.get(raster_path, load_raster)
+            slices = raster_grid.window_slices(local_window)
+            bands, mask = bands[(slice(None),) + slices], mask[slices]
+        instrument.add_bytes(read=bands.nbytes)
+        return bands, mask
+
+    with instrument.stage('load'):
+        bands = read_bands(raster_path, local_window)
+    instrument.add_bytes(read=bands.nbytes)
+    return bands, valid_mask(raster_path, bands, local_window)
+
+
+def read_mask_window(raster_path, raster_window, window):
+    '''
+    Only the valid-data mask for a window of the reference grid. Ingested lines give it from their sidecar without
+    touching the bands, anything else has its bands read through read_window.
+    :param raster_path: The path to the .bsq file.
+    :param raster_window: The raster's own window on the reference grid.
+    :param window: The window to read. Has to be inside the raster.
+    :return: Boolean array for the window.
+    '''
+    with instrument.stage('nodata_mask'):
+        mask = line_ingest.read_mask(raster_path, raster_grid.relative_window(window, raster_window))
+    if mask is None:
+        bands, mask = read_window(raster_path, raster_window, window)
+        return mask
+    instrument.add_bytes(read=mask.nbytes // 8)
+    return mask
+
+
+def load_pair(raster_1_path, raster_2_path, template_raster_path=None):
+    '''
+    Reads only the overlapping part of two five band rasters.
+    :param raster_1_path: The path to raster 1 (mean raster)
+    :param raster_2_path: The path to raster 2 (range raster)
+    :param template_raster_path: The grid to snap to. Raster 1's grid is used when not given.
+    :return: The reference Grid, the overlap window on that grid, the two band arrays for that window and the mask of
+    where they both have data.
+    '''
+    ref_grid, window_1, window_2, overlap = pair_windows(raster_1_path, raster_2_path, template_raster_path)
+    bands_1, bands_2, mask = read_pair_window(raster_1_path, raster_2_path, window_1, window_2, overlap)
+
+    return ref_grid, overlap, bands_1, bands_2, mask
+
+
+def read_pair_window(raster_1_path, raster_2_path, window_1, window_2, window):
+    '''
+    Reads the same piece of the reference grid out of both rasters.
+    :param raster_1_path: The path to raster 1.
+    :param raster_2_path: The path to raster 2.
+    :param window_1: Raster 1's window on the reference grid.
+    :param window_2: Raster 2's window on the reference grid.
+    :param window: The window to read. Has to be inside both rasters.
+    :return: The two band arrays and the mask of where they both have data.
+    '''
+    bands_1, mask_1 = read_window(raster_1_path, window_1, window)
+    bands_2, mask_2 = read_window(raster_2_path, window_2, window)
+    with instrument.stage('intersection'):
+        return bands_1, bands_2, mask_1 & mask_2
+
+
+def raster_intersection(bands_1, bands_2):
+    '''
+    Where both rasters have meaningful data.
+    :param bands_1: Band array of raster 1.
+    :param bands_2: Band array of raster 2, same window as raster 1.
+    :return: Boolean numpy array.
+    '''
+    return remove_nodata(bands_1) & remove_nodata(bands_2)
+
+
+def range_bounds(bands, sigma=1):
+    '''
+    The lower and upper bounds of a raster's sigma range. 1 and 1.96 come straight from their bands, any other sigma
+    (2.58 say) is built from the Mean and PlusStDev bands as Mean +/- sigma * StDev.
+    :param bands: Band array of the range raster.
+    :param sigma: How many standard deviations wide the range is.
+    :return: Tuple of (lower, upper) arrays.
+    '''
+    if sigma in RANGE_BANDS:
+        lower_band, upper_band = RANGE_BANDS[sigma]
+        return bands[lower_band], bands[upper_band]
+
+    mean = bands[MEAN_BAND]
+    stdev = bands[RANGE_BANDS[1][1]] - mean
+    return mean - sigma * stdev, mean + sigma * stdev
+
+
+def in_range(bands_1, bands_2, sigma=1):
+    '''
+    1 where the mean of raster 1 falls within the sigma range of raster 2, otherwise 0.
+    :param bands_1: Band array of raster 1 (mean raster).
+    :param bands_2: Band array of raster 2 (range raster).
+    :param sigma: How many standard deviations wide the range is, see range_bounds.
+    :return: Uint8 numpy array.
+    '''
+    with instrument.stage('compare'):
+        lower, upper = range_bounds(bands_2, sigma)
+
+        mean = bands_1[MEAN_BAND]
+        return ((mean >= lower) & (mean <= upper)).astype(np.uint8)
+
+
+def clip_to_mask(values, mask, window):
+    '''
+    Array version of Clip_management with ClippingGeometry. Sets everything outside the mask to OUT_NODATA and trims
+    the result down to the extent of the mask.
+    :param values: The uint8 array to clip.
+    :param mask: Boolean array, True where values are kept.
+    :param window: The window the arrays cover on the reference grid.
+    :return: The clipped array and its window on the reference grid.
+    '''
+    bounds = raster_grid.mask_bounds(mask)
+    if bounds is None:
+        raise NoOverlap('The rasters have no data in common')
+
+    slices = raster_grid.window_slices(bounds)
+    clipped = np.where(mask[slices], values[slices], OUT_NODATA).astype(np.uint8)
+    clipped_window = (window[0] + bounds[0], window[1] + bounds[1], bounds[2], bounds[3])
+
+    return clipped, clipped_window
+
+
+def check_range(raster_1_path, raster_2_path, con_raster_path, template_raster_path=None, sigma=1):
+    '''
+    Creates a binary raster from two five band rasters. If the mean of raster 1 falls within the sigma range of raster 2
+    a value of 1 (True) is given to the output raster, otherwise 0 (False). Pixels outside the data-full intersection of
+    the two rasters are 255 (NoData).
+    :param raster_1_path: The path to raster 1 (mean raster)
+    :param raster_2_path: The path to raster 2 (range raster)
+    :param con_raster_path: The location of the final conditional output.
+    :param template_raster_path: The raster to snap to.
+    :param sigma: 1 for the single standard deviation range or 1.96 for the 1.96 range.
+    :return:
+    '''
+    return check_ranges(raster_1_path, raster_2_path, {sigma: con_raster_path}, template_raster_path)
+
+
+def check_ranges(raster_1_path, raster_2_path, con_raster_paths, template_raster_path=None):
+    '''
+    Same as check_range but for as many ranges as you like. The pair is read and its intersection found once, then
+    every range is tested against it. Has the same signature as the check functions so pair_scheduler can run it.
+    :param raster_1_path: The path to raster 1 (mean raster)
+    :param raster_2_path: The path to raster 2 (range raster)
+    :param con_raster_paths: Dictionary of {sigma: output path}, e.g. {1: 'a.tif', 1.96: 'b.tif'}.
+    :param template_raster_path: The raster to snap to.
+    :return:
+    '''
+    ref_grid, window, bands_1, bands_2, mask = load_pair(raster_1_path, raster_2_path, template_raster_path)
+
+    for sigma, con_raster_path in con_raster_paths.items():
+        values = in_range(bands_1, bands_2, sigma)
+        with instrument.stage('clip_write'):
+            clipped, clipped_window = clip_to_mask(values, mask, window)
+            raster_grid.write_window(con_raster_path, clipped, ref_grid, clipped_window, gdal.GDT_Byte, OUT_NODATA)
+        instrument.add_bytes(written=clipped.nbytes)
+    return
+
+
+def store_ranges(raster_1_path, raster_2_path, store_target, template_raster_path=None):
+    '''
+    check_ranges writing into a pair_store instead of a GeoTIFF per range. Same signature as the check functions so
+    pair_scheduler can run it, with the output being where in the store the results go.
+    :param raster_1_path: The path to raster 1 (mean raster)
+    :param raster_2_path: The path to raster 2 (range raster)
+    :param store_target: Tuple of (store path, date 1, date 2, {sigma: label}, encoding).
+    :param template_raster_path: The raster to snap to. The stored windows are on its grid.
+    :return:
+    '''
+    store_path, date_1, date_2, labels, encoding = store_target
+    ref_grid, window, bands_1, bands_2, mask = load_pair(raster_1_path, raster_2_path, template_raster_path)
+
+    for sigma, label in labels.items():
+        values = in_range(bands_1, bands_2, sigma)
+        with instrument.stage('clip_write'):
+            clipped, clipped_window = clip_to_mask(values, mask, window)
+            pair_store.write_pair(store_path, date_1, date_2, label, clipped, clipped_window, encoding)
+        instrument.add_bytes(written=clipped.nbytes)
+    return
+
+
+def check_ranges_tiled(raster_1_path, raster_2_path, con_raster_paths, template_raster_path=None,
+                       memory_budget=tiling.DEFAULT_MEMORY_BUDGET):
+    '''
+    check_ranges for pairs too big to hold in memory. The overlap is worked through in tiles lined up with the
+    template's blocks. The first pass finds the extent of the intersection (so the outputs match the clipped ones) and
+    the second writes the outputs tile by tile.
+    :param raster_1_path: The path to raster 1 (mean raster)
+    :param raster_2_path: The path to raster 2 (range raster)
+    :param con_raster_paths: Dictionary of {sigma: output path}, e.g. {1: 'a.tif', 1.96: 'b.tif'}.
+    :param template_raster_path: The raster to snap to.
+    :param memory_budget: Roughly how many bytes of arrays to hold at once.
+    :return:
+    '''
+    ref_grid, window_1, window_2, overlap = pair_windows(raster_1_path, raster_2_path, template_raster_path)
+    block_size = tiling.get_block_size(template_raster_path or raster_1_path)
+    tiles = list(tiling.tile_windows(overlap, tiling.tile_shape(block_size, PAIR_BYTES_PER_PIXEL, memory_budget, overlap[2])))
+
+    bounds = None
+    for tile in tiles:
+        bands_1, bands_2, mask = read_pair_window(raster_1_path, raster_2_path, window_1, window_2, tile)
+        tile_bounds = raster_grid.mask_bounds(mask)
+        if tile_bounds is not None:
+            bounds = raster_grid.union_windows(bounds, (tile[0] + tile_bounds[0], tile[1] + tile_bounds[1],
+                                                        tile_bounds[2], tile_bounds[3]))
+    if bounds is None:
+        raise NoOverlap('The rasters have no data in common')
+
+    outputs = dict((sigma, raster_grid.create_raster(con_raster_path, ref_grid, bounds, gdal.GDT_Byte, OUT_NODATA))
+                   for sigma, con_raster_path in con_raster_paths.items())
+
+    for tile in tiles:
+        tile = raster_grid.intersect_windows(tile, bounds)
+        if tile is None:
+            continue
+
+        bands_1, bands_2, mask = read_pair_window(raster_1_path, raster_2_path, window_1, window_2, tile)
+        out_window = raster_grid.relative_window(tile, bounds)
+        for sigma, out_raster in outputs.items():
+            values = in_range(bands_1, bands_2, sigma)
+            with instrument.stage('clip_write'):
+                values = np.where(mask, values, OUT_NODATA).astype(np.uint8)
+                out_raster.GetRasterBand(1).WriteArray(values, out_window[0], out_window[1])
+            instrument.add_bytes(written=values.nbytes)
+
+    with instrument.stage('clip_write'):
+        outputs = None  # Flushes and closes them.
+    return
+
+
+def check_ranges_budgeted(raster_1_path, raster_2_path, budget_target, template_raster_path=None):
+    '''
+    check_ranges_tiled with the same signature as the check functions so pair_scheduler can run it, with the output
+    being the output paths and the budget together.
+    :param raster_1_path: The path to raster 1 (mean raster)
+    :param raster_2_path: The path to raster 2 (range raster)
+    :param budget_target: Tuple of ({sigma: output path}, memory budget in bytes).
+    :param template_raster_path: The raster to snap to.
+    :return:
+    '''
+    con_raster_paths, memory_budget = budget_target
+    check_ranges_tiled(raster_1_path, raster_2_path, con_raster_paths, template_raster_path, memory_budget)
+    return
+
+
+def check_stdev_range(raster_1_path, raster_2_path, con_raster_path, template_raster_path=None):
+    '''
+    Drop-in replacement for stdev_rangefinder.check_stdev_range using bands 2 and 4 as the range.
+    :param raster_1_path: The path to raster 1 (mean raster)
+    :param raster_2_path: The path to raster 2 (range raster)
+    :param con_raster_path: The location of the final conditional output.
+    :param template_raster_path: The raster to snap to.
+    :return:
+    '''
+    return check_range(raster_1_path, raster_2_path, con_raster_path, template_raster_path, 1)
+
+
+def check_196stdev_range(raster_1_path, raster_2_path, con_raster_path, template_raster_path=None):
+    '''
+    Drop-in replacement for stdev_rangefinder.check_196stdev_range using bands 1 and 5 as the range.
+    :param raster_1_path: The path to raster 1 (mean raster)
+    :param raster_2_path: The path to raster 2 (range raster)
+    :param con_raster_path: The location of the final conditional output.
+    :param template_raster_path: The raster to snap to.
+    :return:
+    '''
+    return check_range(raster_1_path, raster_2_path, con_raster_path, template_raster_path, 1.96)
@@ -0,0 +1,372 @@
+import os
+import time
+import json
+import fnmatch
+import threading
+import contextlib
+from line_names import pair_name
+
+__author__ = 'Steve Kochaver'
+
+# Where the time goes, what was read and written and what happened to every pair. Nothing is recorded until enable is
+# called, and stage() is a couple of attribute lookups when it isn't, so the hooks can stay in the pair code for good.
+#
+# Stage times are self times: a stage running inside another one is taken out of the outer stage's time rather than
+# counted twice. Anything a pair does is added to that pair's record, anything outside a pair (summing, percent) goes
+# into the run totals. Pair records are written as JSON lines as they finish, the run totals when the run is summarised.
+# The stage stack and the current pair belong to the thread, so a pair can be handed from one thread to another (see
+# detach_pair and attach_pair) as it goes through pair_pipeline.
+
+# The stages the code reports, in the order a run goes through them.
+STAGES = ['load', 'nodata_mask', 'intersection', 'compare', 'clip_write', 'accumulate', 'percent']
+
+_settings = None
+_log = None
+_local = threading.local()
+_totals_lock = threading.Lock()
+_totals = {}
+_records = []
+
+
+def enable(log_path=None, profile_pair=None, profile_dir=None, trace_memory=False):
+    '''
+    Starts recording in this process.
+    :param log_path: JSON lines file pair records and the run totals are appended to. None keeps them in memory only.
+    :param profile_pair: Pair name or fnmatch pattern of a pair to run under cProfile. Pairs go by line_names.pair_name
+    like everywhere else, e.g. '140612_03_TO_140708_05' or '140612_*_TO_*'.
+    :param profile_dir: Where the profile output goes. Defaults to the log's directory, or the working directory.
+    :param trace_memory: Also trace allocations with tracemalloc while the profiled pair runs, where there is one.
+    :return:
+    '''
+    global _settings, _log
+    disable()
+    if profile_dir is None:
+        profile_dir = os.path.dirname(os.path.abspath(log_path)) if log_path else os.getcwd()
+
+    _settings = {'log_path': log_path, 'profile_pair': profile_pair, 'profile_dir': profile_dir,
+                 'trace_memory': trace_memory}
+    if log_path:
+        _log = open(log_path, 'a')
+    return
+
+
+def settings():
+    '''
+    The arguments enable was called with, for handing to worker processes. None if recording is off.
+    :return: Dictionary or None.
+    '''
+    return dict(_settings) if _settings else None
+
+
+def enable_worker(worker_settings):
+    '''
+    Turns recording on in a worker process. Workers hand their pair records back to the main process rather than
+    writing the log themselves, so nothing is opened here.
+    :param worker_settings: Dictionary from settings().
+    :return:
+    '''
+    global _settings
+    _settings = dict(worker_settings, log_path=None)
+    return
+
+
+def disable():
+    global _settings, _log
+    if _log is not None:
+        _log.close()
+    _settings = None
+    _log = None
+    _local.pair = None
+    _local.stack = []
+    _totals.clear()
+    del _records[:]
+    return
+
+
+def is_enabled():
+    return _settings is not None
+
+
+def _new_totals():
+    return {'stages': {}, 'bytes_read': 0, 'bytes_written': 0}
+
+
+def _stack():
+    if getattr(_local, 'stack', None) is None:
+        _local.stack = []
+    return _local.stack
+
+
+def _current_pair():
+    return getattr(_local, 'pair', None)
+
+
+def _add_stage(totals, name, seconds):
+    stages = totals['stages']
+    previous, calls = stages.get(name, (0.0, 0))
+    stages[name] = (previous + seconds, calls + 1)
+    return
+
+
+def _add_to_current(func, *args):
+    # A pair is only ever worked on by one thread at a time, the run totals can be added to by any of them.
+    pair = _current_pair()
+    if pair is not None:
+        return func(pair, *args)
+    with _totals_lock:
+        if not _totals:
+            _totals.update(_new_totals())
+        return func(_totals, *args)
+
+
+@contextlib.contextmanager
+def stage(name):
+    '''
+    Times a block of code as one of the STAGES.
+    :param name: The stage name.
+    :return:
+    '''
+    if _settings is None:
+        yield
+        return
+
+    stack = _stack()
+    entry = [time.time(), 0.0]
+    stack.append(entry)
+    try:
+        yield
+    finally:
+        stack.pop()
+        elapsed = time.time() - entry[0]
+        if stack:
+            stack[-1][1] += elapsed
+        _add_to_current(_add_stage, name, elapsed - entry[1])
+    return
+
+
+def _add_bytes(totals, read, written):
+    totals['bytes_read'] += read
+    totals['bytes_written'] += written
+    return
+
+
+def add_bytes(read=0, written=0):
+    '''
+    Counts bytes of raster data read or written. These are array sizes, i.e. what the code asked for, not what a
+    compressed file took on disk.
+    :param read: Bytes read.
+    :param written: Bytes written.
+    :return:
+    '''
+    if _settings is None:
+        return
+    _add_to_current(_add_bytes, read, written)
+    return
+
+
+def start_pair(raster_file, compare_file):
+    '''
+    Starts the record for a pair. Stages and bytes go into it until finish_pair.
+    :param raster_file: The path to raster 1.
+    :param compare_file: The path to raster 2.
+    :return:
+    '''
+    if _settings is None:
+        return
+    _local.pair = dict(_new_totals(), pair=pair_name(raster_file, compare_file), raster_file=raster_file,
+                       compare_file=compare_file, pid=os.getpid(), start=time.time())
+    return
+
+
+def detach_pair():
+    '''
+    Takes the current pair's unfinished record away from this thread, so another thread can carry on with it.
+    :return: The record, or None if recording is off.
+    '''
+    record = _current_pair()
+    _local.pair = None
+    return record
+
+
+def attach_pair(record):
+    '''
+    Makes a record from detach_pair the current pair of this thread.
+    :param record: The record. None is ignored.
+    :return:
+    '''
+    if _settings is not None and record is not None:
+        _local.pair = record
+    return
+
+
+def finish_pair(error=None):
+    '''
+    Closes the current pair's record.
+    :param error: The error message if the pair failed.
+    :return: The record dictionary, or None if recording is off.
+    '''
+    record = _current_pair()
+    if _settings is None or record is None:
+        return None
+
+    _local.pair = None
+    record['seconds'] = time.time() - record.pop('start')
+    record['outcome'] = 'failed' if error else 'ok'
+    record['reason'] = error
+    record['stages'] = dict((name, seconds) for name, (seconds, calls) in record['stages'].items())
+    return record
+
+
+def _write(entry):
+    if _log is not None:
+        _log.write(json.dumps(entry, sort_keys=True) + '\n')
+        _log.flush()
+    return
+
+
+def log_pair(record):
+    '''
+    Keeps a finished pair record and writes it to the log. Called in the main process with what the workers hand back.
+    :param record: Dictionary from finish_pair. None is ignored.
+    :return:
+    '''
+    if _settings is None or record is None:
+        return
+    record = dict(record, type='pair')
+    _records.append(record)
+    _write(record)
+    return
+
+
+def skip_pair(raster_file, compare_file, reason):
+    '''
+    Records a pair that was never run, e.g. because its footprints can't overlap or its outputs are still current.
+    :param raster_file: The path to raster 1.
+    :param compare_file: The path to raster 2.
+    :param reason: Why it was skipped.
+    :return:
+    '''
+    if _settings is None:
+        return
+    log_pair({'pair': pair_name(raster_file, compare_file), 'raster_file': raster_file, 'compare_file': compare_file,
+              'outcome': 'skipped', 'reason': reason, 'seconds': 0.0, 'stages': {}, 'bytes_read': 0,
+              'bytes_written': 0})
+    return
+
+
+@contextlib.contextmanager
+def profiled(raster_file, compare_file):
+    '''
+    Runs a block under cProfile (and tracemalloc if asked for) when the pair matches profile_pair. The stats go to
+    <pair name>.prof and <pair name>.tracemalloc.txt in the profile directory.
+    :param raster_file: The path to raster 1.
+    :param compare_file: The path to raster 2.
+    :return:
+    '''
+    name = pair_name(raster_file, compare_file)
+    if _settings is None or not _settings['profile_pair'] or not fnmatch.fnmatch(name, _settings['profile_pair']):
+        yield
+        return
+
+    import cProfile
+    tracemalloc = None
+    if _settings['trace_memory']:
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None  # Python 2 doesn't have it.
+
+    profile_base = os.path.join(_settings['profile_dir'], name)
+    profiler = cProfile.Profile()
+    if tracemalloc is not None:
+        tracemalloc.start(10)
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_base + '.prof')
+
+        if tracemalloc is not None:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(profile_base + '.tracemalloc.txt', 'w') as f:
+                f.write('peak traced bytes: %d\n' % peak)
+                for statistic in snapshot.statistics('lineno')[:25]:
+                    f.write('%s\n' % statistic)
+            if _current_pair() is not None:
+                _current_pair()['peak_traced_bytes'] = peak
+    return
+
+
+def summary():
+    '''
+    Adds up everything recorded so far in this process.
+    :return: Dictionary of pair outcome counts, failure and skip reasons, and {stage: [seconds, calls]} totals for the
+    pairs and for the rest of the run, plus bytes read and written.
+    '''
+    result = {'outcomes': {}, 'reasons': {}, 'pair_stages': {}, 'run_stages': {}, 'bytes_read': 0, 'bytes_written': 0,
+              'pair_seconds': 0.0}
+
+    for record in _records:
+        outcome = record['outcome']
+        result['outcomes'][outcome] = result['outcomes'].get(outcome, 0) + 1
+        if record['reason']:
+            key = '%s: %s' % (outcome, record['reason'])
+            result['reasons'][key] = result['reasons'].get(key, 0) + 1
+
+        result['pair_seconds'] += record['seconds']
+        result['bytes_read'] += record['bytes_read']
+        result['bytes_written'] += record['bytes_written']
+        for name, seconds in record['stages'].items():
+            total = result['pair_stages'].setdefault(name, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+
+    if _totals:
+        result['bytes_read'] += _totals['bytes_read']
+        result['bytes_written'] += _totals['bytes_written']
+        for name, (seconds, calls) in _totals['stages'].items():
+            result['run_stages'][name] = [seconds, calls]
+
+    return result
+
+
+def write_summary():
+    '''
+    Writes the run totals to the log as a 'summary' line and prints the summary table.
+    :return: The summary dictionary.
+    '''
+    if _settings is None:
+        return None
+
+    result = summary()
+    _write(dict(result, type='summary'))
+    print(format_summary(result))
+    return result
+
+
+def _stage_order(names):
+    return sorted(names, key=lambda name: (STAGES.index(name) if name in STAGES else len(STAGES), name))
+
+
+def format_summary(result):
+    '''
+    The summary as a table.
+    :param result: Dictionary from summary().
+    :return: String.
+    '''
+    lines = ['pairs: ' + (', '.join('%d %s' % (count, outcome) for outcome, count in sorted(result['outcomes'].items()))
+                          or 'none')]
+    for reason, count in sorted(result['reasons'].items(), key=lambda item: -item[1]):
+        lines.append('  %5d  %s' % (count, reason))
+
+    lines.append('%-14s %-6s %10s %8s' % ('stage', 'where', 'seconds', 'count'))
+    for where, stages in [('pairs', result['pair_stages']), ('run', result['run_stages'])]:
+        for name in _stage_order(stages):
+            seconds, count = stages[name]
+            lines.append('%-14s %-6s %10.3f %8d' % (name, where, seconds, count))
+
+    lines.append('read %.1f MB, wrote %.1f MB' % (result['bytes_read'] / 1024.0 ** 2, result['bytes_written'] / 1024.0 ** 2))
+    return '\n'.join(lines)
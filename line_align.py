@@ -0,0 +1,212 @@
+import os
+import math
+import gdal
+import raster_grid
+import bsq_reader
+import manifest
+import line_ingest
+
+gdal.UseExceptions()
+__author__ = 'Steve Kochaver'
+
+# Puts every flight line on the template grid once, up front, so nothing later has to snap or resample. A line that's
+# already on the grid (same cell size, whole pixel offset) is left where it is and only recorded as on the grid. Any
+# other line is warped with gdal.Warp onto the template's cells, nearest neighbour so the five bands of a pixel (and
+# the NoData signatures) stay exactly as they were, and the copy goes in the line's ingest directory under the line's
+# own file name so pair names don't change:
+#
+#   f140612t01p00r03.ingest/f140612t01p00r03.bsq    the aligned copy, ENVI like the original
+#   f140612t01p00r03.ingest/aligned.json            the line's stamp, the template grid and which file to use
+#
+# The analyses pick the aligned copies up through aligned_paths. A record for a changed line or a different template
+# is ignored and the original line is used.
+
+RECORD_NAME = 'aligned.json'
+
+# How far from a whole pixel a line's offset can be and still count as on the grid, as a fraction of a cell.
+OFFSET_TOLERANCE = 1e-3
+
+# Records looked at so far, keyed by (line path, line stamp).
+_records = {}
+
+
+def record_path(raster_path):
+    return os.path.join(line_ingest.ingest_directory(raster_path), RECORD_NAME)
+
+
+def grid_record(grid):
+    return {'geotransform': list(grid.geotransform), 'projection': grid.projection, 'cols': grid.cols, 'rows': grid.rows}
+
+
+def on_grid(grid, template_grid):
+    '''
+    Whether a raster's pixels already line up with the template's.
+    :param grid: The raster's Grid.
+    :param template_grid: The template Grid.
+    :return: Boolean.
+    '''
+    gt, ref_gt = grid.geotransform, template_grid.geotransform
+    if gt[2] or gt[4]:
+        return False
+    if grid.projection and template_grid.projection and grid.projection != template_grid.projection:
+        return False
+    if (abs(gt[1] - ref_gt[1]) > raster_grid.CELL_TOLERANCE * abs(ref_gt[1]) or
+            abs(gt[5] - ref_gt[5]) > raster_grid.CELL_TOLERANCE * abs(ref_gt[5])):
+        return False
+
+    x_offset = (gt[0] - ref_gt[0]) / ref_gt[1]
+    y_offset = (gt[3] - ref_gt[3]) / ref_gt[5]
+    return abs(x_offset - round(x_offset)) <= OFFSET_TOLERANCE and abs(y_offset - round(y_offset)) <= OFFSET_TOLERANCE
+
+
+def snapped_window(grid, template_grid):
+    '''
+    The smallest window of template cells that covers a raster, whatever its grid.
+    :param grid: The raster's Grid. Assumed to be in the template's projection already.
+    :param template_grid: The template Grid.
+    :return: Window tuple (xoff, yoff, cols, rows) on the template grid.
+    '''
+    gt, ref_gt = grid.geotransform, template_grid.geotransform
+    xs = [(x - ref_gt[0]) / ref_gt[1] for x in (gt[0], gt[0] + grid.cols * gt[1])]
+    ys = [(y - ref_gt[3]) / ref_gt[5] for y in (gt[3], gt[3] + grid.rows * gt[5])]
+
+    # Edges within OFFSET_TOLERANCE of a cell boundary don't pull in a whole extra row or column.
+    x_min = int(math.floor(min(xs) + OFFSET_TOLERANCE))
+    y_min = int(math.floor(min(ys) + OFFSET_TOLERANCE))
+    x_max = int(math.ceil(max(xs) - OFFSET_TOLERANCE))
+    y_max = int(math.ceil(max(ys) - OFFSET_TOLERANCE))
+    return x_min, y_min, x_max - x_min, y_max - y_min
+
+
+def aligned_signatures(signatures):
+    '''
+    The NoData signatures for a warped copy: the line's own plus the zero signature, since everything the warp doesn't
+    land on is filled with 0. A line ingested with only 'custom' would otherwise have that margin counted as data.
+    :param signatures: The line's NoData signature names.
+    :return: List of signature names.
+    '''
+    signatures = list(signatures)
+    if 'zero' not in signatures:
+        signatures.append('zero')
+    return signatures
+
+
+def aligned_copy(raster_path):
+    '''
+    A line's warped copy, whichever template it was warped to.
+    :param raster_path: The path to the .bsq file.
+    :return: The copy's path, or None if the line has no current warped copy.
+    '''
+    path = record_path(raster_path)
+    if not os.path.exists(path):
+        return None
+    record = manifest.load_manifest(path)
+    if record.get('stamp') != line_ingest.line_stamp(raster_path) or not record['warped'] or not os.path.exists(record['path']):
+        return None
+    return record['path']
+
+
+def align_line(raster_path, template_raster_path, resample='near', num_threads='ALL_CPUS'):
+    '''
+    Puts one line on the template grid and records where it went.
+    :param raster_path: The path to the .bsq file.
+    :param template_raster_path: The template raster.
+    :param resample: gdal.Warp resampling for lines that need warping. Leave it at 'near' unless you know the NoData
+    signatures can't get blended into the data.
+    :param num_threads: Threads gdal.Warp can use, passed through as its NUM_THREADS warp option.
+    :return: The record dictionary.
+    '''
+    template_grid = raster_grid.get_grid(template_raster_path)
+    grid = bsq_reader.get_grid(raster_path) if bsq_reader.header_path(raster_path) else raster_grid.get_grid(raster_path)
+
+    out_directory = line_ingest.ingest_directory(raster_path)
+    if not os.path.exists(out_directory):
+        os.makedirs(out_directory)
+
+    if on_grid(grid, template_grid):
+        path = raster_path
+    else:
+        path = os.path.join(out_directory, os.path.basename(raster_path))
+        window = snapped_window(grid, template_grid)
+        ref_gt = template_grid.geotransform
+        x_1, x_2 = ref_gt[0] + window[0] * ref_gt[1], ref_gt[0] + (window[0] + window[2]) * ref_gt[1]
+        y_1, y_2 = ref_gt[3] + window[1] * ref_gt[5], ref_gt[3] + (window[1] + window[3]) * ref_gt[5]
+
+        # Everything the warp doesn't land on starts out as 0 in every band, i.e. the zero NoData signature.
+        gdal.Warp(path, raster_path, format='ENVI', outputBounds=(min(x_1, x_2), min(y_1, y_2), max(x_1, x_2), max(y_1, y_2)),
+                  xRes=abs(ref_gt[1]), yRes=abs(ref_gt[5]), dstSRS=template_grid.projection or None,
+                  resampleAlg=resample, multithread=True, creationOptions=['INTERLEAVE=BSQ'],
+                  warpOptions=['NUM_THREADS=%s' % num_threads, 'INIT_DEST=0'])
+
+        # A line ingested with other NoData signatures keeps them for its aligned copy, along with the zero fill.
+        info = line_ingest.read_info(raster_path)
+        if info is not None:
+            line_ingest.ingest_line(path, aligned_signatures(info['signatures']), info['tolerance'], ())
+
+    record = {'stamp': line_ingest.line_stamp(raster_path),
+              'template': grid_record(template_grid),
+              'path': path,
+              'warped': path != raster_path}
+    manifest.save_manifest(record, record_path(raster_path))
+    return record
+
+
+def read_record(raster_path, template_grid):
+    '''
+    A line's alignment record, if it's for this version of the line and this template.
+    :param raster_path: The path to the .bsq file.
+    :param template_grid: The template Grid.
+    :return: Dictionary or None.
+    '''
+    path = record_path(raster_path)
+    if not os.path.exists(path):
+        return None
+
+    key = (os.path.abspath(raster_path), tuple(line_ingest.line_stamp(raster_path)))
+    if key not in _records:
+        record = manifest.load_manifest(path)
+        if record.get('stamp') != list(key[1]):
+            return None
+        _records[key] = record
+
+    record = _records[key]
+    if record['template'] != grid_record(template_grid) or not os.path.exists(record['path']):
+        return None
+    return record
+
+
+def align_lines(line_paths, template_raster_path, resample='near', num_threads='ALL_CPUS', force=False):
+    '''
+    align_line for every line without a current record.
+    :param line_paths: List of .bsq paths.
+    :param template_raster_path: The template raster.
+    :param resample: gdal.Warp resampling, see align_line.
+    :param num_threads: Threads gdal.Warp can use.
+    :param force: Align every line again regardless.
+    :return: List of the paths that were aligned.
+    '''
+    template_grid = raster_grid.get_grid(template_raster_path)
+    aligned = []
+    for path in line_paths:
+        if not force and read_record(path, template_grid) is not None:
+            continue
+        print('aligning ' + path)
+        align_line(path, template_raster_path, resample, num_threads)
+        aligned.append(path)
+    return aligned
+
+
+def aligned_paths(line_paths, template_raster_path):
+    '''
+    The files to analyse for a list of lines: the aligned copy where a line has one for this template, otherwise the
+    line itself.
+    :param line_paths: List of .bsq paths.
+    :param template_raster_path: The template raster.
+    :return: List of paths in the same order.
+    '''
+    template_grid = raster_grid.get_grid(template_raster_path)
+    paths = []
+    for path in line_paths:
+        record = read_record(path, template_grid)
+        paths.append(record['path'] if record is not None else path)
+    return paths
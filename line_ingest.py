@@ -0,0 +1,351 @@
+import os
+import numpy as np
+import raster_grid
+import bsq_reader
+import manifest
+from raster_grid import Grid
+
+__author__ = 'Steve Kochaver'
+
+# One time pass over each flight line that works out where its meaningful data is and keeps the answer next to it, so
+# nothing downstream has to look at all five float bands just to find the NoData. For f140612t01p00r03.bsq it makes
+#
+#   f140612t01p00r03.ingest/valid.bits        the valid-data mask, one bit per pixel, each row packed on its own
+#   f140612t01p00r03.ingest/ingest.json       the mask's shape, the window its data is inside, how NoData was found,
+#                                             the template the overviews were lined up with, and the line's size and
+#                                             mtime when it was ingested
+#   f140612t01p00r03.ingest/overview_4.bsq    the five bands averaged over 4 x 4 blocks of valid pixels (and 16 x 16,
+#                                             ...), 0 in every band where a block has no data, for quick looks
+#
+# A directory rather than files beside the .bsq so nothing here is ever mistaken for a flight line or its .hdr.
+# Sidecars whose line has changed since are ignored, callers just work the mask out from the bands as before.
+
+INGEST_EXT = '.ingest'
+MASK_NAME = 'valid.bits'
+INFO_NAME = 'ingest.json'
+
+# The NoData signatures the lines can have, one value per band (Plus1.96, PlusStDev, Mean, MinusStDev, Minus1.96).
+# 'custom' is the fill Ryan Sword's AVIRIS data uses, same as raster_clipper.custom_nodata.
+NODATA_SIGNATURES = {'zero': (0.0, 0.0, 0.0, 0.0, 0.0),
+                     'custom': (2.1812543869018555, 1.8875709772109985, 1.581650972366333, 1.2757309675216675,
+                                0.9820476770401001)}
+
+DEFAULT_SIGNATURES = ('zero',)
+DEFAULT_OVERVIEWS = (4, 16)
+
+# Rows of a line read at once while ingesting.
+STRIP_ROWS = 512
+
+# ingest.json of every sidecar looked at, keyed by (line path, line stamp).
+_infos = {}
+
+
+def ingest_directory(raster_path):
+    return os.path.splitext(raster_path)[0] + INGEST_EXT
+
+
+def overview_path(raster_path, factor):
+    return os.path.join(ingest_directory(raster_path), 'overview_%d.bsq' % factor)
+
+
+def line_stamp(raster_path):
+    '''
+    The line's size and mtime, and its header's, so a sidecar can tell when it's out of date.
+    :param raster_path: The path to the .bsq file.
+    :return: List of numbers.
+    '''
+    stamp = manifest.file_stamp(raster_path)
+    header_path = bsq_reader.header_path(raster_path)
+    if header_path:
+        stamp += manifest.file_stamp(header_path)
+    return stamp
+
+
+def template_record(template_raster_path):
+    '''
+    What ingest.json remembers about the template the overview blocks were lined up with.
+    :param template_raster_path: The template raster, or None.
+    :return: Dictionary, or None if there's no template.
+    '''
+    if not template_raster_path:
+        return None
+    grid = raster_grid.get_grid(template_raster_path)
+    return {'geotransform': list(grid.geotransform), 'projection': grid.projection, 'cols': grid.cols, 'rows': grid.rows}
+
+
+def signature_mask(bands, signatures=DEFAULT_SIGNATURES, tolerance=0.0):
+    '''
+    Where a five band raster has meaningful data. A pixel is NoData when every band is within tolerance of one of the
+    signatures. With the defaults it's the same as gdal_rangefinder.remove_nodata.
+    :param bands: Numpy array shaped (bands, rows, cols).
+    :param signatures: Names from NODATA_SIGNATURES.
+    :param tolerance: How far a band can be from the signature value and still match it.
+    :return: Boolean array that is True where there is meaningful data.
+    '''
+    valid = np.ones(bands.shape[1:], dtype=bool)
+    for name in signatures:
+        signature = NODATA_SIGNATURES[name]
+        matches = np.ones(bands.shape[1:], dtype=bool)
+        for band, value in zip(bands, signature):
+            if tolerance:
+                matches &= np.abs(band - np.float32(value)) <= tolerance
+            else:
+                matches &= band == np.float32(value)
+        valid &= ~matches
+    return valid
+
+
+def block_average(bands, valid, factor):
+    '''
+    Averages the valid pixels of every factor x factor block. Blocks with no valid pixels come out as 0 in every band.
+    :param bands: Numpy array shaped (bands, rows, cols), rows and cols whole multiples of factor.
+    :param valid: Boolean array shaped (rows, cols).
+    :param factor: The block size.
+    :return: Float32 array shaped (bands, rows / factor, cols / factor).
+    '''
+    rows, cols = valid.shape[0] // factor, valid.shape[1] // factor
+    counts = valid.reshape(rows, factor, cols, factor).sum(axis=(1, 3))
+
+    averaged = np.zeros((bands.shape[0], rows, cols), dtype=np.float32)
+    for i, band in enumerate(bands):
+        sums = np.where(valid, band, 0).reshape(rows, factor, cols, factor).sum(axis=(1, 3), dtype=np.float64)
+        np.divide(sums, counts, out=averaged[i], where=counts > 0, casting='unsafe')
+    return averaged
+
+
+def write_mask(raster_path, bands, signatures, tolerance):
+    '''
+    Works out a line's valid-data mask a strip at a time and writes it packed to the sidecar directory.
+    :param raster_path: The path to the .bsq file.
+    :param bands: The line's bands from bsq_reader.open_bands.
+    :param signatures: NoData signature names, see signature_mask.
+    :param tolerance: How close to a signature counts as NoData.
+    :return: The window (xoff, yoff, cols, rows) in the line's own pixels that all its data is inside, or None if it
+    has none.
+    '''
+    rows, cols = bands.shape[1:]
+    valid_rows = np.zeros(rows, dtype=bool)
+    valid_cols = np.zeros(cols, dtype=bool)
+
+    mask_path = os.path.join(ingest_directory(raster_path), MASK_NAME)
+    temp_path = mask_path + '.%d.tmp' % os.getpid()
+    with open(temp_path, 'wb') as f:
+        for start in range(0, rows, STRIP_ROWS):
+            valid = signature_mask(np.asarray(bands[:, start:start + STRIP_ROWS], dtype=np.float32), signatures, tolerance)
+            np.packbits(valid, axis=1).tofile(f)
+            valid_rows[start:start + STRIP_ROWS] = valid.any(axis=1)
+            valid_cols |= valid.any(axis=0)
+
+    if os.path.exists(mask_path):
+        os.remove(mask_path)
+    os.rename(temp_path, mask_path)
+
+    if not valid_rows.any():
+        return None
+    row_indices = np.flatnonzero(valid_rows)
+    col_indices = np.flatnonzero(valid_cols)
+    return (int(col_indices[0]), int(row_indices[0]), int(col_indices[-1] - col_indices[0] + 1),
+            int(row_indices[-1] - row_indices[0] + 1))
+
+
+def unpack_mask(packed, shape, window=None):
+    '''
+    A window of a packed mask.
+    :param packed: Uint8 array (or memmap) shaped (rows, packed bytes per row).
+    :param shape: (rows, cols) of the whole mask.
+    :param window: Optional window tuple (xoff, yoff, cols, rows) in the line's own pixels. Everything if None.
+    :return: Boolean array.
+    '''
+    if window is None:
+        window = (0, 0, shape[1], shape[0])
+    first_byte, last_byte = window[0] // 8, -(-(window[0] + window[2]) // 8)
+
+    bits = np.unpackbits(packed[window[1]:window[1] + window[3], first_byte:last_byte], axis=1)
+    start = window[0] - first_byte * 8
+    return bits[:, start:start + window[2]].astype(bool)
+
+
+def overview_grid(grid, factor, pad):
+    '''
+    The Grid of a line's overview.
+    :param grid: The line's Grid.
+    :param factor: The overview block size.
+    :param pad: (left, top) pixels of padding before the line's first pixel in the first block.
+    :return: Grid namedtuple.
+    '''
+    gt = grid.geotransform
+    geotransform = (gt[0] - pad[0] * gt[1], gt[1] * factor, 0.0, gt[3] - pad[1] * gt[5], 0.0, gt[5] * factor)
+    return Grid(geotransform, grid.projection, -(-(grid.cols + pad[0]) // factor), -(-(grid.rows + pad[1]) // factor))
+
+
+def write_overview(raster_path, bands, grid, band_names, factor, pad):
+    '''
+    Writes one overview of a line from its bands and the mask write_mask already made.
+    :param raster_path: The path to the .bsq file.
+    :param bands: The line's bands from bsq_reader.open_bands.
+    :param grid: The line's Grid.
+    :param band_names: The line's band names.
+    :param factor: The overview block size.
+    :param pad: (left, top) pixels of padding before the line's first pixel in the first block.
+    :return:
+    '''
+    band_count, rows, cols = bands.shape
+    out_grid = overview_grid(grid, factor, pad)
+    packed = read_packed(raster_path, rows, cols)
+    overview = np.zeros((band_count, out_grid.rows, out_grid.cols), dtype=np.float32)
+
+    strip_blocks = max(1, STRIP_ROWS // factor)
+    for first_block in range(0, out_grid.rows, strip_blocks):
+        block_rows = min(strip_blocks, out_grid.rows - first_block)
+        # The strip in padded pixels, then the part of it the line actually covers.
+        top = first_block * factor - pad[1]
+        line_top, line_bottom = max(top, 0), min(top + block_rows * factor, rows)
+
+        strip = np.zeros((band_count, block_rows * factor, out_grid.cols * factor), dtype=np.float32)
+        valid = np.zeros(strip.shape[1:], dtype=bool)
+        strip[:, line_top - top:line_bottom - top, pad[0]:pad[0] + cols] = bands[:, line_top:line_bottom]
+        valid[line_top - top:line_bottom - top, pad[0]:pad[0] + cols] = unpack_mask(
+            packed, (rows, cols), (0, line_top, cols, line_bottom - line_top))
+
+        overview[:, first_block:first_block + block_rows] = block_average(strip, valid, factor)
+
+    bsq_reader.write_bands(overview_path(raster_path, factor), overview, out_grid, band_names)
+    return
+
+
+def ingest_line(raster_path, signatures=DEFAULT_SIGNATURES, tolerance=0.0, overviews=DEFAULT_OVERVIEWS,
+                template_raster_path=None):
+    '''
+    Writes the sidecars for one flight line.
+    :param raster_path: The path to the .bsq file.
+    :param signatures: NoData signature names, see signature_mask.
+    :param tolerance: How close to a signature counts as NoData.
+    :param overviews: Overview block sizes.
+    :param template_raster_path: Optional template. Overview blocks are lined up with whole blocks of the template so
+    the overviews of different lines all sit on the same coarse grid.
+    :return: The ingest.json dictionary.
+    '''
+    unknown = [name for name in signatures if name not in NODATA_SIGNATURES]
+    if unknown:
+        raise ValueError('Unknown NoData signature(s) %s' % ', '.join(unknown))
+
+    bands, grid, band_names = bsq_reader.open_bands(raster_path)
+    if not os.path.exists(ingest_directory(raster_path)):
+        os.makedirs(ingest_directory(raster_path))
+
+    bounds = write_mask(raster_path, bands, signatures, tolerance)
+
+    # Padding that puts the line's first pixel in the right place in its first overview block.
+    window = (0, 0)
+    if template_raster_path:
+        window = raster_grid.window_in(grid, raster_grid.get_grid(template_raster_path))
+    for factor in overviews:
+        write_overview(raster_path, bands, grid, band_names, factor, (window[0] % factor, window[1] % factor))
+
+    info = {'stamp': line_stamp(raster_path),
+            'shape': [grid.rows, grid.cols],
+            'bounds': list(bounds) if bounds else None,
+            'signatures': list(signatures),
+            'tolerance': tolerance,
+            'overviews': list(overviews),
+            'template': template_record(template_raster_path)}
+    manifest.save_manifest(info, os.path.join(ingest_directory(raster_path), INFO_NAME))
+    _infos[(os.path.abspath(raster_path), tuple(info['stamp']))] = info
+    return info
+
+
+def is_current(info, signatures, tolerance, overviews, template=None):
+    '''
+    Whether a line's sidecars were made the way they're wanted now.
+    :param info: The line's ingest.json from read_info, or None.
+    :param signatures: NoData signature names.
+    :param tolerance: How close to a signature counts as NoData.
+    :param overviews: Overview block sizes.
+    :param template: template_record of the template the overviews should line up with.
+    :return: Boolean.
+    '''
+    return (info is not None and info['signatures'] == list(signatures) and info['tolerance'] == tolerance and
+            info['overviews'] == list(overviews) and (not overviews or info.get('template') == template))
+
+
+def ingest_lines(line_paths, signatures=DEFAULT_SIGNATURES, tolerance=0.0, overviews=DEFAULT_OVERVIEWS,
+                 template_raster_path=None, force=False):
+    '''
+    ingest_line for every line that doesn't have current sidecars made the same way already. A line that line_align
+    has warped gets its copy ingested too (masks only), since that's the file the analyses read.
+    :param line_paths: List of .bsq paths.
+    :param signatures: NoData signature names, see signature_mask.
+    :param tolerance: How close to a signature counts as NoData.
+    :param overviews: Overview block sizes.
+    :param template_raster_path: Optional template to line the overview blocks up with. Lines ingested for another
+    template are ingested again.
+    :param force: Ingest every line again regardless.
+    :return: List of the paths that were ingested.
+    '''
+    import line_align
+
+    template = template_record(template_raster_path)
+    ingested = []
+    for path in line_paths:
+        if force or not is_current(read_info(path), signatures, tolerance, overviews, template):
+            print('ingesting ' + path)
+            ingest_line(path, signatures, tolerance, overviews, template_raster_path)
+            ingested.append(path)
+
+        copy_path = line_align.aligned_copy(path)
+        copy_signatures = line_align.aligned_signatures(signatures)
+        if copy_path and (force or not is_current(read_info(copy_path), copy_signatures, tolerance, ())):
+            print('ingesting ' + copy_path)
+            ingest_line(copy_path, copy_signatures, tolerance, ())
+            ingested.append(copy_path)
+    return ingested
+
+
+def read_info(raster_path):
+    '''
+    A line's ingest.json, if it has one and the line hasn't changed since.
+    :param raster_path: The path to the .bsq file.
+    :return: Dictionary or None.
+    '''
+    info_path = os.path.join(ingest_directory(raster_path), INFO_NAME)
+    if not os.path.exists(info_path):
+        return None
+
+    key = (os.path.abspath(raster_path), tuple(line_stamp(raster_path)))
+    if key not in _infos:
+        info = manifest.load_manifest(info_path)
+        if info.get('stamp') != list(key[1]):
+            return None
+        _infos[key] = info
+    return _infos[key]
+
+
+def read_packed(raster_path, rows, cols):
+    return np.memmap(os.path.join(ingest_directory(raster_path), MASK_NAME), dtype=np.uint8, mode='r',
+                     shape=(rows, -(-cols // 8)))
+
+
+def read_mask(raster_path, window=None):
+    '''
+    A line's valid-data mask from its sidecar. Only the rows and bytes under the window are read.
+    :param raster_path: The path to the .bsq file.
+    :param window: Optional window tuple (xoff, yoff, cols, rows) in the line's own pixels. Everything if None.
+    :return: Boolean array, or None if there's no current sidecar.
+    '''
+    info = read_info(raster_path)
+    if info is None:
+        return None
+    rows, cols = info['shape']
+    return unpack_mask(read_packed(raster_path, rows, cols), (rows, cols), window)
+
+
+def valid_bounds(raster_path):
+    '''
+    The window a line's data is inside, from its sidecar.
+    :param raster_path: The path to the .bsq file.
+    :return: Tuple of (has sidecar, window in the line's own pixels or None if it has no data).
+    '''
+    info = read_info(raster_path)
+    if info is None:
+        return False, None
+    return True, tuple(info['bounds']) if info['bounds'] else None
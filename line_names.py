@@ -0,0 +1,28 @@
+import ntpath
+
+__author__ = 'Steve Kochaver'
+
+# How flight line files and pair outputs are named. Kept apart from the arcpy and GDAL code so anything can name a pair
+# without importing either.
+
+
+def get_date(file_path):
+    '''
+    Takes the file names specific to these five band rasters and slices strings until you have a unique date identifier.
+    :param file_path: The full path to the file we need the date from
+    :return: The date string we cut from the file path
+    '''
+    name = ntpath.basename(file_path)
+    date = name[1:7]
+    full_date = date + '_' + name[14:16]
+    return full_date
+
+
+def pair_name(raster_file, compare_file):
+    '''
+    The name a pair's outputs go under, e.g. '140612_03_TO_140708_05'.
+    :param raster_file: The path to raster 1.
+    :param compare_file: The path to raster 2.
+    :return: String.
+    '''
+    return get_date(raster_file) + '_TO_' + get_date(compare_file)
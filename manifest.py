@@ -0,0 +1,219 @@
+import os
+import json
+import hashlib
+
+__author__ = 'Steve Kochaver'
+
+# Bookkeeping for incremental runs. The manifest remembers what every input looked like (size, mtime and a content
+# hash), which pair outputs were made from which versions of the inputs, and what the count rasters looked like when
+# they were last written. With that a rerun only has to redo the pairs that involve new or changed flight lines.
+
+MANIFEST_NAME = 'stdev_manifest.json'
+HASH_CHUNK = 16 * 1024 * 1024
+
+# Pair failures that will happen again every time until a line changes, by exception name (errors are recorded as
+# 'Name: message'). Anything else (a license checkout, a network read, a full disk) is retried on the next run.
+PERMANENT_ERRORS = ('NoOverlap',)
+
+
+def new_manifest():
+    return {'inputs': {}, 'pairs': {}, 'counts': {}}
+
+
+def load_manifest(manifest_path):
+    '''
+    Reads a manifest, or starts a new one if there isn't one yet.
+    :param manifest_path: The path to the .json manifest.
+    :return: Manifest dictionary.
+    '''
+    if not os.path.exists(manifest_path):
+        return new_manifest()
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifest_path):
+    '''
+    Writes a manifest. Goes through a temp file so a crash can't leave half a manifest behind.
+    :param manifest: Manifest dictionary.
+    :param manifest_path: The path to the .json manifest.
+    :return:
+    '''
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    os.rename(temp_path, manifest_path)
+    return
+
+
+def file_stamp(path):
+    '''
+    The cheap part of a file signature.
+    :param path: The path to the file.
+    :return: List of [size, mtime].
+    '''
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def file_hash(path):
+    '''
+    SHA1 of a file plus its ENVI .hdr if it has one, since the header can change the meaning of the same bytes.
+    :param path: The path to the file.
+    :return: Hex digest string.
+    '''
+    sha = hashlib.sha1()
+    header_path = os.path.splitext(path)[0] + '.hdr'
+
+    for part in [path, header_path]:
+        if not os.path.exists(part):
+            continue
+        with open(part, 'rb') as f:
+            chunk = f.read(HASH_CHUNK)
+            while chunk:
+                sha.update(chunk)
+                chunk = f.read(HASH_CHUNK)
+
+    return sha.hexdigest()
+
+
+def input_signatures(files, manifest):
+    '''
+    Signatures for the current inputs, stored in the manifest as it goes. A file only gets re-hashed when its size or
+    mtime (or its header's mtime) has moved, so an unchanged directory costs a stat per file.
+    :param files: List of input paths.
+    :param manifest: Manifest dictionary. Its 'inputs' section is replaced.
+    :return: Dictionary of {path: hash}.
+    '''
+    inputs = {}
+    for path in files:
+        stamp = file_stamp(path)
+        header_path = os.path.splitext(path)[0] + '.hdr'
+        if os.path.exists(header_path):
+            stamp += file_stamp(header_path)
+
+        previous = manifest['inputs'].get(path)
+        if previous is not None and previous['stamp'] == stamp:
+            inputs[path] = previous
+        else:
+            inputs[path] = {'stamp': stamp, 'hash': file_hash(path)}
+
+    manifest['inputs'] = inputs
+    return dict((path, entry['hash']) for path, entry in inputs.items())
+
+
+def pair_is_current(manifest, pair_name, raster_file, compare_file, signatures, output_paths):
+    '''
+    Whether a pair's outputs (or its recorded failure, if it's one of PERMANENT_ERRORS) still match its inputs.
+    :param manifest: Manifest dictionary.
+    :param pair_name: The pair's output name, e.g. '140612_03_TO_140708_05'.
+    :param raster_file: The path to raster 1.
+    :param compare_file: The path to raster 2.
+    :param signatures: Dictionary of {path: hash} from input_signatures.
+    :param output_paths: Dictionary of {label: output path} this run wants for the pair.
+    :return: Boolean.
+    '''
+    entry = manifest['pairs'].get(pair_name)
+    if entry is None:
+        return False
+    if entry['inputs'] != [raster_file, compare_file]:
+        return False
+    if entry['hashes'] != [signatures[raster_file], signatures[compare_file]]:
+        return False
+    if entry.get('error'):
+        return entry['error'].split(':')[0] in PERMANENT_ERRORS
+
+    for label, output_path in output_paths.items():
+        if entry['outputs'].get(label) != output_path or not os.path.exists(output_path):
+            return False
+    return True
+
+
+def record_pair(manifest, pair_name, raster_file, compare_file, signatures, output_paths, error=None):
+    '''
+    Remembers which versions of the inputs a pair's outputs came from. Failed pairs are remembered too, and ones that
+    failed for a reason in PERMANENT_ERRORS aren't retried until one of their inputs changes.
+    :param manifest: Manifest dictionary.
+    :param pair_name: The pair's output name.
+    :param raster_file: The path to raster 1.
+    :param compare_file: The path to raster 2.
+    :param signatures: Dictionary of {path: hash} from input_signatures.
+    :param output_paths: Dictionary of {label: output path}.
+    :param error: The error message if the pair failed.
+    :return:
+    '''
+    manifest['pairs'][pair_name] = {'inputs': [raster_file, compare_file],
+                                    'hashes': [signatures[raster_file], signatures[compare_file]],
+                                    'outputs': {} if error else output_paths,
+                                    'error': error}
+    return
+
+
+def forget_pair(manifest, pair_name):
+    '''
+    Drops a pair from the manifest.
+    :param manifest: Manifest dictionary.
+    :param pair_name: The pair's output name.
+    :return: The outputs the pair had, as {label: output path}.
+    '''
+    entry = manifest['pairs'].pop(pair_name, None)
+    if entry is None:
+        return {}
+    return entry['outputs']
+
+
+def start_run(manifest, manifest_path):
+    '''
+    Marks the manifest as in the middle of a run and saves it, before any pair outputs are touched. If the run doesn't
+    get as far as finish_run, the next one finds the mark and rebuilds the counts from whatever outputs are on disk
+    instead of trusting count rasters that no longer match them.
+    :param manifest: Manifest dictionary.
+    :param manifest_path: The path to the .json manifest.
+    :return:
+    '''
+    manifest['in_progress'] = True
+    save_manifest(manifest, manifest_path)
+    return
+
+
+def finish_run(manifest, manifest_path):
+    '''
+    Clears the in progress mark and saves the manifest. Call it once the counts are written and recorded.
+    :param manifest: Manifest dictionary.
+    :param manifest_path: The path to the .json manifest.
+    :return:
+    '''
+    manifest['in_progress'] = False
+    save_manifest(manifest, manifest_path)
+    return
+
+
+def count_is_current(manifest, label, count_path):
+    '''
+    Whether a count raster is still the one this manifest last wrote. If it isn't (missing, written by something else,
+    or left by a run that didn't finish) the counts have to be rebuilt from the pair outputs.
+    :param manifest: Manifest dictionary.
+    :param label: The count's label, e.g. 'stdev' or '196stdev'.
+    :param count_path: The path to the count raster.
+    :return: Boolean.
+    '''
+    if manifest.get('in_progress'):
+        return False
+    entry = manifest['counts'].get(label)
+    if entry is None or entry['path'] != count_path or not os.path.exists(count_path):
+        return False
+    return entry['stamp'] == file_stamp(count_path)
+
+
+def record_count(manifest, label, count_path):
+    '''
+    Remembers a count raster right after it's written.
+    :param manifest: Manifest dictionary.
+    :param label: The count's label, e.g. 'stdev' or '196stdev'.
+    :param count_path: The path to the count raster.
+    :return:
+    '''
+    manifest['counts'][label] = {'path': count_path, 'stamp': file_stamp(count_path)}
+    return
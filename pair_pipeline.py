@@ -0,0 +1,313 @@
+import threading
+import numpy as np
+import gdal
+import raster_grid
+import gdal_rangefinder
+import gdal_adder
+import pair_store
+import instrument
+from collections import namedtuple
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue  # Python 3
+
+gdal.UseExceptions()
+__author__ = 'Steve Kochaver'
+
+# Runs GDAL pair comparisons as a pipeline in one process so reading, comparing and writing overlap instead of taking
+# turns. On the network storage most of a pair's time is spent waiting on the reads and writes, with the CPU idle.
+#
+#   reader threads   take pairs in scheduled order and read their bands and masks (load_pair)
+#   this thread      compares each pair as it arrives and clips the results
+#   writer threads   write the finished outputs
+#
+# The queues between the stages are bounded, so a slow stage holds the ones in front of it up rather than letting
+# pairs pile up in memory. At most readers + read_depth + 1 pairs of bands and writers + write_depth pairs of outputs
+# are held at once. GDAL and numpy let go of the GIL while they work so threads are enough for the overlap. Results
+# come back in the order pairs finish, like pair_scheduler.run_pairs, and instrument records follow each pair from
+# thread to thread.
+
+PipelineSettings = namedtuple('PipelineSettings', ['readers', 'writers', 'read_depth', 'write_depth'])
+
+DEFAULT_SETTINGS = PipelineSettings(readers=2, writers=2, read_depth=4, write_depth=8)
+
+# How often a blocked thread checks whether the pipeline has been stopped, in seconds.
+POLL_SECONDS = 0.1
+
+_END = object()
+
+
+class _Stopped(Exception):
+    pass
+
+
+def _put(target, item, stop):
+    while True:
+        if stop.is_set():
+            raise _Stopped()
+        try:
+            target.put(item, timeout=POLL_SECONDS)
+            return
+        except queue.Full:
+            pass
+
+
+def _get(source, stop):
+    while True:
+        if stop.is_set():
+            raise _Stopped()
+        try:
+            return source.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            pass
+
+
+def _error_text(e):
+    return '%s: %s' % (type(e).__name__, e)
+
+
+def _read_loop(jobs, loaded, load, stop):
+    try:
+        try:
+            while True:
+                try:
+                    job = jobs.get_nowait()
+                except queue.Empty:
+                    break
+
+                data, error = None, None
+                try:
+                    instrument.start_pair(job[0], job[1])
+                    data = load(job)
+                except Exception as e:
+                    error = _error_text(e)
+                _put(loaded, (job, data, error, instrument.detach_pair()), stop)
+        finally:
+            # However the loop ends, or run_pipeline would wait on this reader forever.
+            _put(loaded, _END, stop)
+    except _Stopped:
+        pass
+    return
+
+
+def _write_loop(outputs, done, write, stop):
+    try:
+        while True:
+            item = _get(outputs, stop)
+            if item is _END:
+                return
+
+            job, results, error, record = item
+            instrument.attach_pair(record)
+            if error is None:
+                try:
+                    for result in results:
+                        write(job, result)
+                except Exception as e:
+                    error = _error_text(e)
+            done.put((job, error, instrument.finish_pair(error)))
+    except _Stopped:
+        pass
+    return
+
+
+def _start(target, args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def run_pipeline(tasks, load, compute, write, settings=DEFAULT_SETTINGS):
+    '''
+    Pushes pairs through the read, compute and write stages.
+    :param tasks: List of (raster_file, compare_file, output) tuples, in the order they should be read.
+    :param load: Function taking a task and returning whatever compute needs. Runs in the reader threads.
+    :param compute: Function taking a task and what load returned and returning a list of results to write. Runs in
+    the calling thread.
+    :param write: Function taking a task and one result. Runs in the writer threads.
+    :param settings: PipelineSettings.
+    :return: Generator of (raster_file, compare_file, output, error) tuples. error is None if the pair worked.
+    '''
+    jobs = queue.Queue()
+    for task in tasks:
+        jobs.put(task)
+
+    loaded = queue.Queue(max(1, settings.read_depth))
+    outputs = queue.Queue(max(1, settings.write_depth))
+    done = queue.Queue()
+    stop = threading.Event()
+
+    readers = [_start(_read_loop, (jobs, loaded, load, stop)) for i in range(max(1, settings.readers))]
+    writers = [_start(_write_loop, (outputs, done, write, stop)) for i in range(max(1, settings.writers))]
+
+    def finished():
+        while True:
+            try:
+                job, error, record = done.get_nowait()
+            except queue.Empty:
+                return
+            instrument.log_pair(record)
+            yield job[0], job[1], job[2], error
+
+    try:
+        readers_left = len(readers)
+        while readers_left:
+            item = loaded.get()
+            if item is _END:
+                readers_left -= 1
+                continue
+
+            job, data, error, record = item
+            instrument.attach_pair(record)
+            results = []
+            if error is None:
+                try:
+                    results = compute(job, data)
+                except Exception as e:
+                    error = _error_text(e)
+            data = None
+
+            # Blocks while the writers are behind, which is what keeps the outputs in memory bounded.
+            _put(outputs, (job, results, error, instrument.detach_pair()), stop)
+            for result in finished():
+                yield result
+
+        for writer in writers:
+            _put(outputs, _END, stop)
+        for writer in writers:
+            writer.join()
+        for result in finished():
+            yield result
+
+        # Only left over if every reader died outside load, so they're reported rather than lost.
+        while not jobs.empty():
+            job = jobs.get_nowait()
+            yield job[0], job[1], job[2], 'RuntimeError: not read, the reader threads stopped'
+    finally:
+        stop.set()
+    return
+
+
+def load_pair(template_raster_path):
+    '''
+    The load function for comparisons. Memory mapped bands are read in full here so the I/O happens in the reader
+    thread and not when compute first touches them.
+    :param template_raster_path: The raster to snap to.
+    :return: Function for run_pipeline.
+    '''
+    def load(task):
+        ref_grid, window, bands_1, bands_2, mask = gdal_rangefinder.load_pair(task[0], task[1], template_raster_path)
+        if isinstance(bands_1, np.memmap):
+            bands_1 = np.array(bands_1)
+        if isinstance(bands_2, np.memmap):
+            bands_2 = np.array(bands_2)
+        return ref_grid, window, bands_1, bands_2, mask
+    return load
+
+
+def load_mask(template_raster_path):
+    '''
+    The load function when only where a pair has data in common is wanted. No bands are read for ingested lines.
+    :param template_raster_path: The raster to snap to.
+    :return: Function for run_pipeline, giving the overlap window and the mask of where both lines have data.
+    '''
+    def load(task):
+        ref_grid, window_1, window_2, overlap = gdal_rangefinder.pair_windows(task[0], task[1], template_raster_path)
+        mask_1 = gdal_rangefinder.read_mask_window(task[0], window_1, overlap)
+        mask_2 = gdal_rangefinder.read_mask_window(task[1], window_2, overlap)
+        with instrument.stage('intersection'):
+            return overlap, mask_1 & mask_2
+    return load
+
+
+def clipped_ranges(data, sigmas):
+    '''
+    Every range of a pair tested and clipped, the compute half of gdal_rangefinder.check_ranges.
+    :param data: What load_pair's function returned.
+    :param sigmas: The sigmas to test.
+    :return: List of (sigma, clipped values, clipped window, reference Grid).
+    '''
+    ref_grid, window, bands_1, bands_2, mask = data
+    results = []
+    for sigma in sigmas:
+        values = gdal_rangefinder.in_range(bands_1, bands_2, sigma)
+        with instrument.stage('clip_write'):
+            clipped, clipped_window = gdal_rangefinder.clip_to_mask(values, mask, window)
+        results.append((sigma, clipped, clipped_window, ref_grid))
+    return results
+
+
+def check_ranges(tasks, template_raster_path, settings=DEFAULT_SETTINGS):
+    '''
+    gdal_rangefinder.check_ranges for a list of pairs through the pipeline.
+    :param tasks: List of (raster_file, compare_file, {sigma: output path}) tuples.
+    :param template_raster_path: The raster to snap to.
+    :param settings: PipelineSettings.
+    :return: Generator of (raster_file, compare_file, output paths, error) tuples.
+    '''
+    def compute(task, data):
+        return clipped_ranges(data, task[2].keys())
+
+    def write(task, result):
+        sigma, clipped, clipped_window, ref_grid = result
+        with instrument.stage('clip_write'):
+            raster_grid.write_window(task[2][sigma], clipped, ref_grid, clipped_window, gdal.GDT_Byte,
+                                     gdal_rangefinder.OUT_NODATA)
+        instrument.add_bytes(written=clipped.nbytes)
+
+    return run_pipeline(tasks, load_pair(template_raster_path), compute, write, settings)
+
+
+def store_ranges(tasks, template_raster_path, settings=DEFAULT_SETTINGS):
+    '''
+    gdal_rangefinder.store_ranges for a list of pairs through the pipeline.
+    :param tasks: List of (raster_file, compare_file, (store path, date 1, date 2, {sigma: label}, encoding)) tuples.
+    :param template_raster_path: The raster to snap to.
+    :param settings: PipelineSettings.
+    :return: Generator of (raster_file, compare_file, store target, error) tuples.
+    '''
+    def compute(task, data):
+        return clipped_ranges(data, task[2][3].keys())
+
+    def write(task, result):
+        store_path, date_1, date_2, labels, encoding = task[2]
+        sigma, clipped, clipped_window, ref_grid = result
+        with instrument.stage('clip_write'):
+            pair_store.write_pair(store_path, date_1, date_2, labels[sigma], clipped, clipped_window, encoding)
+        instrument.add_bytes(written=clipped.nbytes)
+
+    return run_pipeline(tasks, load_pair(template_raster_path), compute, write, settings)
+
+
+def total_intersection(pairs, template_raster_path, final_raster_path, settings=DEFAULT_SETTINGS):
+    '''
+    GDAL version of raster_adder.total_intersection: the number of pairs with data in common at every pixel. Nothing
+    is written per pair and only the masks are read (from the sidecars of ingested lines), each added straight into
+    the count.
+    :param pairs: List of (raster_file, compare_file) tuples.
+    :param template_raster_path: The template raster defining the output grid.
+    :param final_raster_path: Where the count raster goes.
+    :param settings: PipelineSettings. The writers only close off each pair's record here.
+    :return: Generator of (raster_file, compare_file, None, error) tuples. The count is saved once it's used up.
+    '''
+    template_grid = raster_grid.get_grid(template_raster_path)
+    counts = gdal_adder.new_count_array(template_grid)
+
+    def compute(task, data):
+        window, mask = data
+        with instrument.stage('accumulate'):
+            counts[raster_grid.window_slices(window)] += mask
+        return []
+
+    def write(task, result):
+        return
+
+    tasks = [(raster_file, compare_file, None) for raster_file, compare_file in pairs]
+    for result in run_pipeline(tasks, load_mask(template_raster_path), compute, write, settings):
+        yield result
+
+    gdal_adder.save_counts(counts, template_grid, final_raster_path)
+    return
@@ -0,0 +1,118 @@
+import os
+import sys
+import shutil
+import tempfile
+import multiprocessing
+import band_cache
+import instrument
+
+__author__ = 'Steve Kochaver'
+
+# Set in each worker process by the pool initializer. None means we're running in the main process.
+_scratch_root = None
+_scratch_dir = None
+
+
+def list_pairs(files):
+    '''
+    Every pair of files in the same order the old nested loops used, i.e. each file against every file after it.
+    :param files: List of file paths.
+    :return: List of (raster_file, compare_file) tuples.
+    '''
+    return [(files[i], files[j]) for i in range(len(files)) for j in range(i + 1, len(files))]
+
+
+def _init_worker(scratch_root, cache_bytes=None, spill_dir=None, instrument_settings=None):
+    global _scratch_root
+    _scratch_root = scratch_root
+    if cache_bytes:
+        band_cache.enable(cache_bytes, spill_dir)
+    if instrument_settings:
+        instrument.enable_worker(instrument_settings)
+
+
+def _use_scratch():
+    '''
+    Points temp files (and arcpy's scratch workspace if arcpy is loaded) at a directory only this worker uses so that
+    workers never step on each other's intermediate rasters. Does nothing in the main process.
+    :return:
+    '''
+    global _scratch_dir
+    if _scratch_root is None:
+        return
+
+    if _scratch_dir is None:
+        _scratch_dir = tempfile.mkdtemp(prefix='worker_%d_' % os.getpid(), dir=_scratch_root)
+        tempfile.tempdir = _scratch_dir
+        for variable in ['TMP', 'TEMP', 'TMPDIR']:
+            os.environ[variable] = _scratch_dir
+
+    if 'arcpy' in sys.modules:
+        sys.modules['arcpy'].env.scratchWorkspace = _scratch_dir
+    return
+
+
+def _run_pair(job):
+    check_func, raster_file, compare_file, output_path, template_raster_path = job
+    _use_scratch()
+
+    error = None
+    instrument.start_pair(raster_file, compare_file)
+    try:
+        with instrument.profiled(raster_file, compare_file):
+            check_func(raster_file, compare_file, output_path, template_raster_path)
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+
+    # The record rides back with the result so only the main process writes the instrument log.
+    return raster_file, compare_file, output_path, error, instrument.finish_pair(error)
+
+
+def _finish(result):
+    instrument.log_pair(result[4])
+    return result[:4]
+
+
+def run_pairs(check_func, tasks, template_raster_path, processes=None, cache_bytes=None):
+    '''
+    Runs a pair comparison function over a list of pairs with a pool of worker processes. Results come back as each
+    pair finishes, not in the order they went in.
+    :param check_func: A module level comparison function with the check_stdev_range signature, e.g.
+    stdev_rangefinder.check_stdev_range or gdal_rangefinder.check_196stdev_range.
+    :param tasks: List of (raster_file, compare_file, output_path) tuples.
+    :param template_raster_path: The template raster handed to every comparison.
+    :param processes: Number of worker processes. None uses every core, 1 runs everything in this process.
+    :param cache_bytes: If given each process keeps up to this many bytes of decoded flight lines in band_cache. The
+    workers also share a spill directory so a line decoded by one of them is loaded from there by the rest.
+    If instrument is enabled every pair is timed in its worker and its record logged here as it comes back.
+    :return: Generator of (raster_file, compare_file, output_path, error) tuples. error is None if the pair worked.
+    '''
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    jobs = [(check_func, raster_file, compare_file, output_path, template_raster_path)
+            for raster_file, compare_file, output_path in tasks]
+
+    if processes <= 1:
+        if cache_bytes:
+            band_cache.enable(cache_bytes)
+        try:
+            for job in jobs:
+                yield _finish(_run_pair(job))
+        finally:
+            if cache_bytes:
+                band_cache.disable()
+        return
+
+    scratch_root = tempfile.mkdtemp(prefix='pair_scratch_')
+    spill_dir = os.path.join(scratch_root, 'band_cache') if cache_bytes else None
+    pool = multiprocessing.Pool(processes, _init_worker, (scratch_root, cache_bytes, spill_dir, instrument.settings()))
+    try:
+        for result in pool.imap_unordered(_run_pair, jobs, 1):
+            yield _finish(result)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(scratch_root, ignore_errors=True)
+    return
@@ -0,0 +1,247 @@
+import os
+import glob
+import json
+import time
+import zlib
+import threading
+import numpy as np
+import gdal
+import raster_grid
+
+gdal.UseExceptions()
+__author__ = 'Steve Kochaver'
+
+# Keeps pair comparison results in one store instead of a GeoTIFF per pair. A store is a directory holding a couple of
+# append only files per writing process: part-<pid>.dat is the results one after another, each compressed on its own,
+# and part-<pid>.idx is a JSON line per result saying which pair and sigma it is, where it sits on the template grid
+# and where its bytes are in the .dat. Processes never write each other's files so workers need no locking, and since
+# the bytes go down before their index line a crash can only lose the result being written.
+#
+# Results are kept at their clipped window, either bit packed (a valid bit and a value bit per pixel, which deflate
+# squeezes down to next to nothing for these masks) or as the plain 0/1/255 bytes. Any single result can be read
+# straight out of the index, and summing streams through the .dat files front to back.
+
+STORE_EXT = '.pairs'
+OUT_NODATA = 255
+ENCODINGS = ('bits', 'uint8')
+COMPRESS_LEVEL = 6
+
+# Open (data file, index file) for every store this process has written to, so each result is two appends.
+_writers = {}
+
+# Writer threads in one process share those files, so a result's offset and its bytes have to go down together.
+_write_lock = threading.Lock()
+
+
+def encode(values, encoding='bits'):
+    '''
+    Packs a 0/1/OUT_NODATA result for writing.
+    :param values: Uint8 array.
+    :param encoding: 'bits' or 'uint8'.
+    :return: Compressed bytes.
+    '''
+    if encoding == 'bits':
+        valid = values != OUT_NODATA
+        raw = np.packbits(valid, axis=None).tobytes() + np.packbits(valid & (values == 1), axis=None).tobytes()
+    elif encoding == 'uint8':
+        raw = np.ascontiguousarray(values, dtype=np.uint8).tobytes()
+    else:
+        raise ValueError('Unknown pair store encoding %s' % encoding)
+    return zlib.compress(raw, COMPRESS_LEVEL)
+
+
+def decode(data, shape, encoding='bits'):
+    '''
+    Unpacks what encode made.
+    :param data: Compressed bytes.
+    :param shape: (rows, cols) of the result.
+    :param encoding: 'bits' or 'uint8'.
+    :return: Uint8 array of 0, 1 and OUT_NODATA.
+    '''
+    raw = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+    size = shape[0] * shape[1]
+    if encoding == 'uint8':
+        return raw.reshape(shape)
+
+    plane = len(raw) // 2
+    valid = np.unpackbits(raw[:plane])[:size].astype(bool)
+    ones = np.unpackbits(raw[plane:])[:size].astype(bool)
+    return np.where(valid, ones, OUT_NODATA).astype(np.uint8).reshape(shape)
+
+
+def _writer(store_path):
+    key = (os.path.abspath(store_path), os.getpid())
+    if key not in _writers:
+        if not os.path.exists(store_path):
+            try:
+                os.makedirs(store_path)
+            except OSError:
+                if not os.path.isdir(store_path):  # Another worker may have just made it.
+                    raise
+        part = os.path.join(store_path, 'part-%d' % os.getpid())
+        _writers[key] = (open(part + '.dat', 'ab'), open(part + '.idx', 'a'))
+    return _writers[key]
+
+
+def write_pair(store_path, date_1, date_2, label, values, window, encoding='bits'):
+    '''
+    Adds one pair result to a store.
+    :param store_path: The store directory. Made if it isn't there.
+    :param date_1: get_date of raster 1.
+    :param date_2: get_date of raster 2.
+    :param label: Which result of the pair this is, e.g. 'stdev' or '196stdev'.
+    :param values: Uint8 array of 0, 1 and OUT_NODATA.
+    :param window: The window (xoff, yoff, cols, rows) the values cover on the template grid.
+    :param encoding: 'bits' or 'uint8'.
+    :return:
+    '''
+    data = encode(values, encoding)
+
+    with _write_lock:
+        data_file, index_file = _writer(store_path)
+        data_file.seek(0, os.SEEK_END)
+        offset = data_file.tell()
+        data_file.write(data)
+        data_file.flush()
+
+        entry = {'date_1': date_1, 'date_2': date_2, 'label': label, 'window': list(window), 'encoding': encoding,
+                 'part': os.path.basename(data_file.name), 'offset': offset, 'length': len(data), 'time': time.time()}
+        index_file.write(json.dumps(entry, sort_keys=True) + '\n')
+        index_file.flush()
+    return
+
+
+def close_writers():
+    '''
+    Closes this process's open store files. Everything is flushed as it's written so this is only tidiness.
+    :return:
+    '''
+    for data_file, index_file in _writers.values():
+        data_file.close()
+        index_file.close()
+    _writers.clear()
+    return
+
+
+def clear_store(store_path):
+    '''
+    Empties a store so a run starts from nothing. Appending to the last run's store would grow it by a full copy every
+    time, and results for pairs that now fail (or whose lines are gone) would stay in the index and keep being summed.
+    :param store_path: The store directory.
+    :return:
+    '''
+    key = os.path.abspath(store_path)
+    for writer_key in [writer_key for writer_key in _writers if writer_key[0] == key]:
+        for handle in _writers.pop(writer_key):
+            handle.close()
+    for part_path in glob.glob(os.path.join(store_path, 'part-*.*')):
+        os.remove(part_path)
+    return
+
+
+def read_index(store_path):
+    '''
+    Every result in a store. If a pair was written more than once (a rerun, say) only the latest is kept.
+    :param store_path: The store directory.
+    :return: Dictionary of {(date_1, date_2, label): entry}.
+    '''
+    index = {}
+    for index_path in sorted(glob.glob(os.path.join(store_path, 'part-*.idx'))):
+        data_size = os.path.getsize(os.path.splitext(index_path)[0] + '.dat')
+        with open(index_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Cut off part way through by a crash.
+                if entry['offset'] + entry['length'] > data_size:
+                    continue
+
+                key = (entry['date_1'], entry['date_2'], entry['label'])
+                if key not in index or index[key]['time'] <= entry['time']:
+                    index[key] = entry
+    return index
+
+
+def _read_entry(store_path, entry, data_file=None):
+    if data_file is None:
+        with open(os.path.join(store_path, entry['part']), 'rb') as f:
+            return _read_entry(store_path, entry, f)
+
+    data_file.seek(entry['offset'])
+    window = tuple(entry['window'])
+    return decode(data_file.read(entry['length']), (window[3], window[2]), entry['encoding']), window
+
+
+def read_pair(store_path, date_1, date_2, label, index=None):
+    '''
+    One pair result, e.g. for looking at a single comparison.
+    :param store_path: The store directory.
+    :param date_1: get_date of raster 1.
+    :param date_2: get_date of raster 2.
+    :param label: Which result of the pair.
+    :param index: The store's read_index, if it's already been read.
+    :return: The uint8 values and their window on the template grid.
+    '''
+    if index is None:
+        index = read_index(store_path)
+    key = (date_1, date_2, label)
+    if key not in index:
+        raise KeyError('%s_TO_%s %s is not in %s' % (date_1, date_2, label, store_path))
+    return _read_entry(store_path, index[key])
+
+
+def iter_pairs(store_path, label=None):
+    '''
+    Goes through every result in a store in the order it was written, one file at a time.
+    :param store_path: The store directory.
+    :param label: Only results with this label. All of them if None.
+    :return: Generator of (entry, values, window).
+    '''
+    by_part = {}
+    for entry in read_index(store_path).values():
+        if label is None or entry['label'] == label:
+            by_part.setdefault(entry['part'], []).append(entry)
+
+    for part in sorted(by_part):
+        with open(os.path.join(store_path, part), 'rb') as data_file:
+            for entry in sorted(by_part[part], key=lambda item: item['offset']):
+                values, window = _read_entry(store_path, entry, data_file)
+                yield entry, values, window
+    return
+
+
+def add_store(counts, store_path, label, footprint=False):
+    '''
+    Adds a store's results into a count array, like gdal_adder.add_raster does for a GeoTIFF.
+    :param counts: The count array from gdal_adder.new_count_array. Results are placed by their template window.
+    :param store_path: The store directory.
+    :param label: Which results to add.
+    :param footprint: Count where results have data (the intersection count) instead of where they're 1.
+    :return: How many results were added.
+    '''
+    added = 0
+    for entry, values, window in iter_pairs(store_path, label):
+        if footprint:
+            counts[raster_grid.window_slices(window)] += values != OUT_NODATA
+        else:
+            counts[raster_grid.window_slices(window)] += values == 1
+        added += 1
+    return added
+
+
+def write_geotiff(store_path, date_1, date_2, label, template_raster_path, out_path):
+    '''
+    Writes one stored result out as the GeoTIFF check_ranges would have made.
+    :param store_path: The store directory.
+    :param date_1: get_date of raster 1.
+    :param date_2: get_date of raster 2.
+    :param label: Which result of the pair.
+    :param template_raster_path: The template the results were made on.
+    :param out_path: The path to the output .tif.
+    :return:
+    '''
+    values, window = read_pair(store_path, date_1, date_2, label)
+    raster_grid.write_window(out_path, values, raster_grid.get_grid(template_raster_path), window, gdal.GDT_Byte,
+                             OUT_NODATA)
+    return
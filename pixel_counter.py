@@ -0,0 +1,186 @@
+import numpy as np
+import gdal
+import raster_grid
+import tiling
+import gdal_rangefinder
+
+gdal.UseExceptions()
+__author__ = 'Steve Kochaver'
+
+# The true count raster is only ever a per pixel count of pairs (i < j) where line i's Mean falls inside line j's range,
+# and path_counts is the number of pairs with data at the pixel. Both can be counted straight from a stack of all the
+# lines at each pixel without making any pair rasters at all.
+#
+# For each pixel the means are sorted once and every range is turned into a pair of positions in that sorted order
+# (binary search). The lines are then swept in file order while a Fenwick tree keeps track of which sorted positions
+# belong to lines already seen, so "how many earlier means fall in my range" is two prefix sums. That's n log n per
+# pixel instead of n squared, and all of it is done for a whole tile of pixels at a time.
+
+PERCENT_NODATA = -1
+
+
+def sorted_positions(sorted_values, queries, inclusive):
+    '''
+    searchsorted along the first axis for every pixel at once.
+    :param sorted_values: Array shaped (n, pixels), sorted along axis 0.
+    :param queries: Array shaped (k, pixels) of values to look up in their own pixel's column.
+    :param inclusive: True counts values <= query (side='right'), False counts values < query (side='left').
+    :return: Int array shaped like queries of how many sorted values are below each query.
+    '''
+    n = sorted_values.shape[0]
+    cols = np.arange(sorted_values.shape[1])[np.newaxis, :]
+    low = np.zeros(queries.shape, dtype=np.int64)
+    high = np.full(queries.shape, n, dtype=np.int64)
+
+    active = low < high
+    while active.any():
+        mid = (low + high) // 2
+        values = sorted_values[np.minimum(mid, n - 1), cols]
+        go_up = (values <= queries) if inclusive else (values < queries)
+
+        low = np.where(active & go_up, mid + 1, low)
+        high = np.where(active & ~go_up, mid, high)
+        active = low < high
+
+    return low
+
+
+def _fenwick_prefix(tree, positions, cols):
+    # How many inserted entries sit at sorted positions below each pixel's position.
+    total = np.zeros(positions.shape, dtype=np.int64)
+    index = positions.copy()
+    while index.any():
+        total += np.where(index > 0, tree[index, cols], 0)
+        index -= index & -index
+    return total
+
+
+def _fenwick_insert(tree, positions, mask, cols):
+    n = tree.shape[0] - 1
+    index = positions + 1
+    active = mask & (index <= n)
+    while active.any():
+        tree[index[active], cols[active]] += 1
+        index = np.where(active, index + (index & -index), index)
+        active &= index <= n
+    return
+
+
+def count_pairs(means, valid, ranges):
+    '''
+    Counts, for every pixel, the pairs of lines (i < j) where line i's mean is inside line j's range.
+    :param means: Float32 array shaped (lines, pixels) of each line's Mean. Lines in file order.
+    :param valid: Boolean array shaped (lines, pixels), True where the line has data.
+    :param ranges: List of (lower, upper) arrays shaped (lines, pixels), one per sigma.
+    :return: List of int arrays shaped (pixels,), one count per range, and the number of pairs with data at the pixel.
+    '''
+    n, pixels = means.shape
+    cols = np.arange(pixels)
+
+    # Lines without data sort to the end and are never inserted so they can't be counted.
+    keyed = np.where(valid, means, np.inf).astype(np.float32)
+    order = np.argsort(keyed, axis=0, kind='mergesort')
+    sorted_means = np.take_along_axis(keyed, order, axis=0)
+
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.broadcast_to(np.arange(n)[:, np.newaxis], order.shape), axis=0)
+
+    # mean_i >= lower_j and mean_i <= upper_j becomes lower position <= rank_i < upper position
+    positions = [(sorted_positions(sorted_means, lower.astype(np.float32), False),
+                  sorted_positions(sorted_means, upper.astype(np.float32), True)) for lower, upper in ranges]
+
+    tree = np.zeros((n + 1, pixels), dtype=np.int32)
+    counts = [np.zeros(pixels, dtype=np.int64) for r in ranges]
+
+    for j in range(n):
+        for count, (lower_positions, upper_positions) in zip(counts, positions):
+            in_range = _fenwick_prefix(tree, upper_positions[j], cols) - _fenwick_prefix(tree, lower_positions[j], cols)
+            count += np.where(valid[j], np.maximum(in_range, 0), 0)
+        _fenwick_insert(tree, ranks[j], valid[j], cols)
+
+    lines_with_data = valid.sum(axis=0).astype(np.int64)
+    return counts, lines_with_data * (lines_with_data - 1) // 2
+
+
+def stack_tile(line_paths, line_windows, tile, sigmas):
+    '''
+    Reads every line that touches a tile into (lines, pixels) arrays. Lines that don't touch it are left out.
+    :param line_paths: List of five band raster paths in file order.
+    :param line_windows: Their windows on the template grid.
+    :param tile: The tile window on the template grid.
+    :param sigmas: The ranges to get bounds for.
+    :return: means, valid and the list of (lower, upper) arrays for count_pairs.
+    '''
+    touching = [(path, window) for path, window in zip(line_paths, line_windows)
+                if raster_grid.intersect_windows(window, tile) is not None]
+    shape = (len(touching), tile[3], tile[2])
+
+    means = np.zeros(shape, dtype=np.float32)
+    valid = np.zeros(shape, dtype=bool)
+    ranges = [(np.zeros(shape, dtype=np.float32), np.zeros(shape, dtype=np.float32)) for sigma in sigmas]
+
+    for row, (path, window) in enumerate(touching):
+        part = raster_grid.intersect_windows(window, tile)
+        bands, mask = gdal_rangefinder.read_window(path, window, part)
+        slices = (row,) + raster_grid.window_slices(raster_grid.relative_window(part, tile))
+
+        means[slices] = bands[gdal_rangefinder.MEAN_BAND]
+        valid[slices] = mask
+        for (lower, upper), sigma in zip(ranges, sigmas):
+            lower[slices], upper[slices] = gdal_rangefinder.range_bounds(bands, sigma)
+
+    flat = (len(touching), tile[2] * tile[3])
+    return means.reshape(flat), valid.reshape(flat), [(lower.reshape(flat), upper.reshape(flat)) for lower, upper in ranges]
+
+
+def count_lines(line_paths, template_raster_path, true_count_paths, per_raster_paths, path_count_path,
+                memory_budget=tiling.DEFAULT_MEMORY_BUDGET):
+    '''
+    Makes the true count, percent and path count rasters for a set of flight lines directly, with no pair outputs.
+    Gives the same counts as comparing every pair in list_pairs order and summing the results.
+    :param line_paths: List of five band raster paths in the order pairs would be made from them.
+    :param template_raster_path: The template raster defining the output grid.
+    :param true_count_paths: Dictionary of {sigma: true count raster path}.
+    :param per_raster_paths: Dictionary of {sigma: percent raster path}.
+    :param path_count_path: Where the number of pairs with data at each pixel goes (the path_counts raster).
+    :param memory_budget: Roughly how many bytes of arrays to hold at once.
+    :return:
+    '''
+    sigmas = sorted(true_count_paths)
+    template_grid = raster_grid.get_grid(template_raster_path)
+    full_window = (0, 0, template_grid.cols, template_grid.rows)
+    line_windows = [raster_grid.window_in(gdal_rangefinder.get_grid(path), template_grid) for path in line_paths]
+
+    true_counts = [raster_grid.create_raster(true_count_paths[sigma], template_grid, full_window, gdal.GDT_Int32)
+                   for sigma in sigmas]
+    percents = [raster_grid.create_raster(per_raster_paths[sigma], template_grid, full_window, gdal.GDT_Float32, PERCENT_NODATA)
+                for sigma in sigmas]
+    path_counts = raster_grid.create_raster(path_count_path, template_grid, full_window, gdal.GDT_Int32)
+
+    # Per line and pixel: mean, valid, two bounds and two sorted positions per sigma, the sort order, rank and tree.
+    bytes_per_pixel = max(1, len(line_paths)) * (4 + 1 + len(sigmas) * 24 + 8 * 3 + 4)
+    tile_size = tiling.tile_shape(tiling.get_block_size(template_raster_path), bytes_per_pixel, memory_budget, full_window[2])
+
+    for tile in tiling.tile_windows(full_window, tile_size):
+        # Tiles with no pairs in them are left out of the outputs. The counts read back as 0 and the percents as
+        # PERCENT_NODATA, the same as if they'd been written.
+        if all(raster_grid.intersect_windows(window, tile) is None for window in line_windows):
+            continue
+        means, valid, ranges = stack_tile(line_paths, line_windows, tile, sigmas)
+        counts, pairs = count_pairs(means, valid, ranges)
+        if not pairs.any():
+            continue
+
+        shape = (tile[3], tile[2])
+        path_counts.GetRasterBand(1).WriteArray(pairs.reshape(shape).astype(np.int32), tile[0], tile[1])
+        for count, true_count, percent in zip(counts, true_counts, percents):
+            true_count.GetRasterBand(1).WriteArray(count.reshape(shape).astype(np.int32), tile[0], tile[1])
+
+            tile_percent = np.full(count.shape, PERCENT_NODATA, dtype=np.float32)
+            np.divide(count, pairs, out=tile_percent, where=pairs > 0, casting='unsafe')
+            percent.GetRasterBand(1).WriteArray(tile_percent.reshape(shape), tile[0], tile[1])
+
+    true_counts = None
+    percents = None
+    path_counts = None
+    return
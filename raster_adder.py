@@ -1,13 +1,15 @@
 import os
 import arcpy
-from stdev_rangefinder import get_date, check_stdev_range
+from stdev_rangefinder import check_stdev_range
+from line_names import pair_name
+from footprint_index import overlapping_pairs
+import instrument
+import arcpy_env
 from arcpy.sa import *
 from arcpy import env
 import tempfile
 import shutil
 import time
-arcpy.CheckOutExtension("Spatial")
-env.overwriteOutput = True
 __author__ = 'Steve Kochaver'
 
 
@@ -24,6 +26,7 @@ def make_it_big(small_raster_path, big_raster_path):
     :param small_raster: The raster with the extent that's smaller than the one you want to add it to.
     :return: Returns the Raster object
     '''
+    arcpy_env.setup()
     name, ext = os.path.splitext(big_raster_path)
     temp_raster = name + '-temp' + ext
 
@@ -40,6 +43,7 @@ def make_it_big(small_raster_path, big_raster_path):
 
 def add_small_rasters(small_directory, template_raster_path, final_raster_path):
 
+    arcpy_env.setup()
     env.mask = template_raster_path
     env.extent = template_raster_path
     env.snapRaster = template_raster_path
@@ -61,20 +65,23 @@ def add_small_rasters(small_directory, template_raster_path, final_raster_path):
 
 def total_intersection(in_raster_dir, template_raster_path, final_raster_path):
 
+    arcpy_env.setup()
     temp_dir_1 = tempfile.mkdtemp()
     temp_dir_2 = tempfile.mkdtemp()
 
     meaningful_files = get_files_of_ext(in_raster_dir, '.bsq')
-    remaining_files = meaningful_files[:]
-
-    for raster_file in meaningful_files:
-        remaining_files.remove(raster_file)
-        for compare_file in remaining_files:
-            output_path = os.path.join(temp_dir_1, get_date(raster_file) + '_TO_' + get_date(compare_file) + '.tif')
-            try:
-                check_stdev_range(raster_file, compare_file, output_path, template_raster_path)
-            except:
-                pass
+
+    # Pairs whose extents don't overlap would only fail in check_stdev_range so they're never tried.
+    for raster_file, compare_file in overlapping_pairs(meaningful_files):
+        output_path = os.path.join(temp_dir_1, pair_name(raster_file, compare_file) + '.tif')
+        instrument.start_pair(raster_file, compare_file)
+        error = None
+        try:
+            check_stdev_range(raster_file, compare_file, output_path, template_raster_path)
+        except Exception as e:
+            # Pairs with no data in common fail here and are meant to, but say so rather than losing them.
+            error = '%s: %s' % (type(e).__name__, e)
+        instrument.log_pair(instrument.finish_pair(error))
 
     for image in get_files_of_ext(temp_dir_1, '.tif'):
         image_name = os.path.basename(image)
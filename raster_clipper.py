@@ -1,9 +1,9 @@
 import os
 import arcpy
 from arcpy.sa import *
+import arcpy_env
 
 __author__ = 'Steve Kochaver'
-arcpy.CheckOutExtension('Spatial')
 
 
 def get_band_list(raster):
@@ -38,6 +38,7 @@ def custom_nodata(rlist):
     :param rlist:
     :return: Returns raster object in memory
     '''
+    arcpy_env.setup()
     val_1 = 2.1812543869018555  # Plus 1.96
     val_2 = 1.8875709772109985  # Plus StDev
     val_3 = 1.581650972366333   # Mean
@@ -63,6 +64,7 @@ def raster_to_polygon(raster_path, output_path):
     :param output_path: The path to where you want the output to go.
     :return:
     '''
+    arcpy_env.setup()
     raster = Raster(raster_path)
     mask_raster = Con((raster == 0) | (raster == 1), 1, 0)
     arcpy.RasterToPolygon_conversion(mask_raster, output_path, "NO_SIMPLIFY")
@@ -75,6 +77,7 @@ def raster_obj_to_polygon(raster_obj, output_path):
     :param output_path: The path to where you want the output to go.
     :return:
     '''
+    arcpy_env.setup()
     raster = raster_obj
     mask_raster = Con((raster == 0) | (raster == 1), 1, 0)
     arcpy.RasterToPolygon_conversion(mask_raster, output_path, "NO_SIMPLIFY")
@@ -0,0 +1,215 @@
+import os
+import gdal
+from collections import namedtuple
+
+gdal.UseExceptions()
+__author__ = 'Steve Kochaver'
+
+# Everything GDAL needs to know to put pixels in the right place. Rotated geotransforms aren't supported, none of the
+# AVIRIS products we work with have them.
+Grid = namedtuple('Grid', ['geotransform', 'projection', 'cols', 'rows'])
+
+# How far apart two cell sizes can be (as a fraction of the cell size) and still count as the same grid.
+CELL_TOLERANCE = 1e-6
+
+# SPARSE_OK leaves blocks nothing was written to out of the file altogether. They read back as the band's NoData value,
+# or 0 if it has none, so an output only costs disk for the tiles that actually got data.
+CREATION_OPTIONS = ['COMPRESS=LZW', 'TILED=YES', 'SPARSE_OK=TRUE']
+
+
+def grid_from_dataset(dataset):
+    '''
+    Pulls the grid definition out of an open GDAL dataset.
+    :param dataset: The GDAL dataset.
+    :return: Grid namedtuple.
+    '''
+    return Grid(dataset.GetGeoTransform(), dataset.GetProjection(), dataset.RasterXSize, dataset.RasterYSize)
+
+
+def get_grid(raster_path):
+    '''
+    Opens a raster just long enough to read its grid definition.
+    :param raster_path: The path to the raster dataset.
+    :return: Grid namedtuple.
+    '''
+    dataset = gdal.Open(raster_path)
+    grid = grid_from_dataset(dataset)
+    dataset = None
+    return grid
+
+
+def window_in(grid, ref_grid):
+    '''
+    Finds where a raster sits on the pixels of a reference grid (usually the template raster). The offset is rounded to
+    the nearest whole pixel which is the same thing env.snapRaster does for us on the arcpy side.
+    :param grid: The Grid of the raster you want to place.
+    :param ref_grid: The Grid you want to place it on.
+    :return: Window tuple (xoff, yoff, cols, rows) in reference grid pixels. Offsets can be negative.
+    '''
+    gt = grid.geotransform
+    ref_gt = ref_grid.geotransform
+
+    if abs(gt[1] - ref_gt[1]) > CELL_TOLERANCE * abs(ref_gt[1]) or abs(gt[5] - ref_gt[5]) > CELL_TOLERANCE * abs(ref_gt[5]):
+        raise ValueError('Cell size %s x %s does not match the reference grid (%s x %s)' % (gt[1], gt[5], ref_gt[1], ref_gt[5]))
+
+    xoff = int(round((gt[0] - ref_gt[0]) / ref_gt[1]))
+    yoff = int(round((gt[3] - ref_gt[3]) / ref_gt[5]))
+
+    return xoff, yoff, grid.cols, grid.rows
+
+
+def intersect_windows(window_1, window_2):
+    '''
+    The overlapping part of two windows that are on the same grid.
+    :param window_1: Window tuple (xoff, yoff, cols, rows).
+    :param window_2: Window tuple (xoff, yoff, cols, rows).
+    :return: The window they share or None if they don't touch.
+    '''
+    x_min = max(window_1[0], window_2[0])
+    y_min = max(window_1[1], window_2[1])
+    x_max = min(window_1[0] + window_1[2], window_2[0] + window_2[2])
+    y_max = min(window_1[1] + window_1[3], window_2[1] + window_2[3])
+
+    if x_max <= x_min or y_max <= y_min:
+        return None
+
+    return x_min, y_min, x_max - x_min, y_max - y_min
+
+
+def union_windows(window_1, window_2):
+    '''
+    The smallest window holding both windows. Either one can be None.
+    :param window_1: Window tuple (xoff, yoff, cols, rows) or None.
+    :param window_2: Window tuple (xoff, yoff, cols, rows) or None.
+    :return: Window tuple or None if both were None.
+    '''
+    if window_1 is None:
+        return window_2
+    if window_2 is None:
+        return window_1
+
+    x_min = min(window_1[0], window_2[0])
+    y_min = min(window_1[1], window_2[1])
+    x_max = max(window_1[0] + window_1[2], window_2[0] + window_2[2])
+    y_max = max(window_1[1] + window_1[3], window_2[1] + window_2[3])
+
+    return x_min, y_min, x_max - x_min, y_max - y_min
+
+
+def relative_window(window, outer_window):
+    '''
+    Moves a window so its offsets are counted from the corner of another window rather than the grid origin. Handy
+    for turning a window on the template into a window you can hand to ReadAsArray on a single raster.
+    :param window: The window you want to move.
+    :param outer_window: The window whose upper left corner becomes the new origin.
+    :return: Window tuple.
+    '''
+    return window[0] - outer_window[0], window[1] - outer_window[1], window[2], window[3]
+
+
+def window_slices(window):
+    '''
+    Numpy slices for a window so you can do array[window_slices(window)].
+    :param window: Window tuple (xoff, yoff, cols, rows).
+    :return: Tuple of (row slice, column slice).
+    '''
+    return slice(window[1], window[1] + window[3]), slice(window[0], window[0] + window[2])
+
+
+def window_geotransform(ref_grid, window):
+    '''
+    The geotransform of a window cut out of a grid.
+    :param ref_grid: The Grid the window is on.
+    :param window: Window tuple (xoff, yoff, cols, rows).
+    :return: GDAL geotransform tuple.
+    '''
+    gt = ref_grid.geotransform
+    return gt[0] + window[0] * gt[1], gt[1], gt[2], gt[3] + window[1] * gt[5], gt[4], gt[5]
+
+
+def covering_grid(grids):
+    '''
+    The smallest grid holding every one of a list of grids, on the pixels of the first one.
+    :param grids: List of Grids with the same cell size.
+    :return: Grid namedtuple.
+    '''
+    ref_grid = grids[0]
+    window = None
+    for grid in grids:
+        window = union_windows(window, window_in(grid, ref_grid))
+
+    return Grid(window_geotransform(ref_grid, window), ref_grid.projection, window[2], window[3])
+
+
+def mask_bounds(mask):
+    '''
+    The smallest window that holds every True pixel of a 2D boolean array.
+    :param mask: The boolean numpy array.
+    :return: Window tuple relative to the array or None if there are no True pixels.
+    '''
+    rows = mask.any(axis=1).nonzero()[0]
+    if rows.size == 0:
+        return None
+    cols = mask.any(axis=0).nonzero()[0]
+
+    return int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1)
+
+
+def create_raster(out_path, ref_grid, window, data_type=gdal.GDT_Byte, no_data=None):
+    '''
+    Creates an empty single band GeoTIFF placed at a window of a reference grid. Use this when the output has to be
+    written a piece at a time, otherwise write_window is simpler.
+    :param out_path: The path to the output .tif.
+    :param ref_grid: The Grid the window is on (the template grid in most cases).
+    :param window: Window tuple (xoff, yoff, cols, rows).
+    :param data_type: GDAL data type of the output.
+    :param no_data: The NoData value for the band. None leaves it unset.
+    :return: The open GDAL dataset. Set it to None when you're done writing.
+    '''
+    driver = gdal.GetDriverByName('GTiff')
+    out_raster = driver.Create(out_path, window[2], window[3], 1, data_type, CREATION_OPTIONS)
+    out_raster.SetProjection(ref_grid.projection)
+    out_raster.SetGeoTransform(window_geotransform(ref_grid, window))
+
+    if no_data is not None:
+        out_raster.GetRasterBand(1).SetNoDataValue(no_data)
+
+    return out_raster
+
+
+def write_window(out_path, array, ref_grid, window, data_type=gdal.GDT_Byte, no_data=None):
+    '''
+    Writes a 2D array to a single band GeoTIFF placed at a window of a reference grid.
+    :param out_path: The path to the output .tif.
+    :param array: The 2D numpy array. Should be the same shape as the window.
+    :param ref_grid: The Grid the window is on (the template grid in most cases).
+    :param window: Window tuple (xoff, yoff, cols, rows).
+    :param data_type: GDAL data type of the output.
+    :param no_data: The NoData value for the band. None leaves it unset.
+    :return:
+    '''
+    out_raster = create_raster(out_path, ref_grid, window, data_type, no_data)
+    out_raster.GetRasterBand(1).WriteArray(array)
+    out_raster = None
+    return
+
+
+def save_template(out_path, grid, data_type=gdal.GDT_Int32):
+    '''
+    Saves a template raster without filling it in. A .vrt path gets a VRT with no sources, which is a few hundred bytes
+    of XML and reads as all 0. Anything else gets a sparse tiled GeoTIFF that's just as empty on disk but can be opened
+    for update, so use that for a raster footprints get burned into.
+    :param out_path: The path to the template, .vrt or .tif.
+    :param grid: The Grid of the template.
+    :param data_type: GDAL data type of the template.
+    :return:
+    '''
+    full_window = (0, 0, grid.cols, grid.rows)
+    if os.path.splitext(out_path)[1].lower() == '.vrt':
+        out_raster = gdal.GetDriverByName('VRT').Create(out_path, grid.cols, grid.rows, 1, data_type)
+        out_raster.SetProjection(grid.projection)
+        out_raster.SetGeoTransform(grid.geotransform)
+    else:
+        out_raster = create_raster(out_path, grid, full_window, data_type)
+    out_raster = None
+    return
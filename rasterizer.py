@@ -2,6 +2,8 @@ import ogr
 import gdal
 from gdalconst import *
 import os
+import raster_grid
+import tiling
 
 gdal.UseExceptions()
 __author__ = 'Steve Kochaver'
@@ -28,15 +30,15 @@ def template_raster(base_raster_path, out_raster, data_type=gdal.GDT_Int32, no_d
     # bands = base_raster.RasterCount
     bands = 1
 
+    # Sparse, so the zeros are never actually written. Blocks nobody writes to read back as 0 and take up no space.
     driver = gdal.GetDriverByName("GTIFF")
-    new_raster = driver.Create(out_raster, cols, rows, bands, data_type)
+    new_raster = driver.Create(out_raster, cols, rows, bands, data_type, raster_grid.CREATION_OPTIONS)
     new_raster.SetProjection(projection)
     new_raster.SetGeoTransform(geotransform)
 
     for i in range(bands):
         new_raster.GetRasterBand(i + 1).SetNoDataValue(None)  # Change these zeros if there is important data in base data or params
         # new_raster.GetRasterBand(i + 1).SetNoDataValue(no_data)  # If you want to implement a no data value uncomment this line
-        new_raster.GetRasterBand(i + 1).Fill(0)   # Change these zeros if there is important data in base data or params
 
     return new_raster
 
@@ -66,6 +68,56 @@ def add_to_raster(base_raster, shape_file):
 
     return
 
+def burn_many(base_raster, vector_sources, add=True, cache_max=None, num_threads='ALL_CPUS', progress=None):
+    '''
+    add_to_raster (or burn_without_add) for a whole stack of shapefiles at once. The base raster is opened and flushed
+    a single time instead of once per shapefile, so burning hundreds of footprints costs about one raster write.
+    :param base_raster: The path to the raster to burn into.
+    :param vector_sources: List of .shp paths and/or OGR layers (in-memory ones are fine).
+    :param add: True adds 1 to touched pixels (MERGE_ALG=ADD), False sets them to 1 like burn_without_add.
+    :param cache_max: GDAL block cache size in bytes while burning. Big enough to hold the raster means nothing gets
+    written until the end. Defaults to the size of the raster, up to tiling.DEFAULT_MEMORY_BUDGET so a huge template
+    doesn't take gigabytes of cache. Past that blocks get flushed along the way.
+    :param num_threads: Threads GDAL can use for (de)compressing blocks, passed through as GDAL_NUM_THREADS.
+    :param progress: Optional function called as progress(done, total, source) after each source is burned.
+    :return: Doesn't return anything either.
+    '''
+    options = ['ALL_TOUCHED=TRUE', 'MERGE_ALG=ADD'] if add else ['ALL_TOUCHED=TRUE']
+
+    old_cache_max = gdal.GetCacheMax()
+    old_num_threads = gdal.GetConfigOption('GDAL_NUM_THREADS')
+
+    add_out = gdal.Open(base_raster, GA_Update)
+    if cache_max is None:
+        band = add_out.GetRasterBand(1)
+        cache_max = min(add_out.RasterXSize * add_out.RasterYSize * gdal.GetDataTypeSize(band.DataType) // 8,
+                        tiling.DEFAULT_MEMORY_BUDGET)
+        band = None
+    gdal.SetCacheMax(max(cache_max, old_cache_max))
+    gdal.SetConfigOption('GDAL_NUM_THREADS', num_threads)
+
+    try:
+        for i, source in enumerate(vector_sources):
+            if isinstance(source, ogr.Layer):
+                vector, layer = None, source
+            else:
+                vector = ogr.Open(source)
+                layer = vector.GetLayer()
+
+            gdal.RasterizeLayer(add_out, [1], layer, burn_values=[1], options=options)
+
+            layer = None
+            vector = None
+            if progress is not None:
+                progress(i + 1, len(vector_sources), source)
+    finally:
+        # The one and only flush.
+        add_out = None
+        gdal.SetCacheMax(old_cache_max)
+        gdal.SetConfigOption('GDAL_NUM_THREADS', old_num_threads)
+
+    return
+
 def create_out_tiff(in_file, out_file, initial_shp):
     '''
     This function is another attempt at creating a template raster file from an existing raster to define the raster
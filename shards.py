@@ -0,0 +1,356 @@
+import os
+import json
+import time
+import zlib
+import socket
+import hashlib
+import raster_grid
+import gdal_rangefinder
+import gdal_adder
+import manifest
+import instrument
+from line_names import pair_name
+
+__author__ = 'Steve Kochaver'
+
+# Splits the pair comparisons of an analysis into K shards that can run on any number of machines sharing a file
+# system. Everything goes through a work directory:
+#
+#   plan.json               the flight lines, pairs, shard of every pair and where the final outputs go
+#   shard_003.lock          held by whoever is running shard 3, touched after every pair so it doesn't go stale
+#   shard_003/              shard 3's partial true counts (one per sigma) and intersection count, on the template grid
+#   shard_003.done.json     written last, so a shard only counts as done once all its partials are in place
+#
+# Pairs go to shards by a hash of their name, so every node works out the same split and a pair keeps its shard when
+# lines are added. A shard never writes pair rasters, each pair is compared in memory and added straight into the
+# shard's counts. Running a shard that's already done does nothing, and a shard that died part way is just run again
+# from the start since its partials are only renamed into place at the end. A pair that fails for a reason that may
+# not happen again (manifest.PERMANENT_ERRORS being the ones that will) is listed in the done marker and left out of
+# the partials, and running the shard again compares just those pairs into them. merge sums the partials into the
+# usual _true_count and _percent rasters.
+#
+# A running shard holds its counts in memory: len(sigmas) + 1 Int32 arrays the size of the template, so 12 bytes a
+# template pixel with the default two sigmas. Size the number of workers per node by that, not by the core count.
+
+PLAN_NAME = 'plan.json'
+STALE_SECONDS = 30 * 60
+INT_COUNT_LABEL = 'int_count'
+
+
+def shard_of(name, shard_count):
+    '''
+    Which shard a pair belongs to. Depends only on the pair's name, not on the other pairs or the machine.
+    :param name: The pair name, e.g. '140612_03_TO_140708_05'.
+    :param shard_count: How many shards there are.
+    :return: Shard number from 0 to shard_count - 1.
+    '''
+    return (zlib.crc32(name.encode('utf-8')) & 0xffffffff) % shard_count
+
+
+def make_plan(work_directory, line_paths, pairs, template_raster_path, sigma_labels, outputs, int_count_path,
+              shard_count):
+    '''
+    Writes the plan every node works from. Making it again with the same inputs gives the same plan, so shards already
+    done stay done, while a changed flight line changes the plan id and makes every shard run again.
+    :param work_directory: The shared work directory. Made if it isn't there.
+    :param line_paths: The flight lines.
+    :param pairs: List of (raster_file, compare_file) to compare, e.g. from overlapping_pairs.
+    :param template_raster_path: The template raster defining the output grid.
+    :param sigma_labels: Dictionary of {sigma: label}, e.g. {1: 'stdev', 1.96: '196stdev'}.
+    :param outputs: Dictionary of {label: (true count path, percent path)} for merge to write.
+    :param int_count_path: Where merge writes the summed intersection count, which the percents are divided by.
+    :param shard_count: How many shards to split the pairs into.
+    :return: The plan dictionary.
+    '''
+    if not os.path.exists(work_directory):
+        os.makedirs(work_directory)
+
+    signatures = manifest.input_signatures(line_paths, manifest.new_manifest())
+    shards = [[] for i in range(shard_count)]
+    for raster_file, compare_file in pairs:
+        name = pair_name(raster_file, compare_file)
+        shards[shard_of(name, shard_count)].append([name, raster_file, compare_file])
+
+    plan = {'template': template_raster_path,
+            'sigmas': sorted([sigma, label] for sigma, label in sigma_labels.items()),
+            'outputs': dict((label, list(paths)) for label, paths in outputs.items()),
+            'int_count': int_count_path,
+            'signatures': signatures,
+            'shards': shards}
+    plan['id'] = hashlib.sha1(json.dumps(plan, sort_keys=True).encode('utf-8')).hexdigest()
+
+    manifest.save_manifest(plan, os.path.join(work_directory, PLAN_NAME))
+    return plan
+
+
+def load_plan(work_directory):
+    with open(os.path.join(work_directory, PLAN_NAME)) as f:
+        return json.load(f)
+
+
+def shard_directory(work_directory, shard):
+    return os.path.join(work_directory, 'shard_%03d' % shard)
+
+
+def read_done(work_directory, plan, shard):
+    '''
+    A shard's done marker, if its partials are all there and were made from this plan.
+    :param work_directory: The shared work directory.
+    :param plan: The plan dictionary.
+    :param shard: The shard number.
+    :return: Dictionary with the plan id, partial paths, pair count and {pair name: error} of the failed pairs, or None.
+    '''
+    done_path = shard_directory(work_directory, shard) + '.done.json'
+    if not os.path.exists(done_path):
+        return None
+    with open(done_path) as f:
+        done = json.load(f)
+    if done['plan'] != plan['id'] or not all(os.path.exists(path) for path in done['partials'].values()):
+        return None
+    return done
+
+
+def shard_is_done(work_directory, plan, shard):
+    '''
+    Whether a shard's partials are all there and were made from this plan. Pairs that failed may still be left out.
+    :param work_directory: The shared work directory.
+    :param plan: The plan dictionary.
+    :param shard: The shard number.
+    :return: Boolean.
+    '''
+    return read_done(work_directory, plan, shard) is not None
+
+
+def holds_shard(work_directory, shard):
+    '''
+    Whether this process is the one whose lock is on a shard.
+    :param work_directory: The shared work directory.
+    :param shard: The shard number.
+    :return: Boolean.
+    '''
+    try:
+        with open(shard_directory(work_directory, shard) + '.lock') as f:
+            lock = json.load(f)
+    except (IOError, OSError, ValueError):
+        return False
+    return lock.get('host') == socket.gethostname() and lock.get('pid') == os.getpid()
+
+
+def take_stale_lock(lock_path, stale_seconds):
+    '''
+    Moves an abandoned lock out of the way. Renaming is atomic, so when several nodes find the same stale lock only one
+    of them gets to move it. A node that moved a lock somebody has only just made (because the stale one was taken
+    over between its looking and its renaming) puts it back.
+    :param lock_path: The shard's lock file.
+    :param stale_seconds: How old a lock has to be before it's considered abandoned.
+    :return: True if the lock is gone and can be claimed.
+    '''
+    try:
+        if time.time() - os.path.getmtime(lock_path) < stale_seconds:
+            return False
+    except OSError:
+        return True  # Released in the meantime.
+
+    moved_path = '%s.%s.%d.stale' % (lock_path, socket.gethostname(), os.getpid())
+    try:
+        os.rename(lock_path, moved_path)
+    except OSError:
+        return False  # Somebody else moved it first.
+
+    if time.time() - os.path.getmtime(moved_path) < stale_seconds:
+        try:
+            os.rename(moved_path, lock_path)
+        except OSError:
+            os.remove(moved_path)
+        return False
+    os.remove(moved_path)
+    return True
+
+
+def claim_shard(work_directory, shard, stale_seconds=STALE_SECONDS):
+    '''
+    Takes the lock on a shard. Creating the lock file is atomic even on most network file systems, so only one node
+    gets it. A lock nobody has touched for stale_seconds belonged to a node that died and is taken over.
+    :param work_directory: The shared work directory.
+    :param shard: The shard number.
+    :param stale_seconds: How old a lock has to be before it's considered abandoned.
+    :return: True if this process now holds the shard.
+    '''
+    lock_path = shard_directory(work_directory, shard) + '.lock'
+    for attempt in range(2):
+        try:
+            handle = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            if not take_stale_lock(lock_path, stale_seconds):
+                return False
+            continue
+
+        os.write(handle, json.dumps({'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}).encode('utf-8'))
+        os.close(handle)
+        return True
+    return False
+
+
+def release_shard(work_directory, shard):
+    '''
+    Removes the lock on a shard, as long as it's still this process's.
+    :param work_directory: The shared work directory.
+    :param shard: The shard number.
+    :return:
+    '''
+    if holds_shard(work_directory, shard):
+        os.remove(shard_directory(work_directory, shard) + '.lock')
+    return
+
+
+def add_pair(counts, int_counts, raster_file, compare_file, template_raster_path, sigmas):
+    '''
+    Compares one pair in memory and adds it into the shard's counts, the same as summing its check_ranges outputs.
+    :param counts: Dictionary of {sigma: count array}.
+    :param int_counts: The intersection count array.
+    :param raster_file: The path to raster 1 (mean raster).
+    :param compare_file: The path to raster 2 (range raster).
+    :param template_raster_path: The template raster.
+    :param sigmas: The sigmas to count.
+    :return:
+    '''
+    ref_grid, window, bands_1, bands_2, mask = gdal_rangefinder.load_pair(raster_file, compare_file, template_raster_path)
+    slices = raster_grid.window_slices(window)
+
+    # Everything's compared before anything's added, so a pair that fails adds nothing at all.
+    values = dict((sigma, gdal_rangefinder.in_range(bands_1, bands_2, sigma)) for sigma in sigmas)
+    with instrument.stage('accumulate'):
+        int_counts[slices] += mask
+        for sigma in sigmas:
+            counts[sigma][slices] += (values[sigma] == 1) & mask
+    return
+
+
+def run_shard(work_directory, shard, stale_seconds=STALE_SECONDS):
+    '''
+    Runs one shard if it isn't done and nobody else has it.
+    :param work_directory: The shared work directory with a plan in it.
+    :param shard: The shard number.
+    :param stale_seconds: How old someone else's lock has to be before it's taken over.
+    :return: 'done' if it was already done, 'busy' if another node has it (or took it over part way), 'ran' if it was
+    run here, 'failed' if it was run here but some pairs failed and are worth running it again for.
+    '''
+    plan = load_plan(work_directory)
+    done = read_done(work_directory, plan, shard)
+    if done is not None and not done.get('failed'):
+        return 'done'
+    if not claim_shard(work_directory, shard, stale_seconds):
+        return 'busy'
+
+    try:
+        template_grid = raster_grid.get_grid(plan['template'])
+        sigmas = [sigma for sigma, label in plan['sigmas']]
+        lock_path = shard_directory(work_directory, shard) + '.lock'
+        done_path = shard_directory(work_directory, shard) + '.done.json'
+
+        # Looked at again now it's held, another node may have finished it in the meantime.
+        done = read_done(work_directory, plan, shard)
+        if done is None:
+            pairs = plan['shards'][shard]
+            counts = dict((sigma, gdal_adder.new_count_array(template_grid)) for sigma in sigmas)
+            int_counts = gdal_adder.new_count_array(template_grid)
+        elif done.get('failed'):
+            # Only the pairs that failed last time, added into the partials the rest made. The marker goes first so
+            # dying part way through the rewrite means a fresh run rather than these pairs being added twice.
+            pairs = [pair for pair in plan['shards'][shard] if pair[0] in done['failed']]
+            counts = dict((sigma, gdal_adder.load_counts(done['partials'][label])) for sigma, label in plan['sigmas'])
+            int_counts = gdal_adder.load_counts(done['partials'][INT_COUNT_LABEL])
+            os.remove(done_path)
+        else:
+            return 'done'
+
+        failed = {}
+        for name, raster_file, compare_file in pairs:
+            instrument.start_pair(raster_file, compare_file)
+            error = None
+            try:
+                add_pair(counts, int_counts, raster_file, compare_file, plan['template'], sigmas)
+            except Exception as e:
+                # No data in common would add nothing to the counts anyway. Anything else (a read failing on the
+                # network share, say) is recorded so running the shard again retries it.
+                error = '%s: %s' % (type(e).__name__, e)
+                if type(e).__name__ not in manifest.PERMANENT_ERRORS:
+                    failed[name] = error
+            instrument.log_pair(instrument.finish_pair(error))
+            try:
+                os.utime(lock_path, None)
+            except OSError:
+                pass  # Taken over and released by another node, found out by holds_shard before anything's written.
+
+        out_directory = shard_directory(work_directory, shard)
+        if not os.path.exists(out_directory):
+            os.makedirs(out_directory)
+
+        partials = dict((label, os.path.join(out_directory, label + '_true_count.tif')) for sigma, label in plan['sigmas'])
+        partials[INT_COUNT_LABEL] = os.path.join(out_directory, INT_COUNT_LABEL + '.tif')
+        arrays = dict((label, counts[sigma]) for sigma, label in plan['sigmas'])
+        arrays[INT_COUNT_LABEL] = int_counts
+
+        # If the lock was taken over while this ran (a node that stalled longer than stale_seconds), the new holder
+        # is doing the shard and these counts are thrown away rather than written over its partials.
+        if not holds_shard(work_directory, shard):
+            return 'busy'
+
+        # Partials go down under temporary names and are renamed into place, then the done marker last of all.
+        for label, partial_path in partials.items():
+            temp_path = partial_path + '.tmp.tif'
+            gdal_adder.save_counts(arrays[label], template_grid, temp_path)
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            os.rename(temp_path, partial_path)
+
+        manifest.save_manifest({'plan': plan['id'], 'partials': partials, 'pairs': len(plan['shards'][shard]),
+                                'failed': failed}, done_path)
+    finally:
+        release_shard(work_directory, shard)
+    return 'failed' if failed else 'ran'
+
+
+def run_shards(work_directory, shards=None, stale_seconds=STALE_SECONDS):
+    '''
+    Works through shards until there's nothing left this process can take, like a worker pulling from a queue. Start
+    a few of these on every node and they'll share the shards out between them. Each holds (len(sigmas) + 1) * 4
+    bytes per template pixel while it runs a shard, so start only as many as fit in memory.
+    :param work_directory: The shared work directory with a plan in it.
+    :param shards: The shard numbers to try, every shard in the plan if None.
+    :param stale_seconds: How old someone else's lock has to be before it's taken over.
+    :return: Dictionary of {shard: 'done', 'busy', 'ran' or 'failed'}.
+    '''
+    if shards is None:
+        shards = range(len(load_plan(work_directory)['shards']))
+    return dict((shard, run_shard(work_directory, shard, stale_seconds)) for shard in shards)
+
+
+def merge(work_directory):
+    '''
+    Sums every shard's partials into the final true count, intersection count and percent rasters. Pairs that failed
+    in their shard are printed and left out, run the shards again first to retry them.
+    :param work_directory: The shared work directory.
+    :return:
+    '''
+    plan = load_plan(work_directory)
+    dones = [read_done(work_directory, plan, shard) for shard in range(len(plan['shards']))]
+    unfinished = [shard for shard, done in enumerate(dones) if done is None]
+    if unfinished:
+        raise RuntimeError('Shards %s are not done yet' % ', '.join(str(shard) for shard in unfinished))
+    for shard, done in enumerate(dones):
+        for name, error in sorted(done.get('failed', {}).items()):
+            print('shard %d: %s left out, %s' % (shard, name, error))
+
+    labels = [label for sigma, label in plan['sigmas']] + [INT_COUNT_LABEL]
+    final_paths = dict((label, paths[0]) for label, paths in plan['outputs'].items())
+    final_paths[INT_COUNT_LABEL] = plan['int_count']
+
+    for label in labels:
+        partials = [os.path.join(shard_directory(work_directory, shard), label + ('.tif' if label == INT_COUNT_LABEL else '_true_count.tif'))
+                    for shard in range(len(plan['shards']))]
+        gdal_adder.add_raster_list(partials, plan['template'], final_paths[label])
+
+    for label, (true_count_path, per_raster_path) in plan['outputs'].items():
+        gdal_adder.percent_raster(true_count_path, plan['int_count'], per_raster_path)
+    return
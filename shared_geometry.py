@@ -0,0 +1,198 @@
+import numpy as np
+import gdal
+import raster_grid
+import tiling
+import gdal_rangefinder
+import gdal_adder
+import pair_pipeline
+import instrument
+from line_names import get_date
+from footprint_index import overlapping_pairs
+
+__author__ = 'Steve Kochaver'
+
+# N, LMA and LIG are the same flight lines with the same footprints, so a pair overlaps in the same place and has data
+# in the same pixels whichever variable you look at. Rather than three runs that each work out every pair's overlap
+# window, intersection mask and path count, the pair geometry is worked out once from the first variable and the range
+# tests for every variable are done against it:
+#
+#   per pair    the overlap window and intersection mask of the first variable's lines, then the bands of every
+#               variable read for that one window
+#   per run     one path count, plus a true count and percent for every variable and sigma
+#
+# Lines are matched between variables by their line name (get_date). The other variables are checked to sit on the
+# template in the same place as the first, but their masks aren't worked out, the first variable's stands in for all
+# of them. Pairs go through pair_pipeline so the reads overlap the comparisons. The counts (an Int32 array per variable
+# and sigma plus the path count, 28 bytes a pixel for N, LMA and LIG at two sigmas) are held for as much of the
+# template as fits in the memory budget at a time, see count_variables.
+
+
+def match_lines(variable_lines):
+    '''
+    Lines the flight lines of several variables up by name.
+    :param variable_lines: List of (variable, list of line paths). The first variable's lines set the order.
+    :return: List of tuples with one path per variable, in the same order as variable_lines. Lines missing from any
+    variable are printed and left out.
+    '''
+    by_name = [dict((get_date(path), path) for path in paths) for variable, paths in variable_lines]
+
+    lines = []
+    for path in variable_lines[0][1]:
+        name = get_date(path)
+        missing = [variable for (variable, paths), names in zip(variable_lines, by_name) if name not in names]
+        if missing:
+            print('skipping ' + name + ', not in ' + ', '.join(missing))
+            continue
+        lines.append(tuple(names[name] for names in by_name))
+    return lines
+
+
+def line_pairs(lines):
+    '''
+    The overlapping pairs of matched lines, worked out from the first variable's footprints.
+    :param lines: List of line tuples from match_lines.
+    :return: List of (line 1 tuple, line 2 tuple).
+    '''
+    by_path = dict((line[0], line) for line in lines)
+    return [(by_path[raster_file], by_path[compare_file])
+            for raster_file, compare_file in overlapping_pairs([line[0] for line in lines])]
+
+
+def pair_geometry(line_1, line_2, template_raster_path):
+    '''
+    Where a pair of matched lines sits on the template, worked out from the first variable without reading any pixels.
+    :param line_1: Line tuple of raster 1 (mean raster).
+    :param line_2: Line tuple of raster 2 (range raster).
+    :param template_raster_path: The raster to snap to.
+    :return: Raster 1's window, raster 2's window and their overlap, all on the template grid.
+    '''
+    ref_grid, window_1, window_2, overlap = gdal_rangefinder.pair_windows(line_1[0], line_2[0], template_raster_path)
+    for line, window in ((line_1, window_1), (line_2, window_2)):
+        for path in line[1:]:
+            if raster_grid.window_in(gdal_rangefinder.get_grid(path), ref_grid) != window:
+                raise ValueError('%s is not in the same place as %s' % (path, line[0]))
+    return window_1, window_2, overlap
+
+
+def load_lines(task):
+    '''
+    The load function for run_pipeline. A task is (line 1 path, line 2 path, (line 1 tuple, line 2 tuple, window 1,
+    window 2, window to read)), the paths being the first variable's so the pair gets its usual name.
+    :param task: The task.
+    :return: The window read, the intersection mask and a (bands 1, bands 2) tuple per variable.
+    '''
+    line_1, line_2, window_1, window_2, window = task[2]
+    bands_1, bands_2, mask = gdal_rangefinder.read_pair_window(line_1[0], line_2[0], window_1, window_2, window)
+    bands = [(np.array(bands_1), np.array(bands_2))]
+
+    for path_1, path_2 in zip(line_1[1:], line_2[1:]):
+        pair = []
+        for path, line_window in ((path_1, window_1), (path_2, window_2)):
+            with instrument.stage('load'):
+                values = np.array(gdal_rangefinder.read_bands(path, raster_grid.relative_window(window, line_window)))
+            instrument.add_bytes(read=values.nbytes)
+            pair.append(values)
+        bands.append(tuple(pair))
+
+    return window, mask, bands
+
+
+def count_variables(pairs, template_raster_path, sigmas, true_count_paths, per_raster_paths, path_count_path,
+                    settings=pair_pipeline.DEFAULT_SETTINGS, memory_budget=tiling.DEFAULT_MEMORY_BUDGET):
+    '''
+    The true counts, percents and path count of every variable from one pass over the pairs. When the counts for the
+    whole template don't fit in the memory budget the template is split into areas that do, done one after another,
+    each reading only the parts of the pairs that fall in it.
+    :param pairs: List of (line 1 tuple, line 2 tuple) from line_pairs.
+    :param template_raster_path: The template raster defining the output grid.
+    :param sigmas: The standard deviation ranges to check.
+    :param true_count_paths: List with a {sigma: true count raster path} dictionary per variable, in line tuple order.
+    :param per_raster_paths: List with a {sigma: percent raster path} dictionary per variable, in line tuple order.
+    :param path_count_path: Where the number of pairs with data at each pixel goes (the path_counts raster).
+    :param settings: pair_pipeline.PipelineSettings.
+    :param memory_budget: Roughly how many bytes of count arrays to hold at once.
+    :return: Generator of (line 1 path, line 2 path, (line 1 tuple, line 2 tuple), error) tuples, the paths being the
+    first variable's, one per pair once it's been through every area or as soon as it fails. A pair that fails is left
+    out of the areas after the one it failed in, but the areas before have already been written with it. Its path
+    count and true counts go in together so the percents there still hold, they just include the pair. The rasters
+    are saved once it's used up.
+    '''
+    template_grid = raster_grid.get_grid(template_raster_path)
+    full_window = (0, 0, template_grid.cols, template_grid.rows)
+
+    # The geometry of every pair up front, so each area only takes the pairs that touch it.
+    geometries = []
+    for line_1, line_2 in pairs:
+        try:
+            geometries.append((line_1, line_2) + pair_geometry(line_1, line_2, template_raster_path))
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+            instrument.skip_pair(line_1[0], line_2[0], error)
+            yield line_1[0], line_2[0], (line_1, line_2), error
+
+    path_out = raster_grid.create_raster(path_count_path, template_grid, full_window, gdal.GDT_Int32)
+    true_outs = [dict((sigma, raster_grid.create_raster(paths[sigma], template_grid, full_window, gdal.GDT_Int32))
+                      for sigma in sigmas) for paths in true_count_paths]
+
+    bytes_per_pixel = 4 * (len(true_count_paths) * len(sigmas) + 1)
+    areas = list(tiling.tile_windows(full_window, tiling.tile_shape(tiling.get_block_size(template_raster_path),
+                                                                    bytes_per_pixel, memory_budget, full_window[2])))
+    areas_left = dict(((line_1, line_2), sum(1 for area in areas if raster_grid.intersect_windows(overlap, area)))
+                      for line_1, line_2, window_1, window_2, overlap in geometries)
+    failed = set()
+    for (line_1, line_2), left in areas_left.items():
+        if not left:
+            yield line_1[0], line_2[0], (line_1, line_2), None  # Off the template, nothing to add.
+
+    for area in areas:
+        tasks = []
+        for line_1, line_2, window_1, window_2, overlap in geometries:
+            window = raster_grid.intersect_windows(overlap, area)
+            if window is not None and (line_1, line_2) not in failed:
+                tasks.append((line_1[0], line_2[0], (line_1, line_2, window_1, window_2, window)))
+        if not tasks:
+            continue
+
+        shape = (area[3], area[2])
+        path_counts = np.zeros(shape, dtype=np.int32)
+        counts = [dict((sigma, np.zeros(shape, dtype=np.int32)) for sigma in sigmas) for paths in true_count_paths]
+
+        def compute(task, data):
+            window, mask, bands = data
+            slices = raster_grid.window_slices(raster_grid.relative_window(window, area))
+            with instrument.stage('accumulate'):
+                path_counts[slices] += mask
+            for variable_counts, (bands_1, bands_2) in zip(counts, bands):
+                for sigma in sigmas:
+                    values = gdal_rangefinder.in_range(bands_1, bands_2, sigma)
+                    with instrument.stage('accumulate'):
+                        variable_counts[sigma][slices] += (values == 1) & mask
+            return []
+
+        def write(task, result):
+            return
+
+        for raster_file, compare_file, target, error in pair_pipeline.run_pipeline(tasks, load_lines, compute, write,
+                                                                                    settings):
+            key = target[:2]
+            areas_left[key] -= 1
+            if error and key not in failed:
+                failed.add(key)
+                yield raster_file, compare_file, key, error
+            elif not areas_left[key] and key not in failed:
+                yield raster_file, compare_file, key, None
+
+        with instrument.stage('accumulate'):
+            written = gdal_adder.write_count_tiles(path_out.GetRasterBand(1), path_counts, area)
+            for variable_counts, variable_outs in zip(counts, true_outs):
+                for sigma in sigmas:
+                    written += gdal_adder.write_count_tiles(variable_outs[sigma].GetRasterBand(1), variable_counts[sigma], area)
+        instrument.add_bytes(written=written)
+
+    # Every dataset has to be closed (the loop above still holds the last variable's) so the counts are flushed before
+    # the percents read them back.
+    path_out = variable_outs = true_outs = None
+    for variable_true_paths, variable_per_paths in zip(true_count_paths, per_raster_paths):
+        for sigma in sigmas:
+            gdal_adder.percent_raster(variable_true_paths[sigma], path_count_path, variable_per_paths[sigma], memory_budget)
+    return
@@ -1,12 +1,15 @@
 import os
+import tempfile
+import numpy as np
 import arcpy
 from arcpy import env
 from arcpy.sa import *
 import raster_clipper
-import ntpath
+import raster_grid
+import instrument
+import arcpy_env
+from line_names import pair_name
 
-print 'Packages Loaded'
-env.overwriteOutput = True
 __author__ = 'Steve Kochaver'
 
 def remove_nodata(in_raster_path):
@@ -16,33 +19,72 @@ def remove_nodata(in_raster_path):
     :param in_raster_path: The path to the five band raster in question.
     :return: Returns and Arc Raster object with the new Null pixels.
     '''
+    arcpy_env.setup()
 
-    band_list = raster_clipper.get_band_list(in_raster_path)
-    rlist = raster_clipper.bands_to_raster_obj(in_raster_path, band_list)
-    in_raster = Raster(in_raster_path)
+    with instrument.stage('load'):
+        band_list = raster_clipper.get_band_list(in_raster_path)
+        rlist = raster_clipper.bands_to_raster_obj(in_raster_path, band_list)
+        in_raster = Raster(in_raster_path)
 
     #  Conditional statement finding pixels where all bands are 0 and sets to Null.
-    new_raster = SetNull(((rlist[0] == 0) & (rlist[1] == 0) & (rlist[2] == 0) & (rlist[3] == 0) & (rlist[4] == 0)), in_raster)
+    with instrument.stage('nodata_mask'):
+        new_raster = SetNull(((rlist[0] == 0) & (rlist[1] == 0) & (rlist[2] == 0) & (rlist[3] == 0) & (rlist[4] == 0)), in_raster)
 
     return new_raster
 
 def raster_intersection(raster_1_path, raster_2_path):
     '''
-    Given two rasters this function will find data-full intersection between them and create an unsimplified polygon (i.e. the
-    polygon will follow the exact edges of the pixels) of that intersection.
+    Given two rasters this function will find data-full intersection between them and keep it as a mask raster on the
+    snap grid. No polygon is made, the mask is applied to the outputs with a Con instead of a Clip.
     :param raster_1_path: The path to one of the raster datasets.
     :param raster_2_path: The path to the other raster.
-    :return: Returns and Arc polygon object as well as the path (in memory) to the shapefile containing that polygon.
+    :return: Returns an Arc Raster object that is 1 where both rasters have data and Null everywhere else.
     '''
     raster_1 = remove_nodata(raster_1_path)
     raster_2 = remove_nodata(raster_2_path)
 
-    rintersection = Con((raster_1 == True) & (raster_2 == True), 1, 0)
+    with instrument.stage('intersection'):
+        rintersection = Con(~IsNull(raster_1) & ~IsNull(raster_2), 1)
 
-    pmemory = 'in_memory//poly'
-    ext_poly = arcpy.RasterToPolygon_conversion(rintersection, pmemory, "NO_SIMPLIFY")
+    return rintersection
 
-    return ext_poly, pmemory
+def mask_extent(mask_raster):
+    '''
+    The extent of the cells where a mask raster has data, which is what the old clipping polygon's extent was. The
+    mask's own extent covers all of both rasters' overlap, NoData margins and all.
+    :param mask_raster: The intersection mask from raster_intersection.
+    :return: Arc Extent object.
+    '''
+    has_data = arcpy.RasterToNumPyArray(mask_raster, nodata_to_value=0) == 1
+    rows = np.flatnonzero(has_data.any(axis=1))
+    cols = np.flatnonzero(has_data.any(axis=0))
+    if not len(rows):
+        raise RuntimeError('The rasters have no data in common')
+
+    cell_width, cell_height = mask_raster.meanCellWidth, mask_raster.meanCellHeight
+    x_min = mask_raster.extent.XMin + cols[0] * cell_width
+    y_max = mask_raster.extent.YMax - rows[0] * cell_height
+    return Extent(x_min, y_max - (rows[-1] + 1 - rows[0]) * cell_height,
+                  x_min + (cols[-1] + 1 - cols[0]) * cell_width, y_max)
+
+def mask_to_output(in_range_raster, mask_raster, con_raster_path):
+    '''
+    Stands in for the old Clip_management call. Keeps the values of in_range_raster under the mask and saves them as
+    an 8 bit raster with 255 as NoData, trimmed to where the mask has data, same as the clipped outputs.
+    :param in_range_raster: The 1 or 0 comparison raster.
+    :param mask_raster: The intersection mask from raster_intersection.
+    :param con_raster_path: The location of the final conditional output.
+    :return:
+    '''
+    with instrument.stage('clip_write'):
+        previous_extent = env.extent
+        env.extent = mask_extent(mask_raster)
+        try:
+            masked_raster = Con(mask_raster == 1, in_range_raster)
+            arcpy.CopyRaster_management(masked_raster, con_raster_path, '#', '#', '255', '#', '#', '8_BIT_UNSIGNED')
+        finally:
+            env.extent = previous_extent
+    return
 
 def check_stdev_range(raster_1_path, raster_2_path, con_raster_path, template_raster_path):
     '''
@@ -55,8 +97,9 @@ def check_stdev_range(raster_1_path, raster_2_path, con_raster_path, template_ra
     :param con_raster_path: The location of the final conditional output.
     :return:
     '''
-    bound_poly, pmemory = raster_intersection(raster_1_path, raster_2_path)
+    arcpy_env.setup()
     env.snapRaster = template_raster_path
+    mask_raster = raster_intersection(raster_1_path, raster_2_path)
 
     band_list_1 = raster_clipper.get_band_list(raster_1_path)
     rlist1 = raster_clipper.bands_to_raster_obj(raster_1_path, band_list_1)
@@ -65,21 +108,22 @@ def check_stdev_range(raster_1_path, raster_2_path, con_raster_path, template_ra
     rlist2 = raster_clipper.bands_to_raster_obj(raster_2_path, band_list_2)
 
     in_range_raster = Con((rlist1[2] >= rlist2[3]) & (rlist1[2] <= rlist2[1]), 1, 0)
-    arcpy.Clip_management(in_range_raster, '#', con_raster_path, bound_poly, '255', "ClippingGeometry")
-
-    arcpy.Delete_management(pmemory)
+    mask_to_output(in_range_raster, mask_raster, con_raster_path)
     return
 
-def check_196stdev_range(raster_1_path, raster_2_path, con_raster_path):
+def check_196stdev_range(raster_1_path, raster_2_path, con_raster_path, template_raster_path=None):
     '''
     Does the same thing as the check_stdev_range function with the same assumptions using band 1 and 5 as the range.
     :param raster_1_path: The path to raster 1 (mean raster)
     :param raster_2_path: The path to raster 2 (range raster)
     :param con_raster_path: The location of the final conditional output
+    :param template_raster_path: Optional raster to snap to.
     :return:
     '''
-
-    bound_poly, pmemory = raster_intersection(raster_1_path, raster_2_path)
+    arcpy_env.setup()
+    if template_raster_path:
+        env.snapRaster = template_raster_path
+    mask_raster = raster_intersection(raster_1_path, raster_2_path)
 
     band_list_1 = raster_clipper.get_band_list(raster_1_path)
     rlist1 = raster_clipper.bands_to_raster_obj(raster_1_path, band_list_1)
@@ -88,19 +132,69 @@ def check_196stdev_range(raster_1_path, raster_2_path, con_raster_path):
     rlist2 = raster_clipper.bands_to_raster_obj(raster_2_path, band_list_2)
 
     in_range_raster = Con((rlist1[2] >= rlist2[4]) & (rlist1[2] <= rlist2[0]), 1, 0)
-    arcpy.Clip_management(in_range_raster, '#', con_raster_path, bound_poly, '255', "ClippingGeometry")
+    mask_to_output(in_range_raster, mask_raster, con_raster_path)
+    return
+
+def range_rasters(rlist, sigma):
+    '''
+    The lower and upper bound rasters of a five band raster's sigma range. 1 and 1.96 are bands already, anything else
+    (2.58 say) is worked out from the Mean and PlusStDev bands.
+    :param rlist: List of band Raster objects from raster_clipper.bands_to_raster_obj.
+    :param sigma: How many standard deviations wide the range is.
+    :return: Tuple of (lower, upper) Raster objects.
+    '''
+    if sigma == 1:
+        return rlist[3], rlist[1]
+    if sigma == 1.96:
+        return rlist[4], rlist[0]
+
+    stdev = rlist[1] - rlist[2]
+    return rlist[2] - stdev * sigma, rlist[2] + stdev * sigma
+
+def check_ranges(raster_1_path, raster_2_path, con_raster_paths, template_raster_path=None):
+    '''
+    Does check_stdev_range and check_196stdev_range (or any other sigma) in one go. The bands and the intersection
+    mask are only built once for the pair.
+    :param raster_1_path: The path to raster 1 (mean raster)
+    :param raster_2_path: The path to raster 2 (range raster)
+    :param con_raster_paths: Dictionary of {sigma: output path}, e.g. {1: 'a.tif', 1.96: 'b.tif'}.
+    :param template_raster_path: Optional raster to snap to.
+    :return:
+    '''
+    arcpy_env.setup()
+    if template_raster_path:
+        env.snapRaster = template_raster_path
+    mask_raster = raster_intersection(raster_1_path, raster_2_path)
+
+    band_list_1 = raster_clipper.get_band_list(raster_1_path)
+    rlist1 = raster_clipper.bands_to_raster_obj(raster_1_path, band_list_1)
+
+    band_list_2 = raster_clipper.get_band_list(raster_2_path)
+    rlist2 = raster_clipper.bands_to_raster_obj(raster_2_path, band_list_2)
 
-    arcpy.Delete_management(pmemory)
+    for sigma, con_raster_path in con_raster_paths.items():
+        lower, upper = range_rasters(rlist2, sigma)
+        in_range_raster = Con((rlist1[2] >= lower) & (rlist1[2] <= upper), 1, 0)
+        mask_to_output(in_range_raster, mask_raster, con_raster_path)
     return
 
-def create_const_raster(base_raster_path, constant):
+def create_const_raster(base_raster_path, constant, out_path=None):
     '''
     Given a raster dataset and any integer number this function will create a constant raster at the same extent as
-    the input raster.
+    the input raster. A 0 constant is a template, and those are saved sparse with raster_grid.save_template instead of
+    through CreateConstantRaster, so no pixels are written whatever the extent and every cell reads back as 0.
     :param base_raster_path: The path to the raster we'll use as a template.
     :param constant: The integer value to use in the constant.
-    :return:
+    :param out_path: Where a 0 template's GeoTIFF goes. A new temp directory if None.
+    :return: Arc Raster object.
     '''
+    arcpy_env.setup()
+
+    if constant == 0:
+        if out_path is None:
+            out_path = os.path.join(tempfile.mkdtemp(), 'template.tif')
+        raster_grid.save_template(out_path, raster_grid.get_grid(base_raster_path))
+        return Raster(out_path)
 
     base_raster = Raster(base_raster_path)
 
@@ -116,18 +210,6 @@ def create_const_raster(base_raster_path, constant):
     return constant_raster
 
 
-def get_date(file_path):
-    '''
-    Takes the file names specific to these five band rasters and slices strings until you have a unique date identifier.
-    :param file_path: The full path to the file we need the date from
-    :return: The date string we cut from the file path
-    '''
-    name = ntpath.basename(file_path)
-    date = name[1:7]
-    full_date = date + '_' + name[14:16]
-    return full_date
-
-
 def run_stdev_finder():
     '''
     !!!No longer relevant but I'll keep it here for nostalgia's sake!!!
@@ -144,7 +226,7 @@ def run_stdev_finder():
         remaining_files.remove(raster_file)
         for compare_file in remaining_files:
             print '\t' + compare_file
-            output_path = os.path.join(os.getcwd(), "stdev_outs//", get_date(raster_file) + '_TO_' + get_date(compare_file) + '.tif')
+            output_path = os.path.join(os.getcwd(), "stdev_outs//", pair_name(raster_file, compare_file) + '.tif')
             try:
                 check_stdev_range(raster_file, compare_file, output_path)
             except:
@@ -166,7 +248,7 @@ def run_196stdev_finder():
         remaining_files.remove(raster_file)
         for compare_file in remaining_files:
             print '\t' + compare_file
-            output_path = os.path.join(os.getcwd(), "196stdev_outs//", get_date(raster_file) + '_TO_' + get_date(compare_file) + '.tif')
+            output_path = os.path.join(os.getcwd(), "196stdev_outs//", pair_name(raster_file, compare_file) + '.tif')
 
             try:
                 check_196stdev_range(raster_file, compare_file, output_path)
@@ -0,0 +1,9 @@
+import os
+import sys
+
+__author__ = 'Steve Kochaver'
+
+# The modules live at the top of the repository rather than in a package, so the tests import them from there. Tests
+# for modules that need GDAL skip themselves when it isn't installed (pytest.importorskip).
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
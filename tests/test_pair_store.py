@@ -0,0 +1,120 @@
+import json
+import threading
+import numpy as np
+import pytest
+
+pytest.importorskip('gdal')
+import pair_store
+
+__author__ = 'Steve Kochaver'
+
+
+@pytest.fixture
+def store_path(tmpdir):
+    yield str(tmpdir.join('n_pairs' + pair_store.STORE_EXT))
+    pair_store.close_writers()
+
+
+def random_result(random_state, rows, cols):
+    values = random_state.randint(0, 2, (rows, cols)).astype(np.uint8)
+    values[random_state.rand(rows, cols) < 0.3] = pair_store.OUT_NODATA
+    return values
+
+
+@pytest.mark.parametrize('encoding', pair_store.ENCODINGS)
+@pytest.mark.parametrize('shape', [(1, 1), (3, 7), (5, 8), (4, 13), (17, 31)])
+def test_encode_round_trip(encoding, shape):
+    values = random_result(np.random.RandomState(shape[1]), *shape)
+    decoded = pair_store.decode(pair_store.encode(values, encoding), shape, encoding)
+    assert decoded.dtype == np.uint8
+    assert (decoded == values).all()
+
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError):
+        pair_store.encode(np.zeros((2, 2), dtype=np.uint8), 'float')
+
+
+@pytest.mark.parametrize('encoding', pair_store.ENCODINGS)
+def test_write_and_read_pairs(store_path, encoding):
+    random_state = np.random.RandomState(1)
+    written = {}
+    for date_2, window in [('140602', (3, 4, 9, 5)), ('140603', (0, 0, 16, 2)), ('140604', (10, 1, 1, 11))]:
+        for label in ('stdev', '196stdev'):
+            values = random_result(random_state, window[3], window[2])
+            pair_store.write_pair(store_path, '140601', date_2, label, values, window, encoding)
+            written[('140601', date_2, label)] = values, window
+
+    index = pair_store.read_index(store_path)
+    assert set(index) == set(written)
+    for (date_1, date_2, label), (values, window) in written.items():
+        read_values, read_window = pair_store.read_pair(store_path, date_1, date_2, label, index)
+        assert read_window == window
+        assert (read_values == values).all()
+
+    assert len(list(pair_store.iter_pairs(store_path, 'stdev'))) == 3
+    with pytest.raises(KeyError):
+        pair_store.read_pair(store_path, '140601', '140605', 'stdev', index)
+
+
+def test_latest_write_wins(store_path):
+    first = np.zeros((2, 3), dtype=np.uint8)
+    second = np.ones((2, 3), dtype=np.uint8)
+    pair_store.write_pair(store_path, '140601', '140602', 'stdev', first, (0, 0, 3, 2))
+    pair_store.write_pair(store_path, '140601', '140602', 'stdev', second, (0, 0, 3, 2))
+
+    values, window = pair_store.read_pair(store_path, '140601', '140602', 'stdev')
+    assert (values == second).all()
+    assert len(pair_store.read_index(store_path)) == 1
+
+
+def test_index_skips_cut_off_entries(store_path, tmpdir):
+    values = np.ones((2, 3), dtype=np.uint8)
+    pair_store.write_pair(store_path, '140601', '140602', 'stdev', values, (0, 0, 3, 2))
+    pair_store.close_writers()
+
+    # A crash can leave half an index line, or a whole line whose bytes never made it into the .dat.
+    index_path = tmpdir.join('n_pairs' + pair_store.STORE_EXT).listdir('*.idx')[0]
+    entry = json.loads(index_path.readlines()[0])
+    entry.update({'date_2': '140603', 'offset': entry['offset'] + entry['length']})
+    index_path.write(json.dumps(entry) + '\n{"date_1": "1406', mode='a')
+
+    assert list(pair_store.read_index(store_path)) == [('140601', '140602', 'stdev')]
+
+
+def test_threads_share_a_store(store_path):
+    # pair_pipeline's writer threads append to the same part files, every result has to land whole.
+    random_state = np.random.RandomState(2)
+    results = [(('%06d' % (140600 + i)), random_result(random_state, 6, 11)) for i in range(40)]
+
+    def write(chunk):
+        for date_2, values in chunk:
+            pair_store.write_pair(store_path, '140600', date_2, 'stdev', values, (0, 0, 11, 6))
+
+    threads = [threading.Thread(target=write, args=(results[i::4],)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    index = pair_store.read_index(store_path)
+    assert len(index) == len(results)
+    for date_2, values in results:
+        assert (pair_store.read_pair(store_path, '140600', date_2, 'stdev', index)[0] == values).all()
+
+
+def test_add_store_and_clear(store_path):
+    values = np.array([[1, 0, pair_store.OUT_NODATA]], dtype=np.uint8)
+    pair_store.write_pair(store_path, '140601', '140602', 'stdev', values, (1, 1, 3, 1))
+    pair_store.write_pair(store_path, '140601', '140603', 'stdev', values, (2, 1, 3, 1))
+
+    counts = np.zeros((3, 6), dtype=np.int32)
+    assert pair_store.add_store(counts, store_path, 'stdev') == 2
+    assert counts[1].tolist() == [0, 1, 1, 0, 0, 0]
+
+    footprints = np.zeros((3, 6), dtype=np.int32)
+    pair_store.add_store(footprints, store_path, 'stdev', footprint=True)
+    assert footprints[1].tolist() == [0, 1, 2, 1, 0, 0]
+
+    pair_store.clear_store(store_path)
+    assert pair_store.read_index(store_path) == {}
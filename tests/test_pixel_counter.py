@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('gdal')
+import pixel_counter
+
+__author__ = 'Steve Kochaver'
+
+
+def brute_force(means, valid, ranges):
+    # The pair loop count_pairs replaces: line i's mean inside line j's range, for every i < j with data at the pixel.
+    n, pixels = means.shape
+    counts = [np.zeros(pixels, dtype=np.int64) for r in ranges]
+    pairs = np.zeros(pixels, dtype=np.int64)
+    for i in range(n):
+        for j in range(i + 1, n):
+            both = valid[i] & valid[j]
+            pairs += both
+            for count, (lower, upper) in zip(counts, ranges):
+                count += both & (means[i] >= lower[j]) & (means[i] <= upper[j])
+    return counts, pairs
+
+
+def random_lines(random_state, n, pixels, coverage):
+    means = random_state.normal(1.0, 0.2, (n, pixels)).astype(np.float32)
+    stdev = random_state.uniform(0.0, 0.3, (n, pixels)).astype(np.float32)
+    valid = random_state.rand(n, pixels) < coverage
+    ranges = [(means - stdev, means + stdev), (means - 1.96 * stdev, means + 1.96 * stdev)]
+    return means, valid, ranges
+
+
+@pytest.mark.parametrize('n, coverage', [(1, 1.0), (2, 0.5), (7, 0.8), (16, 0.3), (33, 0.9)])
+def test_count_pairs_matches_brute_force(n, coverage):
+    random_state = np.random.RandomState(n)
+    means, valid, ranges = random_lines(random_state, n, 257, coverage)
+
+    counts, pairs = pixel_counter.count_pairs(means, valid, ranges)
+    expected_counts, expected_pairs = brute_force(means, valid, ranges)
+
+    assert (pairs == expected_pairs).all()
+    for count, expected in zip(counts, expected_counts):
+        assert (count == expected).all()
+
+
+def test_count_pairs_ties_and_range_edges():
+    # Equal means and means sitting exactly on a range bound are both inside the range.
+    random_state = np.random.RandomState(0)
+    means = random_state.randint(0, 4, (9, 64)).astype(np.float32)
+    valid = random_state.rand(9, 64) < 0.7
+    ranges = [(means - 1, means + 1), (means, means)]
+
+    counts, pairs = pixel_counter.count_pairs(means, valid, ranges)
+    expected_counts, expected_pairs = brute_force(means, valid, ranges)
+
+    assert (pairs == expected_pairs).all()
+    for count, expected in zip(counts, expected_counts):
+        assert (count == expected).all()
+
+
+def test_count_pairs_no_data():
+    means = np.ones((4, 10), dtype=np.float32)
+    counts, pairs = pixel_counter.count_pairs(means, np.zeros((4, 10), dtype=bool), [(means - 1, means + 1)])
+    assert not pairs.any()
+    assert not counts[0].any()
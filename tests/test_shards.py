@@ -0,0 +1,175 @@
+import os
+import json
+import socket
+import pytest
+
+pytest.importorskip('gdal')
+import benchmark
+import gdal_adder
+import gdal_rangefinder
+import raster_grid
+import shards
+from line_names import pair_name
+from pair_scheduler import list_pairs
+
+__author__ = 'Steve Kochaver'
+
+SIGMA_LABELS = {1: 'stdev', 1.96: '196stdev'}
+
+
+def lock_path(work_directory, shard):
+    return shards.shard_directory(work_directory, shard) + '.lock'
+
+
+def foreign_lock(work_directory, shard, age):
+    # A lock some other node made age seconds ago.
+    path = lock_path(work_directory, shard)
+    with open(path, 'w') as f:
+        json.dump({'host': 'elsewhere', 'pid': 1, 'time': 0}, f)
+    then = os.path.getmtime(path) - age
+    os.utime(path, (then, then))
+    return path
+
+
+def test_shard_of_is_stable():
+    names = ['1406%02d_01_TO_1407%02d_02' % (i, i) for i in range(1, 29)]
+    for shard_count in (1, 3, 64):
+        assigned = [shards.shard_of(name, shard_count) for name in names]
+        assert all(0 <= shard < shard_count for shard in assigned)
+        assert assigned == [shards.shard_of(name, shard_count) for name in names]
+    assert len(set(shards.shard_of(name, 4) for name in names)) == 4
+    assert shards.shard_of('140612_03_TO_140708_05', 64) == 56
+
+
+def test_lock_contention(tmpdir):
+    work_directory = str(tmpdir)
+    assert shards.claim_shard(work_directory, 0)
+    assert shards.holds_shard(work_directory, 0)
+    assert not shards.claim_shard(work_directory, 0)
+
+    shards.release_shard(work_directory, 0)
+    assert not os.path.exists(lock_path(work_directory, 0))
+    assert shards.claim_shard(work_directory, 0)
+
+
+def test_fresh_lock_is_left_alone(tmpdir):
+    work_directory = str(tmpdir)
+    path = foreign_lock(work_directory, 2, 10)
+
+    assert not shards.claim_shard(work_directory, 2, stale_seconds=60)
+    assert not shards.holds_shard(work_directory, 2)
+    shards.release_shard(work_directory, 2)
+    assert os.path.exists(path)
+    with open(path) as f:
+        assert json.load(f)['host'] == 'elsewhere'
+
+
+def test_stale_lock_is_taken_over(tmpdir):
+    work_directory = str(tmpdir)
+    foreign_lock(work_directory, 1, 120)
+
+    assert shards.claim_shard(work_directory, 1, stale_seconds=60)
+    assert shards.holds_shard(work_directory, 1)
+    with open(lock_path(work_directory, 1)) as f:
+        assert json.load(f)['host'] == socket.gethostname()
+    assert not [name for name in os.listdir(work_directory) if name.endswith('.stale')]
+
+
+def test_stale_lock_taken_over_by_someone_else_first(tmpdir, monkeypatch):
+    # The lock looked stale, but by the time it's renamed another node has already replaced it with a fresh one.
+    work_directory = str(tmpdir)
+    path = foreign_lock(work_directory, 0, 0)
+    real_getmtime = os.path.getmtime
+    looks = []
+
+    def getmtime(checked_path):
+        looks.append(checked_path)
+        return 0 if len(looks) == 1 else real_getmtime(checked_path)
+
+    monkeypatch.setattr(os.path, 'getmtime', getmtime)
+    assert not shards.take_stale_lock(path, 60)
+    monkeypatch.undo()
+
+    assert os.path.exists(path)
+    assert not [name for name in os.listdir(work_directory) if name.endswith('.stale')]
+
+
+@pytest.fixture
+def plan_directory(tmpdir):
+    line_directory = str(tmpdir.mkdir('lines'))
+    lines, template = benchmark.make_lines(line_directory, 5, 40, 30, 0.5, 'mixed', 1)
+    outputs = dict((label, (os.path.join(line_directory, label + '_true_count.tif'),
+                            os.path.join(line_directory, label + '_percent.tif'))) for label in SIGMA_LABELS.values())
+    work_directory = str(tmpdir.join('work'))
+    shards.make_plan(work_directory, lines, list_pairs(lines), template, SIGMA_LABELS, outputs,
+                     os.path.join(line_directory, 'path_counts.tif'), 3)
+    return work_directory
+
+
+def expected_counts(plan):
+    grid = raster_grid.get_grid(plan['template'])
+    counts = dict((sigma, gdal_adder.new_count_array(grid)) for sigma in SIGMA_LABELS)
+    int_counts = gdal_adder.new_count_array(grid)
+    for pairs in plan['shards']:
+        for name, raster_file, compare_file in pairs:
+            try:
+                shards.add_pair(counts, int_counts, raster_file, compare_file, plan['template'], list(SIGMA_LABELS))
+            except gdal_rangefinder.NoOverlap:
+                pass
+    return counts, int_counts
+
+
+def merged_counts(plan):
+    counts = dict((sigma, gdal_adder.load_counts(plan['outputs'][label][0])) for sigma, label in SIGMA_LABELS.items())
+    return counts, gdal_adder.load_counts(plan['int_count'])
+
+
+def assert_same(counts, expected):
+    for sigma in SIGMA_LABELS:
+        assert (counts[0][sigma] == expected[0][sigma]).all()
+    assert (counts[1] == expected[1]).all()
+
+
+def test_run_and_merge(plan_directory):
+    plan = shards.load_plan(plan_directory)
+    with pytest.raises(RuntimeError):
+        shards.merge(plan_directory)
+
+    assert set(shards.run_shards(plan_directory).values()) == set(['ran'])
+    assert set(shards.run_shards(plan_directory).values()) == set(['done'])
+    shards.merge(plan_directory)
+
+    expected = expected_counts(plan)
+    assert expected[1].any()
+    assert_same(merged_counts(plan), expected)
+
+
+def test_failed_pairs_are_retried(plan_directory, monkeypatch):
+    plan = shards.load_plan(plan_directory)
+    shard = max(range(len(plan['shards'])), key=lambda index: len(plan['shards'][index]))
+    broken = plan['shards'][shard][0][0]
+    real_add_pair = shards.add_pair
+
+    def flaky_add_pair(counts, int_counts, raster_file, compare_file, template_raster_path, sigmas):
+        if pair_name(raster_file, compare_file) == broken:
+            raise IOError('read timed out')
+        return real_add_pair(counts, int_counts, raster_file, compare_file, template_raster_path, sigmas)
+
+    monkeypatch.setattr(shards, 'add_pair', flaky_add_pair)
+    assert shards.run_shard(plan_directory, shard) == 'failed'
+    done = shards.read_done(plan_directory, plan, shard)
+    assert list(done['failed']) == [broken]
+    assert done['failed'][broken].endswith('read timed out')
+    monkeypatch.undo()
+
+    retried = []
+    monkeypatch.setattr(shards, 'add_pair', lambda *args: (retried.append(pair_name(args[2], args[3])),
+                                                           real_add_pair(*args)))
+    assert shards.run_shard(plan_directory, shard) == 'ran'
+    assert retried == [broken]
+    assert shards.run_shard(plan_directory, shard) == 'done'
+    monkeypatch.undo()
+
+    shards.run_shards(plan_directory)
+    shards.merge(plan_directory)
+    assert_same(merged_counts(plan), expected_counts(plan))
@@ -0,0 +1,93 @@
+import os
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('gdal')
+import benchmark
+import gdal_adder
+import gdal_rangefinder
+import tiling
+from pair_scheduler import list_pairs
+
+__author__ = 'Steve Kochaver'
+
+SIGMAS = (1, 1.96)
+
+
+@pytest.mark.parametrize('block_size, bytes_per_pixel, memory_budget, max_cols', [
+    ((256, 256), 48, 512 * 1024 * 1024, 10000),
+    ((256, 256), 48, 1, 10000),
+    ((256, 16), 4, 256 * 16 * 4 * 5, 1000),
+    ((128, 128), 12, 128 * 128 * 12 * 40, 300),
+])
+def test_tile_shape(block_size, bytes_per_pixel, memory_budget, max_cols):
+    tile_cols, tile_rows = tiling.tile_shape(block_size, bytes_per_pixel, memory_budget, max_cols)
+
+    assert tile_cols % block_size[0] == 0 and tile_rows % block_size[1] == 0
+    assert tile_cols >= block_size[0] and tile_rows >= block_size[1]
+    assert tile_cols < max_cols + block_size[0]
+    if tile_cols * tile_rows > block_size[0] * block_size[1]:
+        assert tile_cols * tile_rows * bytes_per_pixel <= memory_budget
+
+
+@pytest.mark.parametrize('area_window', [(0, 0, 1000, 700), (37, 5, 300, 611), (256, 512, 256, 256), (3, 3, 1, 1)])
+@pytest.mark.parametrize('tile_size', [(256, 256), (512, 128), (1024, 1024)])
+def test_tile_windows_cover_the_area_once(area_window, tile_size):
+    covered = np.zeros((area_window[1] + area_window[3] + 10, area_window[0] + area_window[2] + 10), dtype=np.int32)
+    for x, y, cols, rows in tiling.tile_windows(area_window, tile_size):
+        assert cols > 0 and rows > 0
+        # Every tile sits inside one cell of the lattice that starts at the grid origin.
+        assert x // tile_size[0] == (x + cols - 1) // tile_size[0]
+        assert y // tile_size[1] == (y + rows - 1) // tile_size[1]
+        covered[y:y + rows, x:x + cols] += 1
+
+    expected = np.zeros_like(covered)
+    expected[area_window[1]:area_window[1] + area_window[3], area_window[0]:area_window[0] + area_window[2]] = 1
+    assert (covered == expected).all()
+
+
+def read_output(path):
+    dataset = gdal.Open(path)
+    values = dataset.GetRasterBand(1).ReadAsArray().copy()
+    geotransform = tuple(dataset.GetGeoTransform())
+    dataset = None
+    return values, geotransform
+
+
+def test_tiled_matches_untiled(tmpdir):
+    # Lines a few blocks across so the overlaps are cut into several tiles at the smallest budget.
+    line_directory = str(tmpdir.mkdir('lines'))
+    lines, template = benchmark.make_lines(line_directory, 3, 600, 560, 0.5, 'mixed', 2)
+    untiled_directories = dict((sigma, str(tmpdir.mkdir('untiled_%s' % sigma))) for sigma in SIGMAS)
+    tiled_directories = dict((sigma, str(tmpdir.mkdir('tiled_%s' % sigma))) for sigma in SIGMAS)
+
+    compared = 0
+    for raster_file, compare_file in list_pairs(lines):
+        name = os.path.basename(raster_file) + '_' + os.path.basename(compare_file) + '.tif'
+        untiled = dict((sigma, os.path.join(untiled_directories[sigma], name)) for sigma in SIGMAS)
+        tiled = dict((sigma, os.path.join(tiled_directories[sigma], name)) for sigma in SIGMAS)
+        try:
+            gdal_rangefinder.check_ranges(raster_file, compare_file, untiled, template)
+        except gdal_rangefinder.NoOverlap:
+            with pytest.raises(gdal_rangefinder.NoOverlap):
+                gdal_rangefinder.check_ranges_budgeted(raster_file, compare_file, (tiled, 1), template)
+            continue
+        gdal_rangefinder.check_ranges_budgeted(raster_file, compare_file, (tiled, 1), template)
+        overlap = gdal_rangefinder.pair_windows(raster_file, compare_file, template)[3]
+        assert len(list(tiling.tile_windows(overlap, tiling.DEFAULT_BLOCK_SIZE))) > 1
+        compared += 1
+
+        for sigma in SIGMAS:
+            untiled_values, untiled_geotransform = read_output(untiled[sigma])
+            tiled_values, tiled_geotransform = read_output(tiled[sigma])
+            assert tiled_geotransform == untiled_geotransform
+            assert tiled_values.shape == untiled_values.shape
+            assert (tiled_values == untiled_values).all()
+    assert compared
+
+    for sigma in SIGMAS:
+        untiled_count, tiled_count = str(tmpdir.join('untiled_%s.tif' % sigma)), str(tmpdir.join('tiled_%s.tif' % sigma))
+        gdal_adder.add_small_rasters(untiled_directories[sigma], template, untiled_count)
+        gdal_adder.add_small_rasters_tiled(tiled_directories[sigma], template, tiled_count, 1)
+        assert (read_output(tiled_count)[0] == read_output(untiled_count)[0]).all()
+        assert read_output(untiled_count)[0].any()
@@ -0,0 +1,69 @@
+import gdal
+import raster_grid
+
+gdal.UseExceptions()
+__author__ = 'Steve Kochaver'
+
+# Helpers for working through big rasters a tile at a time. Tiles are whole multiples of the GeoTIFF's internal
+# blocks and line up with the grid origin, so every read and write touches complete blocks.
+
+# Used when a raster isn't there yet to ask (or is striped rather than tiled).
+DEFAULT_BLOCK_SIZE = (256, 256)
+
+# Half a gig of arrays per tile unless somebody says otherwise.
+DEFAULT_MEMORY_BUDGET = 512 * 1024 * 1024
+
+
+def get_block_size(raster_path):
+    '''
+    The internal block size of the first band of a raster.
+    :param raster_path: The path to the raster dataset.
+    :return: Tuple of (block cols, block rows).
+    '''
+    dataset = gdal.Open(raster_path)
+    block_cols, block_rows = dataset.GetRasterBand(1).GetBlockSize()
+    dataset = None
+
+    # Striped files report one-row blocks which make for silly tiles, so treat them like the default tiling.
+    if block_rows == 1:
+        return DEFAULT_BLOCK_SIZE
+    return block_cols, block_rows
+
+
+def tile_shape(block_size, bytes_per_pixel, memory_budget, max_cols):
+    '''
+    The biggest tile (in whole blocks) whose working arrays fit in the memory budget. Tiles grow across first since
+    full-width reads are the cheapest, then down. A tile is never smaller than one block.
+    :param block_size: Tuple of (block cols, block rows).
+    :param bytes_per_pixel: How many bytes of arrays the caller holds per pixel of tile.
+    :param memory_budget: Bytes the caller is willing to spend on a tile.
+    :param max_cols: Width of the area being tiled. Tiles won't be (much) wider than this.
+    :return: Tuple of (tile cols, tile rows).
+    '''
+    block_cols, block_rows = block_size
+    block_bytes = block_cols * block_rows * bytes_per_pixel
+    max_blocks = max(1, memory_budget // block_bytes)
+
+    blocks_across = min(max_blocks, max(1, -(-max_cols // block_cols)))
+    blocks_down = max(1, max_blocks // blocks_across)
+
+    return blocks_across * block_cols, blocks_down * block_rows
+
+
+def tile_windows(area_window, tile_size):
+    '''
+    Windows covering an area, cut along a tile lattice that starts at the grid origin. Tiles on the edge of the area
+    are trimmed to it.
+    :param area_window: Window tuple (xoff, yoff, cols, rows) of the area to cover.
+    :param tile_size: Tuple of (tile cols, tile rows) from tile_shape.
+    :return: Generator of window tuples on the same grid as area_window.
+    '''
+    tile_cols, tile_rows = tile_size
+    x_start = (area_window[0] // tile_cols) * tile_cols
+    y_start = (area_window[1] // tile_rows) * tile_rows
+
+    for y in range(y_start, area_window[1] + area_window[3], tile_rows):
+        for x in range(x_start, area_window[0] + area_window[2], tile_cols):
+            window = raster_grid.intersect_windows((x, y, tile_cols, tile_rows), area_window)
+            if window is not None:
+                yield window
@@ -1,15 +1,28 @@
-from raster_clipper import *
-from stdev_rangefinder import get_date, check_stdev_range, check_196stdev_range
-from raster_adder import add_small_rasters, total_intersection
-import arcpy
-from rasterizer import add_to_raster
-from arcpy.sa import *
+from line_names import get_date, pair_name
+from backends import load_backend
+import arcpy_env
+from gdal_adder import burn_footprints, add_small_rasters, add_small_rasters_tiled, percent_raster, new_count_array, add_raster, load_counts, save_counts, add_store_results
+from gdal_rangefinder import store_ranges
+from raster_grid import get_grid, create_raster, covering_grid, save_template
+import manifest
+import pair_store
+import instrument
+import band_cache
+from pixel_counter import count_lines
+from tiling import DEFAULT_MEMORY_BUDGET
+from pair_scheduler import run_pairs
+from footprint_index import overlapping_pairs
+from line_align import aligned_paths
+import multiprocessing
 import tempfile
 import shutil
 import os
 
 __author__ = 'Steve Kochaver'
 
+# arcpy (and the modules built on it) are only imported by the functions that use them, so importing this module is
+# cheap and works without arcpy. Pick the backend per analysis, or run things from analysis_cli.
+
 
 def listdir_fullpath(directory):
     return [os.path.join(directory, name) for name in os.listdir(directory)]
@@ -19,16 +32,54 @@ def get_files_of_ext(directory, extension):
     return [path for path in listdir_fullpath(directory) if os.path.splitext(path)[1].lower() == extension]
 
 
-def create_path_footprints(image_directory, burn_raster_path):
+def line_paths(image_directory, template_raster_path):
+    '''
+    The .bsq flight lines in a directory, with the copies line_align put on the template grid in place of the lines
+    that needed one.
+    :param image_directory: Directory of the flight lines.
+    :param template_raster_path: The template the lines were aligned to.
+    :return: List of line paths.
+    '''
+    return aligned_paths(get_files_of_ext(image_directory, '.bsq'), template_raster_path)
+
+def make_template(image_directory, template_raster_path):
+    '''
+    Makes the template for a directory of flight lines: the smallest grid covering every line, on the pixels of the
+    first one, saved without any pixel values (see raster_grid.save_template). Use a .vrt path for a template that's
+    only there to define the grid and a .tif for one that footprints get burned into.
+    :param image_directory: The directory of the images (N, LIG, or LMA).
+    :param template_raster_path: Where the template goes.
+    :return: The template Grid.
+    '''
+    import gdal_rangefinder
+
+    grid = covering_grid([gdal_rangefinder.get_grid(path) for path in get_files_of_ext(image_directory, '.bsq')])
+    save_template(template_raster_path, grid)
+    return grid
+
+def create_path_footprints(image_directory, burn_raster_path, fused=True):
     '''
     Given a directory containing .tif images and a path to an 0 constant raster this function will add 1 to every raster
     pixel where there is meaningful data in the raster. Converts to shapefile in directory and burns based on the
-    output polygon geometry. Puts those shapefiles into a temporary directory then removes the directory.
+    output polygon geometry. Puts those shapefiles into a temporary directory, burns them all in one go, then removes
+    the directory.
     :param image_directory: The directory containing the raster images
     :param burn_raster_path: The path to the 0 constant raster. Should be of an extent that contains all the paths.
+    :param fused: Adds each image's mask straight into the burn raster with gdal_adder.burn_footprints instead of
+    going through shapefiles. Same counts for images on the burn raster's grid. False for the old polygon burn.
     :return:
     '''
+    if fused:
+        burn_footprints(get_files_of_ext(image_directory, '.tif'), burn_raster_path)
+        return
+
+    import arcpy
+    from arcpy.sa import Raster, Con
+    from rasterizer import burn_many
+    arcpy_env.setup()
+
     temp_dir = tempfile.mkdtemp()
+    shape_files = []
 
     for image in get_files_of_ext(image_directory, '.tif'):
 
@@ -38,96 +89,528 @@ def create_path_footprints(image_directory, burn_raster_path):
         mask_raster = Con((raster == 0) | (raster == 1), 1, 0)
         output_path = os.path.join(temp_dir, image_name + '.shp')
         arcpy.RasterToPolygon_conversion(mask_raster, output_path, "NO_SIMPLIFY")
+        shape_files.append(output_path)
 
-        add_to_raster(burn_raster_path, output_path)
+    # All the footprints go in with one open and flush of the burn raster rather than one per image.
+    burn_many(burn_raster_path, shape_files)
 
     shutil.rmtree(temp_dir)
 
     return
 
 
-def stdev_analysis(image_directory, template_raster_path, int_count_raster, type):
+def count_and_percent(stdev_dir, template_raster_path, int_count_raster, true_count_path, per_raster_path, memory_budget=None, backend='arcpy'):
+    '''
+    Sums the comparison outputs in a directory into a true count raster and divides it by the intersection count.
+    :param stdev_dir: The directory of comparison outputs.
+    :param template_raster_path: The zero constant raster of the maximum extent of all the paths.
+    :param int_count_raster: The intersection count raster (path_counts).
+    :param true_count_path: Where the true count raster goes.
+    :param per_raster_path: Where the percent raster goes.
+    :param memory_budget: If given both steps run a tile at a time using roughly this many bytes of arrays.
+    :param backend: 'arcpy' does the percent with map algebra, 'gdal' with gdal_adder.percent_raster.
+    :return:
+    '''
+    if memory_budget:
+        add_small_rasters_tiled(stdev_dir, template_raster_path, true_count_path, memory_budget)
+        percent_raster(true_count_path, int_count_raster, per_raster_path, memory_budget)
+        return
+
+    add_small_rasters(stdev_dir, template_raster_path, true_count_path)
+
+    if backend == 'gdal':
+        percent_raster(true_count_path, int_count_raster, per_raster_path)
+        return
+
+    from arcpy.sa import Raster
+    arcpy_env.setup()
+    per_calc = Raster(true_count_path) * 1.0 / Raster(int_count_raster) * 1.0
+    per_calc.save(per_raster_path)
+    return
+
+def stdev_analysis(image_directory, template_raster_path, int_count_raster, type, processes=None, memory_budget=None, backend='arcpy'):
     '''
     Does the standard deviation analysis for the .bsq images in the given image directory. Creates a directory of
     all the analysis outputs in said directory then creates a count raster of all those outputs.
     :param image_directory: The directory of the images (N, LIG, or LMA) for analysis.
     :param template_raster_path: The zero constant raster of the maximum extent of all the paths.
+    :param processes: Number of worker processes for the pair comparisons. None uses every core.
+    :param memory_budget: Bytes of arrays to allow for summing and percent. None does them all in memory at once.
+    :param backend: 'arcpy' or 'gdal', see backends.
     :return:
     '''
 
     stdev_dir = os.path.join(image_directory, 'stdev_outs')
     if not os.path.exists(stdev_dir): os.makedirs(stdev_dir)
 
-    meaningful_files = get_files_of_ext(image_directory, '.bsq')
-    remaining_files = meaningful_files[:]
+    meaningful_files = line_paths(image_directory, template_raster_path)
+    tasks = [(raster_file, compare_file, os.path.join(os.getcwd(), stdev_dir, pair_name(raster_file, compare_file) + '.tif'))
+             for raster_file, compare_file in overlapping_pairs(meaningful_files)]
 
-    for raster_file in meaningful_files:
+    for raster_file, compare_file, output_path, error in run_pairs(load_backend(backend).check_stdev_range, tasks, template_raster_path, processes):
         print raster_file
-        remaining_files.remove(raster_file)
-        for compare_file in remaining_files:
-            print '\t' + compare_file
-            output_path = os.path.join(os.getcwd(), stdev_dir, get_date(raster_file) + '_TO_' + get_date(compare_file) + '.tif')
-            try:
-                check_stdev_range(raster_file, compare_file, output_path, template_raster_path)
-            except:
-                pass
+        print '\t' + compare_file
+        if error: print '\t\tFAILED ' + error
 
     true_count_path = os.path.join(stdev_dir, type+'_stdev_true_count.tif')
-    add_small_rasters(stdev_dir, template_raster_path, true_count_path)
-
     per_raster_path = os.path.join(stdev_dir, type+'_stdev_percent.tif')
-    per_calc = Raster(true_count_path) * 1.0 / Raster(int_count_raster) * 1.0
-    per_calc.save(per_raster_path)
+    count_and_percent(stdev_dir, template_raster_path, int_count_raster, true_count_path, per_raster_path, memory_budget, backend)
     return
 
-def _196stdev_analysis(image_directory, template_raster_path, int_count_raster, type):
+def _196stdev_analysis(image_directory, template_raster_path, int_count_raster, type, processes=None, memory_budget=None, backend='arcpy'):
     '''
     Does the standard deviation analysis for the .bsq images in the given image directory. Creates a directory of
     all the analysis outputs in said directory then creates a count raster of all those outputs.
     :param image_directory: The directory of the images (N, LIG, or LMA) for analysis.
     :param template_raster_path: The zero constant raster of the maximum extent of all the paths.
+    :param processes: Number of worker processes for the pair comparisons. None uses every core.
+    :param memory_budget: Bytes of arrays to allow for summing and percent. None does them all in memory at once.
+    :param backend: 'arcpy' or 'gdal', see backends.
     :return:
     '''
 
     stdev_dir = os.path.join(image_directory, '196stdev_outs')
     if not os.path.exists(stdev_dir): os.makedirs(stdev_dir)
 
-    meaningful_files = get_files_of_ext(image_directory, '.bsq')
-    remaining_files = meaningful_files[:]
+    meaningful_files = line_paths(image_directory, template_raster_path)
+    tasks = [(raster_file, compare_file, os.path.join(os.getcwd(), stdev_dir, pair_name(raster_file, compare_file) + '.tif'))
+             for raster_file, compare_file in overlapping_pairs(meaningful_files)]
 
-    for raster_file in meaningful_files:
+    for raster_file, compare_file, output_path, error in run_pairs(load_backend(backend).check_196stdev_range, tasks, template_raster_path, processes):
         print raster_file
-        remaining_files.remove(raster_file)
-        for compare_file in remaining_files:
-            print '\t' + compare_file
-            output_path = os.path.join(os.getcwd(), stdev_dir, get_date(raster_file) + '_TO_' + get_date(compare_file) + '.tif')
-            try:
-                check_196stdev_range(raster_file, compare_file, output_path)
-            except:
-                pass
+        print '\t' + compare_file
+        if error: print '\t\tFAILED ' + error
 
     true_count_path = os.path.join(stdev_dir, type+'_196stdev_true_count.tif')
-    add_small_rasters(stdev_dir, template_raster_path, true_count_path)
-
     per_raster_path = os.path.join(stdev_dir, type+'_196stdev_percent.tif')
-    per_calc = Raster(true_count_path) * 1.0 / Raster(int_count_raster) * 1.0
-    per_calc.save(per_raster_path)
+    count_and_percent(stdev_dir, template_raster_path, int_count_raster, true_count_path, per_raster_path, memory_budget, backend)
     return
 
-n_path = r"C:\_sword_analysis\4-14-15\Resampled_AVG\N"
-lma_path = r"C:\_sword_analysis\4-14-15\Resampled_AVG\LMA"
-lig_path = r"C:\_sword_analysis\4-14-15\Resampled_AVG\LIG"
+def sigma_label(sigma):
+    '''
+    The name used for a sigma in output folders and files, i.e. 'stdev' for 1, '196stdev' for 1.96, '258stdev' for 2.58.
+    '''
+    if sigma == 1:
+        return 'stdev'
+    return str(sigma).replace('.', '') + 'stdev'
+
+def cached_pipeline(results, cache_bytes=None):
+    '''
+    Runs a pair_pipeline generator with band_cache on in this process, where its reader threads share it.
+    :param results: The generator from pair_pipeline.
+    :param cache_bytes: Bytes of decoded flight lines to keep. None leaves the cache off.
+    :return: Generator of the same results.
+    '''
+    if cache_bytes:
+        band_cache.enable(cache_bytes)
+    try:
+        for result in results:
+            yield result
+    finally:
+        if cache_bytes:
+            band_cache.disable()
+    return
+
+def multi_stdev_analysis(image_directory, template_raster_path, int_count_raster, type, sigmas=(1, 1.96), processes=None, memory_budget=None, store_encoding=None, backend='arcpy', pipeline=None, cache_bytes=None):
+    '''
+    Does stdev_analysis and _196stdev_analysis (or any other set of sigmas) in a single pass over the pairs. Each pair
+    is read once and written out for every sigma into the usual stdev_outs, 196stdev_outs, etc. directories, then each
+    directory gets its own true count and percent rasters.
+    :param image_directory: The directory of the images (N, LIG, or LMA) for analysis.
+    :param template_raster_path: The zero constant raster of the maximum extent of all the paths.
+    :param sigmas: The standard deviation ranges to check.
+    :param processes: Number of worker processes for the pair comparisons. None uses every core.
+    :param memory_budget: Bytes of arrays to allow for summing and percent. None does them all in memory at once. With
+    the gdal backend and a pool of workers the pairs are compared a tile at a time within it too, the budget shared out
+    between the workers.
+    :param store_encoding: 'bits' or 'uint8' to keep the pair results in a single pair_store (<type>_pairs.pairs in the
+    image directory) instead of a GeoTIFF per pair. The count and percent rasters still go in the usual directories.
+    Store runs always compare with gdal_rangefinder.
+    :param backend: 'arcpy' or 'gdal', see backends.
+    :param pipeline: pair_pipeline.PipelineSettings to compare the pairs with gdal_rangefinder in one process, reading
+    ahead and writing behind, instead of with a pool of worker processes. Meant for lines on network storage.
+    :param cache_bytes: Bytes of decoded flight lines each worker (or the pipeline) keeps in band_cache, so a line is
+    read once rather than once for every pair it's in. Only gdal_rangefinder's comparisons use the cache.
+    :return:
+    '''
+    if store_encoding:
+        return stored_stdev_analysis(image_directory, template_raster_path, int_count_raster, type, sigmas, processes,
+                                     memory_budget, store_encoding, pipeline, cache_bytes)
+
+    stdev_dirs = dict((sigma, os.path.join(image_directory, sigma_label(sigma) + '_outs')) for sigma in sigmas)
+    for stdev_dir in stdev_dirs.values():
+        if not os.path.exists(stdev_dir): os.makedirs(stdev_dir)
+
+    meaningful_files = line_paths(image_directory, template_raster_path)
+    tasks = []
+    for raster_file, compare_file in overlapping_pairs(meaningful_files):
+        out_name = pair_name(raster_file, compare_file) + '.tif'
+        tasks.append((raster_file, compare_file, dict((sigma, os.path.join(stdev_dir, out_name)) for sigma, stdev_dir in stdev_dirs.items())))
+
+    if pipeline:
+        import pair_pipeline
+        results = cached_pipeline(pair_pipeline.check_ranges(tasks, template_raster_path, pipeline), cache_bytes)
+    elif memory_budget and backend == 'gdal':
+        import gdal_rangefinder
+        pair_budget = memory_budget // (processes or multiprocessing.cpu_count())
+        budget_tasks = [(raster_file, compare_file, (output_paths, pair_budget)) for raster_file, compare_file, output_paths in tasks]
+        results = run_pairs(gdal_rangefinder.check_ranges_budgeted, budget_tasks, template_raster_path, processes, cache_bytes)
+    else:
+        results = run_pairs(load_backend(backend).check_ranges, tasks, template_raster_path, processes, cache_bytes)
+
+    for raster_file, compare_file, output_paths, error in results:
+        print raster_file
+        print '\t' + compare_file
+        if error: print '\t\tFAILED ' + error
+
+    for sigma, stdev_dir in stdev_dirs.items():
+        true_count_path = os.path.join(stdev_dir, type + '_' + sigma_label(sigma) + '_true_count.tif')
+        per_raster_path = os.path.join(stdev_dir, type + '_' + sigma_label(sigma) + '_percent.tif')
+        count_and_percent(stdev_dir, template_raster_path, int_count_raster, true_count_path, per_raster_path, memory_budget, backend)
+    return
+
+def stored_stdev_analysis(image_directory, template_raster_path, int_count_raster, type, sigmas=(1, 1.96), processes=None, memory_budget=None, store_encoding='bits', pipeline=None, cache_bytes=None):
+    '''
+    multi_stdev_analysis with the pair results going into one pair_store rather than hundreds of GeoTIFFs, compared
+    with gdal_rangefinder. Summing reads the store once per sigma without expanding anything to the template extent.
+    The store is emptied first so it only ever holds this run's pairs.
+    :param image_directory: The directory of the images (N, LIG, or LMA) for analysis.
+    :param template_raster_path: The zero constant raster of the maximum extent of all the paths.
+    :param int_count_raster: The intersection count raster (path_counts).
+    :param sigmas: The standard deviation ranges to check.
+    :param processes: Number of worker processes for the pair comparisons. None uses every core.
+    :param memory_budget: Bytes of arrays to allow for the percent rasters. None uses the tiling default.
+    :param store_encoding: 'bits' or 'uint8', see pair_store.
+    :param pipeline: pair_pipeline.PipelineSettings to read ahead and write behind in one process instead of using a
+    pool of worker processes.
+    :param cache_bytes: Bytes of decoded flight lines each worker (or the pipeline) keeps in band_cache.
+    :return:
+    '''
+
+    stdev_dirs = dict((sigma, os.path.join(image_directory, sigma_label(sigma) + '_outs')) for sigma in sigmas)
+    for stdev_dir in stdev_dirs.values():
+        if not os.path.exists(stdev_dir): os.makedirs(stdev_dir)
+
+    store_path = os.path.join(image_directory, type + '_pairs' + pair_store.STORE_EXT)
+    labels = dict((sigma, sigma_label(sigma)) for sigma in sigmas)
+    pair_store.clear_store(store_path)
+
+    meaningful_files = line_paths(image_directory, template_raster_path)
+    tasks = [(raster_file, compare_file, (store_path, get_date(raster_file), get_date(compare_file), labels, store_encoding))
+             for raster_file, compare_file in overlapping_pairs(meaningful_files)]
+
+    if pipeline:
+        import pair_pipeline
+        results = cached_pipeline(pair_pipeline.store_ranges(tasks, template_raster_path, pipeline), cache_bytes)
+    else:
+        results = run_pairs(store_ranges, tasks, template_raster_path, processes, cache_bytes)
+
+    for raster_file, compare_file, store_target, error in results:
+        print raster_file
+        print '\t' + compare_file
+        if error: print '\t\tFAILED ' + error
+
+    for sigma, stdev_dir in stdev_dirs.items():
+        true_count_path = os.path.join(stdev_dir, type + '_' + sigma_label(sigma) + '_true_count.tif')
+        per_raster_path = os.path.join(stdev_dir, type + '_' + sigma_label(sigma) + '_percent.tif')
+        add_store_results(store_path, labels[sigma], template_raster_path, true_count_path)
+        percent_raster(true_count_path, int_count_raster, per_raster_path, memory_budget or DEFAULT_MEMORY_BUDGET)
+    return
+
+def retire_pair(state, pair_name, counts, template_grid):
+    '''
+    Takes a pair's old outputs back out of the count arrays and off the disk, and drops it from the manifest.
+    :param state: The manifest dictionary.
+    :param pair_name: The pair's output name.
+    :param counts: Dictionary of {sigma: count array}.
+    :param template_grid: The Grid of the template raster.
+    :return:
+    '''
+    old_outputs = manifest.forget_pair(state, pair_name)
+    for sigma, sigma_counts in counts.items():
+        old_path = old_outputs.get(sigma_label(sigma))
+        if old_path and os.path.exists(old_path):
+            add_raster(sigma_counts, template_grid, old_path, -1)
+            os.remove(old_path)
+    return
+
+def incremental_stdev_analysis(image_directory, template_raster_path, int_count_raster, type, sigmas=(1, 1.96), processes=None, backend='arcpy'):
+    '''
+    multi_stdev_analysis for a directory that's already been run. A manifest in the image directory remembers which
+    versions of the flight lines every pair output came from, so only pairs with a new or changed line are compared
+    again. Their old outputs are taken back out of the true count rasters and the new ones added in rather than summing
+    every output again. Pairs whose lines are gone are taken out and deleted. The first run just does everything.
+    The manifest is marked in progress before any output is touched, so a run that dies part way leaves the next one
+    rebuilding the counts from the outputs actually on disk rather than trusting counts that no longer match them.
+    :param image_directory: The directory of the images (N, LIG, or LMA) for analysis.
+    :param template_raster_path: The zero constant raster of the maximum extent of all the paths.
+    :param int_count_raster: The intersection count raster (path_counts). Rebuild it first if lines were added.
+    :param sigmas: The standard deviation ranges to check.
+    :param processes: Number of worker processes for the pair comparisons. None uses every core.
+    :param backend: 'arcpy' or 'gdal', see backends.
+    :return:
+    '''
+
+    stdev_dirs = dict((sigma, os.path.join(image_directory, sigma_label(sigma) + '_outs')) for sigma in sigmas)
+    for stdev_dir in stdev_dirs.values():
+        if not os.path.exists(stdev_dir): os.makedirs(stdev_dir)
+
+    manifest_path = os.path.join(image_directory, manifest.MANIFEST_NAME)
+    state = manifest.load_manifest(manifest_path)
+    template_grid = get_grid(template_raster_path)
+
+    meaningful_files = line_paths(image_directory, template_raster_path)
+    signatures = manifest.input_signatures(meaningful_files, state)
+
+    # Start from the last counts if they're still the ones we wrote and that run finished, otherwise rebuild them from
+    # the recorded outputs. Whatever is at a recorded path gets added, even if it's a newer output a dead run put there,
+    # because retire_pair below takes out exactly what's at the path too.
+    true_count_paths = dict((sigma, os.path.join(stdev_dir, type + '_' + sigma_label(sigma) + '_true_count.tif'))
+                            for sigma, stdev_dir in stdev_dirs.items())
+    counts = {}
+    for sigma, true_count_path in true_count_paths.items():
+        if manifest.count_is_current(state, sigma_label(sigma), true_count_path):
+            counts[sigma] = load_counts(true_count_path)
+            continue
+        counts[sigma] = new_count_array(template_grid)
+        for entry in state['pairs'].values():
+            output_path = entry['outputs'].get(sigma_label(sigma))
+            if output_path and os.path.exists(output_path):
+                try:
+                    add_raster(counts[sigma], template_grid, output_path)
+                except RuntimeError:
+                    os.remove(output_path)  # Half written by a run that died. Gone, so the pair gets compared again.
+
+    manifest.start_run(state, manifest_path)
+
+    tasks = []
+    wanted_pairs = set()
+    for raster_file, compare_file in overlapping_pairs(meaningful_files):
+        name = pair_name(raster_file, compare_file)
+        wanted_pairs.add(name)
+        output_paths = dict((sigma, os.path.join(stdev_dir, name + '.tif')) for sigma, stdev_dir in stdev_dirs.items())
+        labelled_paths = dict((sigma_label(sigma), path) for sigma, path in output_paths.items())
+
+        if manifest.pair_is_current(state, name, raster_file, compare_file, signatures, labelled_paths):
+            instrument.skip_pair(raster_file, compare_file, 'outputs are current')
+            continue
+        retire_pair(state, name, counts, template_grid)
+        tasks.append((raster_file, compare_file, output_paths))
+
+    for name in [name for name in state['pairs'] if name not in wanted_pairs]:
+        retire_pair(state, name, counts, template_grid)
+
+    print '%d of %d pairs need comparing' % (len(tasks), len(wanted_pairs))
+
+    for raster_file, compare_file, output_paths, error in run_pairs(load_backend(backend).check_ranges, tasks, template_raster_path, processes):
+        print raster_file
+        print '\t' + compare_file
+        if error: print '\t\tFAILED ' + error
+        name = pair_name(raster_file, compare_file)
+        labelled_paths = dict((sigma_label(sigma), path) for sigma, path in output_paths.items())
+
+        if error:
+            # Don't leave half finished outputs lying around for add_small_rasters to find.
+            for output_path in output_paths.values():
+                if os.path.exists(output_path): os.remove(output_path)
+        else:
+            for sigma, output_path in output_paths.items():
+                add_raster(counts[sigma], template_grid, output_path)
+        manifest.record_pair(state, name, raster_file, compare_file, signatures, labelled_paths, error)
+
+    for sigma, stdev_dir in stdev_dirs.items():
+        save_counts(counts[sigma], template_grid, true_count_paths[sigma])
+        manifest.record_count(state, sigma_label(sigma), true_count_paths[sigma])
+
+        per_raster_path = os.path.join(stdev_dir, type + '_' + sigma_label(sigma) + '_percent.tif')
+        percent_raster(true_count_paths[sigma], int_count_raster, per_raster_path)
+
+    manifest.finish_run(state, manifest_path)
+    return
+
+def gdal_total_intersection(image_directory, template_raster_path, int_count_raster, pipeline=None):
+    '''
+    raster_adder.total_intersection without arcpy. The pairs' masks are read through pair_pipeline and counted as they
+    come, nothing is written per pair.
+    :param image_directory: The directory of the images (N, LIG, or LMA).
+    :param template_raster_path: The zero constant raster of the maximum extent of all the paths.
+    :param int_count_raster: Where the intersection count (path_counts) raster goes.
+    :param pipeline: pair_pipeline.PipelineSettings. None uses its defaults.
+    :return:
+    '''
+    import pair_pipeline
+
+    meaningful_files = line_paths(image_directory, template_raster_path)
+    for raster_file, compare_file, output, error in pair_pipeline.total_intersection(
+            overlapping_pairs(meaningful_files), template_raster_path, int_count_raster, pipeline or pair_pipeline.DEFAULT_SETTINGS):
+        print raster_file
+        print '\t' + compare_file
+        if error: print '\t\tFAILED ' + error
+    return
+
+def direct_stdev_analysis(image_directory, template_raster_path, type, sigmas=(1, 1.96), memory_budget=None):
+    '''
+    Makes the same true count and percent rasters as multi_stdev_analysis but counts the pairs per pixel with
+    pixel_counter instead of writing a comparison raster for every pair and summing them. The intersection count it
+    divides by is counted along the way and saved as <type>_path_counts.tif in the image directory.
+    :param image_directory: The directory of the images (N, LIG, or LMA) for analysis.
+    :param template_raster_path: The zero constant raster of the maximum extent of all the paths.
+    :param sigmas: The standard deviation ranges to check.
+    :param memory_budget: Roughly how many bytes of arrays to hold at once. None uses the tiling default.
+    :return:
+    '''
+
+    stdev_dirs = dict((sigma, os.path.join(image_directory, sigma_label(sigma) + '_outs')) for sigma in sigmas)
+    for stdev_dir in stdev_dirs.values():
+        if not os.path.exists(stdev_dir): os.makedirs(stdev_dir)
+
+    true_count_paths = dict((sigma, os.path.join(stdev_dir, type + '_' + sigma_label(sigma) + '_true_count.tif'))
+                            for sigma, stdev_dir in stdev_dirs.items())
+    per_raster_paths = dict((sigma, os.path.join(stdev_dir, type + '_' + sigma_label(sigma) + '_percent.tif'))
+                            for sigma, stdev_dir in stdev_dirs.items())
+    path_count_path = os.path.join(image_directory, type + '_path_counts.tif')
+
+    meaningful_files = line_paths(image_directory, template_raster_path)
+    count_lines(meaningful_files, template_raster_path, true_count_paths, per_raster_paths, path_count_path,
+                memory_budget or DEFAULT_MEMORY_BUDGET)
+    return
+
+def shared_stdev_analysis(variables, template_raster_path, int_count_raster, sigmas=(1, 1.96), pipeline=None, memory_budget=None):
+    '''
+    multi_stdev_analysis for N, LMA and LIG (or any variables made from the same flight lines) in one go, counting
+    straight into the true count rasters rather than writing a comparison raster for every pair. Each pair's overlap
+    and intersection mask are worked out once and every variable is tested against them, see shared_geometry. The
+    true count and percent rasters go in each variable's directory as usual.
+    :param variables: List of (type, image directory), e.g. [('n', n_path), ('lma', lma_path), ('lig', lig_path)]. The
+    first one's lines define the pair geometry.
+    :param template_raster_path: The zero constant raster of the maximum extent of all the paths.
+    :param int_count_raster: Where the intersection count (path_counts) raster goes. There's only one for every variable.
+    :param sigmas: The standard deviation ranges to check.
+    :param pipeline: pair_pipeline.PipelineSettings. None uses its defaults.
+    :param memory_budget: Roughly how many bytes of count arrays to hold at once. None uses the tiling default.
+    :return:
+    '''
+    import pair_pipeline
+    import shared_geometry
+
+    true_count_paths = []
+    per_raster_paths = []
+    for type, image_directory in variables:
+        stdev_dirs = dict((sigma, os.path.join(image_directory, sigma_label(sigma) + '_outs')) for sigma in sigmas)
+        for stdev_dir in stdev_dirs.values():
+            if not os.path.exists(stdev_dir): os.makedirs(stdev_dir)
+
+        true_count_paths.append(dict((sigma, os.path.join(stdev_dir, type + '_' + sigma_label(sigma) + '_true_count.tif'))
+                                     for sigma, stdev_dir in stdev_dirs.items()))
+        per_raster_paths.append(dict((sigma, os.path.join(stdev_dir, type + '_' + sigma_label(sigma) + '_percent.tif'))
+                                     for sigma, stdev_dir in stdev_dirs.items()))
+
+    lines = shared_geometry.match_lines([(type, line_paths(image_directory, template_raster_path))
+                                         for type, image_directory in variables])
+    for raster_file, compare_file, output, error in shared_geometry.count_variables(
+            shared_geometry.line_pairs(lines), template_raster_path, sigmas, true_count_paths, per_raster_paths,
+            int_count_raster, pipeline or pair_pipeline.DEFAULT_SETTINGS, memory_budget or DEFAULT_MEMORY_BUDGET):
+        print raster_file
+        print '\t' + compare_file
+        if error: print '\t\tFAILED ' + error
+    return
+
+def quicklook_stdev_analysis(image_directory, template_raster_path, type, factor=16, sigmas=(1, 1.96)):
+    '''
+    A rough direct_stdev_analysis made from the lines' overviews instead of the lines, for a first look at a new set of
+    lines. The lines need ingesting with this factor and the same template first (line_ingest.ingest_lines). Outputs
+    have _ovr<factor> on the end of the name and are on a template grid <factor> times coarser. The counts go in
+    <sigma>_outs_ovr<factor> directories of their own, the full resolution analyses sum every .tif in <sigma>_outs.
+    :param image_directory: The directory of the images (N, LIG, or LMA) for analysis.
+    :param template_raster_path: The zero constant raster of the maximum extent of all the paths.
+    :param type: A string to differentiate the output names, e.g. 'n', 'lig', 'lma'.
+    :param factor: Which overview to use.
+    :param sigmas: The standard deviation ranges to check.
+    :return:
+    '''
+    import line_ingest
+
+    suffix = '_ovr%d' % factor
+    meaningful_files = get_files_of_ext(image_directory, '.bsq')
+
+    # An overview made for another template (or a line that's changed since) would land up to half a coarse cell off.
+    template = line_ingest.template_record(template_raster_path)
+    missing = []
+    for path in meaningful_files:
+        info = line_ingest.read_info(path)
+        if (info is None or factor not in info['overviews'] or info.get('template') != template or
+                not os.path.exists(line_ingest.overview_path(path, factor))):
+            missing.append(path)
+    if missing:
+        raise RuntimeError('%d lines have no current %d overview for this template, ingest them first' % (len(missing), factor))
+
+    coarse_template = os.path.join(image_directory, type + '_template' + suffix + '.tif')
+    coarse_grid = line_ingest.overview_grid(get_grid(template_raster_path), factor, (0, 0))
+    coarse_raster = create_raster(coarse_template, coarse_grid, (0, 0, coarse_grid.cols, coarse_grid.rows))
+    coarse_raster = None
+
+    stdev_dirs = dict((sigma, os.path.join(image_directory, sigma_label(sigma) + '_outs' + suffix)) for sigma in sigmas)
+    for stdev_dir in stdev_dirs.values():
+        if not os.path.exists(stdev_dir): os.makedirs(stdev_dir)
+
+    true_count_paths = dict((sigma, os.path.join(stdev_dir, type + '_' + sigma_label(sigma) + '_true_count' + suffix + '.tif'))
+                            for sigma, stdev_dir in stdev_dirs.items())
+    per_raster_paths = dict((sigma, os.path.join(stdev_dir, type + '_' + sigma_label(sigma) + '_percent' + suffix + '.tif'))
+                            for sigma, stdev_dir in stdev_dirs.items())
+    path_count_path = os.path.join(image_directory, type + '_path_counts' + suffix + '.tif')
+
+    overview_files = [line_ingest.overview_path(path, factor) for path in meaningful_files]
+    count_lines(overview_files, coarse_template, true_count_paths, per_raster_paths, path_count_path)
+    return
+
+def plan_sharded_analysis(image_directory, template_raster_path, type, work_directory, shard_count, sigmas=(1, 1.96)):
+    '''
+    Splits the pairs of an analysis into shards for shards.run_shards to work through on as many machines as share the
+    work directory, then shards.merge writes the usual true count and percent rasters. Like direct_stdev_analysis the
+    intersection count is counted along the way and saved as <type>_path_counts.tif in the image directory.
+    :param image_directory: The directory of the images (N, LIG, or LMA) for analysis.
+    :param template_raster_path: The zero constant raster of the maximum extent of all the paths.
+    :param type: A string to differentiate the output names, e.g. 'n', 'lig', 'lma'.
+    :param work_directory: The work directory every node can see.
+    :param shard_count: How many shards to split the pairs into.
+    :param sigmas: The standard deviation ranges to check.
+    :return: The plan dictionary.
+    '''
+    import shards
+
+    stdev_dirs = dict((sigma, os.path.join(image_directory, sigma_label(sigma) + '_outs')) for sigma in sigmas)
+    for stdev_dir in stdev_dirs.values():
+        if not os.path.exists(stdev_dir): os.makedirs(stdev_dir)
+
+    outputs = dict((sigma_label(sigma), (os.path.join(stdev_dir, type + '_' + sigma_label(sigma) + '_true_count.tif'),
+                                         os.path.join(stdev_dir, type + '_' + sigma_label(sigma) + '_percent.tif')))
+                   for sigma, stdev_dir in stdev_dirs.items())
+    path_count_path = os.path.join(image_directory, type + '_path_counts.tif')
+
+    meaningful_files = line_paths(image_directory, template_raster_path)
+    labels = dict((sigma, sigma_label(sigma)) for sigma in sigmas)
+    return shards.make_plan(work_directory, meaningful_files, overlapping_pairs(meaningful_files), template_raster_path,
+                            labels, outputs, path_count_path, shard_count)
+
+if __name__ == '__main__':
+    n_path = r"C:\_sword_analysis\4-14-15\Resampled_AVG\N"
+    lma_path = r"C:\_sword_analysis\4-14-15\Resampled_AVG\LMA"
+    lig_path = r"C:\_sword_analysis\4-14-15\Resampled_AVG\LIG"
+
+    path_count = r"C:\_sword_analysis\4-14-15\Resampled_AVG\path_counts.tif"
+    template_raster_path = r"C:\_sword_analysis\4-8-15\empty_raster.tif"
+
+    # Per pair timings and failures go to a JSON lines log, with a summary printed at the end.
+    instrument.enable(r"C:\_sword_analysis\4-14-15\Resampled_AVG\instrument.jsonl")
 
-path_count = r"C:\_sword_analysis\4-14-15\Resampled_AVG\path_counts.tif"
-template_raster_path = r"C:\_sword_analysis\4-8-15\empty_raster.tif"
+    # total_intersection(n_path, template_raster_path, path_count)
 
-# total_intersection(n_path, template_raster_path, path_count)
+    # stdev_analysis(n_path, template_raster_path, path_count, 'n')
+    # _196stdev_analysis(n_path, template_raster_path, path_count, 'n')
 
-# stdev_analysis(n_path, template_raster_path, path_count, 'n')
-# _196stdev_analysis(n_path, template_raster_path, path_count, 'n')
+    # stdev_analysis(lma_path, template_raster_path, path_count, 'lma')
+    _196stdev_analysis(lma_path, template_raster_path, path_count, 'lma')
 
-# stdev_analysis(lma_path, template_raster_path, path_count, 'lma')
-_196stdev_analysis(lma_path, template_raster_path, path_count, 'lma')
+    multi_stdev_analysis(lig_path, template_raster_path, path_count, 'lig')
 
-stdev_analysis(lig_path, template_raster_path, path_count, 'lig')
-_196stdev_analysis(lig_path, template_raster_path, path_count, 'lig')
+    instrument.write_summary()